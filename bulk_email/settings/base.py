@@ -148,6 +148,35 @@ EMAIL_HOST_USER = config("EMAIL_USER", "")
 EMAIL_HOST_PASSWORD = config("EMAIL_PASSWORD", "")
 EMAIL_USE_TLS = True
 
+# The send rate budget of the SMTP relay for mass email (Office365 limits).
+# BURST is how many sends may go out back to back when the budget allows.
+EMAIL_SEND_RATE_PER_MINUTE = config("EMAIL_SEND_RATE_PER_MINUTE", 30, cast=int)
+EMAIL_SEND_RATE_PER_DAY = config("EMAIL_SEND_RATE_PER_DAY", 10000, cast=int)
+EMAIL_SEND_RATE_BURST = config("EMAIL_SEND_RATE_BURST", 1, cast=int)
+
+# The async SMTP delivery engine: concurrent SMTP sessions, and how many
+# rendered messages may wait for a free session.
+EMAIL_ASYNC_SESSIONS = config("EMAIL_ASYNC_SESSIONS", 4, cast=int)
+EMAIL_ASYNC_QUEUE_SIZE = config("EMAIL_ASYNC_QUEUE_SIZE", 100, cast=int)
+
+# The cache is shared by the web and worker processes, so an entry one of
+# them writes or invalidates is seen by all of them (compiled batch
+# templates, previews, list filter choices). The table is created with
+# `python manage.py createcachetable`, see the Procfile.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "email_tool_cache",
+        # Previews are cached per Customer, the default of 300 would be culled all the time.
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    }
+}
+
+# Open and click tracking hits are counted in memory and written to the db
+# every FLUSH_INTERVAL seconds, or sooner once BUFFER_SIZE emails have hits.
+EMAIL_TRACKING_FLUSH_INTERVAL = config("EMAIL_TRACKING_FLUSH_INTERVAL", 5, cast=int)
+EMAIL_TRACKING_BUFFER_SIZE = config("EMAIL_TRACKING_BUFFER_SIZE", 1000, cast=int)
+
 
 # Ckeditor Configs #
 CKEDITOR_CONFIGS = {
@@ -264,10 +293,13 @@ JAZZMIN_SETTINGS = {
         "auth.user": "fas fa-user",
         "auth.Group": "fas fa-user-friends",
         "email_tool.customer": "fas fa-users",
+        "email_tool.customersegment": "fas fa-filter",
         "email_tool.emailbatch": "fas fa-mail-bulk",
         "email_tool.emailmessage": "fas fa-envelope",
+        "email_tool.deadletteremailmessage": "fas fa-exclamation-triangle",
         "email_tool.imageresource": "fas fa-images",
         "email_tool.nextactionitem": "fas fa-calendar-alt",
+        "email_tool.suppression": "fas fa-ban",
         "candidates.candidate": "fas fa-briefcase",
         "candidates.techstack": "fas fa-laptop-code",
         "document.document": "fas fa-file-upload",
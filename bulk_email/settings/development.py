@@ -3,6 +3,7 @@ from .base import *
 DEBUG = True
 
 UNSUBSCRIBE_ROUTE_BASE = "http://127.0.0.1:8000/email/unsubscribe"
+EMAIL_ROUTE_BASE = "http://127.0.0.1:8000/email"
 
 ALLOWED_HOSTS += ["*"]
 
@@ -12,5 +13,8 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+        # A file rather than the in-memory default, so the threads of a
+        # parallel send wait for each other's writes instead of failing.
+        "TEST": {"NAME": os.path.join(BASE_DIR, "test_db.sqlite3")},
     }
 }
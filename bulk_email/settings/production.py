@@ -4,6 +4,7 @@ from decouple import config
 DEBUG = False
 
 UNSUBSCRIBE_ROUTE_BASE = "https://oppdashboard.com/email/unsubscribe"
+EMAIL_ROUTE_BASE = "https://oppdashboard.com/email"
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -5,6 +5,7 @@ from decouple import config
 DEBUG = True
 
 UNSUBSCRIBE_ROUTE_BASE = "https://fidelis-opp-staging.herokuapp.com/email/unsubscribe"
+EMAIL_ROUTE_BASE = "https://fidelis-opp-staging.herokuapp.com/email"
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -3,11 +3,15 @@ from datetime import datetime
 
 ### Django imports ###
 from django import forms
-from django.contrib import admin
-from django.http import HttpResponseRedirect
+from django.contrib import admin, messages
+from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
+from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 from django.contrib.admin import SimpleListFilter
+from django.contrib.admin.views.main import ORDER_VAR
+from django.db import transaction
+from django.db.models import Count, F, Q
 from django.utils.timezone import now
 
 ### Third Party imports ###
@@ -29,7 +33,15 @@ from .models import (
     NextActionItem,
     NextActionItemStatus,
     ImageCategory,
+    Suppression,
+    DeadLetterEmailMessage,
+    DeliveryState,
+    EmailBatchStatus,
+    CustomerSegment,
 )
+from .messaging.preview import batch_preview, cached_preview, customer_values
+from .list_filters import CachedChoicesFilter, CachedChoicesFilterAdminMixin
+from .search import search_customers
 
 
 class ImageCategoryFilter(admin.SimpleListFilter):
@@ -235,6 +247,19 @@ class CreateNewEmailBatchForm(forms.Form):
     )
 
 
+# The values of `CreateNewEmailBatchForm` that its previews show.
+PREVIEW_FORM_FIELDS = [
+    "subject",
+    "title",
+    "custom_content",
+    "call_to_action_button_text",
+    "call_to_action_button_link",
+    "company_logo",
+    "alt_company_logo",
+    "primary_image",
+]
+
+
 class SendExistingEmailBatchForm(forms.Form):
     selected_batch = EmailBatchChoiceField(queryset=EmailBatch.objects.filter(archived=False))
     batch_title = forms.CharField(
@@ -245,7 +270,7 @@ class SendExistingEmailBatchForm(forms.Form):
 
 
 @admin.register(NextActionItem)
-class NextActionItemAdminModel(admin.ModelAdmin):
+class NextActionItemAdminModel(CachedChoicesFilterAdminMixin, admin.ModelAdmin):
     """Admin View for NextActionItem"""
 
     list_display = [
@@ -259,7 +284,7 @@ class NextActionItemAdminModel(admin.ModelAdmin):
 
     list_filter = [
         NextActionItemStatusFilter,
-        "customer",
+        ("customer", CachedChoicesFilter),
         "assignee",
         "target_date",
         "created_at",
@@ -302,7 +327,7 @@ class CustomerResource(resources.ModelResource):
 
 
 @admin.register(Customer)
-class CustomerAdminModel(ImportExportModelAdmin):
+class CustomerAdminModel(CachedChoicesFilterAdminMixin, ImportExportModelAdmin):
     """ Used for django-import-export library."""
 
     resource_class = CustomerResource
@@ -364,7 +389,9 @@ class CustomerAdminModel(ImportExportModelAdmin):
                 ]
             },
         ),
+        ("Emails", {"fields": ["last_emailed_at", "emails_sent_count", "is_dnc"]}),
     ]
+    readonly_fields = ["last_emailed_at", "emails_sent_count", "is_dnc"]
 
     ordering = ("company",)
 
@@ -379,6 +406,8 @@ class CustomerAdminModel(ImportExportModelAdmin):
         "interest_level",
         "business_type",
         "relationship_type",
+        "last_emailed_at",
+        "can_email",
         "next_actions_pastdue",
     ]
 
@@ -396,15 +425,16 @@ class CustomerAdminModel(ImportExportModelAdmin):
     ]
 
     list_filter = [
-        "primary_contact",
-        "assignee",
+        ("primary_contact", CachedChoicesFilter),
+        ("assignee", CachedChoicesFilter),
         "last_contacted",
         ServiceCategoryFilter,
         RelationshipTypeFilter,
         BusinessTypeFilter,
-        # IsDncFilter,
+        "is_dnc",
+        "last_emailed_at",
         StatusFilter,
-        "master_company",
+        ("master_company", CachedChoicesFilter),
     ]
 
     actions = [
@@ -412,13 +442,42 @@ class CustomerAdminModel(ImportExportModelAdmin):
         "send_existing_batch_to_different_customers",
     ]
 
+    def get_queryset(self, request):
+        """Counts the past due Next Action Items and joins the primary contact
+        in the changelist query, so rendering a row doesn't query either.
+        """
+        return (
+            super()
+            .get_queryset(request)
+            .select_related("primary_contact")
+            .annotate(
+                pastdue_count=Count(
+                    "nextactionitem",
+                    filter=Q(nextactionitem__completed__isnull=True, nextactionitem__target_date__lt=now()),
+                )
+            )
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        """Searches the Customers' search documents, see `email_tool.search`,
+        instead of an OR of `search_fields` for every word. The results are
+        ranked by relevance unless a column is sorted on.
+        """
+        results = search_customers(queryset, search_term)
+        if results is None:
+            return super().get_search_results(request, queryset, search_term)
+
+        if ORDER_VAR not in request.GET:
+            results = results.order_by("-search_rank", *queryset.query.order_by)
+        return results, False
+
     def next_actions_pastdue(self, obj):
-        pastdue_count = obj.nextactionitem_set.filter(completed__isnull=True, target_date__lt=now()).count()
-        if pastdue_count > 0:
-            return mark_safe(f'<b style="background:red; color: white; padding:5px;">{pastdue_count}</b>')  # noqa
+        if obj.pastdue_count > 0:
+            return mark_safe(f'<b style="background:red; color: white; padding:5px;">{obj.pastdue_count}</b>')  # noqa
         return ""
 
     next_actions_pastdue.short_description = "Next actions past due"
+    next_actions_pastdue.admin_order_field = "pastdue_count"
 
     def status(self, customer):
         """ Styles the color for each item in the status field"""
@@ -443,15 +502,11 @@ class CustomerAdminModel(ImportExportModelAdmin):
         return mark_safe(f'<b style="background:{color}; color: white; padding:5px;">{status.value}</b>')
 
     def can_email(self, customer):
-        return not customer.is_dnc()
+        return not customer.is_dnc
 
     can_email.boolean = True
     can_email.short_description = "Can Email"
-
-    def last_emailed_at(self, customer):
-        return customer.last_emailed_at()
-
-    last_emailed_at.short_description = "Last Emailed"
+    can_email.admin_order_field = "is_dnc"
 
     def create_new_email_batch(self, request, queryset):
         """Action handler for creating an email batch with full control
@@ -470,12 +525,9 @@ class CustomerAdminModel(ImportExportModelAdmin):
 
         # If not a submission request, then we just render the form page
         # for the user to fill out.
-        context = {
-            "customers": queryset,
-            "form": CreateNewEmailBatchForm(),
-            "action": "create_new_email_batch",
-        }
-        return render(request, "admin/mass_email_form.html", context=context)
+        return _render_mass_email_form(
+            request, CreateNewEmailBatchForm(), "create_new_email_batch", queryset, queryset
+        )
 
     create_new_email_batch.short_description = "Create new email batch to selected customers"
 
@@ -501,12 +553,9 @@ class CustomerAdminModel(ImportExportModelAdmin):
             return self._execute_mass_email(request, queryset, existing_batch)
 
         # If not a submission request, then we just render the form page for the user to fill out.
-        context = {
-            "customers": queryset,
-            "form": SendExistingEmailBatchForm(),
-            "action": "send_existing_batch_to_different_customers",
-        }
-        return render(request, "admin/mass_email_form.html", context=context)
+        return _render_mass_email_form(
+            request, SendExistingEmailBatchForm(), "send_existing_batch_to_different_customers", queryset, queryset
+        )
 
     send_existing_batch_to_different_customers.short_description = "Send existing email batch to selected customers"
 
@@ -514,34 +563,43 @@ class CustomerAdminModel(ImportExportModelAdmin):
         """Return the rendered email template with the current
         form values rendered, i.e. a "Preview". Make sure the submit
         button uses `formtarget="_blank"` so it opens in a new tab.
+
+        Previews are cached by the form values, so clicking Preview again
+        without changes doesn't render it again.
         """
         customer = queryset[0]  # we use first customer just for preview
         values = request.POST
-
-        # Creates a tmp instance so we can pass it to the template for rendering
-        email_message = EmailMessage()
-        email_message.subject = values["subject"]
-        email_message.title = values["title"]
-        email_message.custom_message = values["custom_content"]
-        email_message.call_to_action_button_text = values["call_to_action_button_text"]
-        email_message.call_to_action_button_link = values["call_to_action_button_link"]
-
-        if _not_blank(values, "company_logo"):
-            email_message.company_logo = ImageResource.objects.get(pk=values["company_logo"])
-
-        if _not_blank(values, "alt_company_logo"):
-            email_message.alt_company_logo = ImageResource.objects.get(pk=values["alt_company_logo"])
-
-        if _not_blank(values, "primary_image"):
-            email_message.primary_image = ImageResource.objects.get(pk=values["primary_image"])
-
         template_file = values["template_file"]
-        context = {
-            "customer": customer,
-            "email_message": email_message,
-            "unsubscribe_link": "https://www.google.com",
-        }
-        return render(request, f"email/{template_file}", context)
+
+        def render_preview():
+            # Creates a tmp instance so we can pass it to the template for rendering
+            email_message = EmailMessage()
+            email_message.subject = values["subject"]
+            email_message.title = values["title"]
+            email_message.custom_message = values["custom_content"]
+            email_message.call_to_action_button_text = values["call_to_action_button_text"]
+            email_message.call_to_action_button_link = values["call_to_action_button_link"]
+
+            if _not_blank(values, "company_logo"):
+                email_message.company_logo = ImageResource.objects.get(pk=values["company_logo"])
+
+            if _not_blank(values, "alt_company_logo"):
+                email_message.alt_company_logo = ImageResource.objects.get(pk=values["alt_company_logo"])
+
+            if _not_blank(values, "primary_image"):
+                email_message.primary_image = ImageResource.objects.get(pk=values["primary_image"])
+
+            context = {
+                "customer": customer,
+                "email_message": email_message,
+                "unsubscribe_link": "https://www.google.com",
+            }
+            return render_to_string(f"email/{template_file}", context, request)
+
+        form_values = [values.get(name) for name in PREVIEW_FORM_FIELDS]
+        return HttpResponse(
+            cached_preview(None, template_file, [*form_values, customer_values(customer)], render_preview)
+        )
 
     def _build_preview_for_existing_batch(self, request, queryset, batch):
         """Return the rendered email template with values from
@@ -549,19 +607,11 @@ class CustomerAdminModel(ImportExportModelAdmin):
         Make sure the submit button uses `formtarget="_blank"` so
         it opens in a new tab.
         """
-        customer = queryset[0]  # we use first customer just for preview
-        email_message = batch.create_email_message(customer)
-        template_file = batch.template_file
-
-        context = {
-            "customer": customer,
-            "email_message": email_message,
-            "unsubscribe_link": "https://www.google.com",
-        }
-        return render(request, f"email/{template_file}", context)
+        return _build_batch_preview(request, queryset[0], batch)  # we use first customer just for preview
 
     def _execute_mass_email(self, request, queryset, existing_batch=None):
-        """Loop over the customer queryset and send an email to each one.
+        """Create a new EmailBatch and queue it to be sent to each customer
+        in the queryset.
 
         Arguments:
             `request`: The Django `Request` object from the admin site we're
@@ -595,28 +645,15 @@ class CustomerAdminModel(ImportExportModelAdmin):
             new_batch = existing_batch.clone(values["batch_title"])
             new_batch.save()
 
-        # Iterate thru customer queryset and create an EmailMessage for each.
-        initiated, skipped = 0, 0
-        for customer in queryset.all():
-
-            if customer.is_dnc():
-                skipped += 1
-                continue
-
-            # We use a factory method on the BatchEmail object we just
-            # created to construct the EmailMessage objects then immediately
-            # call save(), initiating sending the object via signal handler.
-            new_batch.create_email_message(customer).save()
-            initiated += 1
-
-        # Update the EmailBatch object with the results of the sending themails
-        new_batch.emails_initiated = initiated
-        new_batch.emails_skipped = skipped
-        new_batch.save()
+        # Queue the batch for the customers in the queryset. The actual
+        # sending happens in the `process_email_queue` worker so that
+        # large batches don't run past the request timeout.
+        recipient_count = new_batch.add_recipients(queryset)
 
         self.message_user(
             request,
-            f" We reached {initiated} prospects with this email! {skipped} did not receive this email because they have unsubscribed",
+            f"Your email batch '{new_batch.batch_title}' to {recipient_count} prospects has been queued for sending! "
+            "Customers that have unsubscribed will be skipped.",
         )
         return HttpResponseRedirect(request.get_full_path())
 
@@ -656,9 +693,18 @@ class EmailMessageAdminModel(admin.ModelAdmin):
         ("Images", {"fields": ["company_logo", "alt_company_logo", "primary_image"]}),
     ]
 
-    list_display = ["created_at", "customer", "token", "send_succeeded", "batch_id"]
+    list_display = ["created_at", "customer", "token", "send_succeeded", "delivery_state", "attempts", "batch_id"]
+    list_filter = ["delivery_state"]
     search_fields = ["customer", "send_succeeded"]
-    readonly_fields = ["send_succeeded", "unsubscribed"]
+    readonly_fields = [
+        "send_succeeded",
+        "unsubscribed",
+        "delivery_state",
+        "attempts",
+        "last_attempt_at",
+        "open_count",
+        "click_count",
+    ]
 
     ordering = ("-created_at",)
 
@@ -668,6 +714,47 @@ class EmailMessageAdminModel(admin.ModelAdmin):
         return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
+@admin.register(DeadLetterEmailMessage)
+class DeadLetterEmailMessageAdminModel(admin.ModelAdmin):
+    """Admin View for batch emails that ran out of send attempts"""
+
+    list_display = ["last_attempt_at", "customer", "batch", "attempts", "last_error"]
+    list_filter = ["batch"]
+    search_fields = ["customer__email", "customer__company"]
+    ordering = ("-last_attempt_at",)
+    actions = ["requeue_action"]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).filter(delivery_state=DeliveryState.DEAD_LETTER)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def requeue_action(self, request, queryset):
+        """This action sends the selected emails again with a fresh set of attempts."""
+        with transaction.atomic():
+            per_batch = dict(queryset.order_by().values_list("batch_id").annotate(Count("pk")))
+            requeued = queryset.update(
+                delivery_state=DeliveryState.QUEUED, attempts=0, next_attempt_at=None, last_error=""
+            )
+
+            # They were counted as initiated when they ran out of attempts, and
+            # are counted again once they are finished.
+            for batch_id, count in per_batch.items():
+                EmailBatch.objects.filter(pk=batch_id).update(emails_initiated=F("emails_initiated") - count)
+
+            # Batches that are still sending pick the messages up by themselves.
+            EmailBatch.objects.filter(pk__in=per_batch, status=EmailBatchStatus.COMPLETED).update(
+                status=EmailBatchStatus.QUEUED, next_attempt_at=None
+            )
+        self.message_user(request, f"{requeued} emails have been requeued for sending.")
+
+    requeue_action.short_description = "Requeue selected emails"
+
+
 @admin.register(ImageResource)
 class ImageResourceAdminModel(admin.ModelAdmin):
     list_display = [
@@ -712,6 +799,7 @@ class EmailBatchAdminModel(admin.ModelAdmin):
                 "fields": [
                     "batch_title",
                     "template_file",
+                    "delivery_engine",
                     "archived",
                 ]
             },
@@ -740,8 +828,14 @@ class EmailBatchAdminModel(admin.ModelAdmin):
             "Sent & Skipped",
             {
                 "fields": [
+                    "segment",
+                    "status",
                     "emails_initiated",
+                    "emails_sent",
                     "emails_skipped",
+                    "unsubscribe_count",
+                    "open_count",
+                    "click_count",
                 ]
             },
         ),
@@ -751,15 +845,35 @@ class EmailBatchAdminModel(admin.ModelAdmin):
         "batch_title",
         "template_file",
         "preview_link",
+        "status",
         "emails_sent",
         "emails_skipped",
         "unsubscribe_count",
+        "open_count",
+        "click_count",
         "created_at",
     ]
-    list_filter = [ArchivedFilter]
+    list_filter = [ArchivedFilter, "status"]
+    readonly_fields = ["status", "emails_sent", "unsubscribe_count", "open_count", "click_count"]
 
     ordering = ("batch_title",)
 
+    def get_readonly_fields(self, request, obj=None):
+        # The segment's Customers are queued when the batch is added, changing it later wouldn't send to them.
+        if obj is not None:
+            return [*self.readonly_fields, "segment"]
+        return self.readonly_fields
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        if not change and obj.segment is not None:
+            recipient_count = obj.add_recipients(obj.segment.customers())
+            self.message_user(
+                request,
+                f"Your email batch '{obj.batch_title}' to {recipient_count} prospects in "
+                f"'{obj.segment.name}' has been queued for sending!",
+            )
+
     def archive_action(modeladmin, request, queryset):
         """This action marks selected Email Batches as archived."""
         queryset.update(archived=True)
@@ -775,6 +889,119 @@ class EmailBatchAdminModel(admin.ModelAdmin):
     actions = [archive_action, unarchive_action]
 
 
+@admin.register(CustomerSegment)
+class CustomerSegmentAdminModel(admin.ModelAdmin):
+    """Admin View for saved Customer segments, mass email can be sent to
+    all the Customers of a segment without selecting them one by one.
+    """
+
+    # The criteria are only known in Python, so the count of Customers
+    # would be a query per row, it is only shown on the change page.
+    list_display = ["name", "description", "updated_at"]
+    search_fields = ["name", "description"]
+    readonly_fields = ["customer_count"]
+    fieldsets = [
+        (None, {"fields": ["name", "description", "customer_count"]}),
+        (
+            "Criteria",
+            {
+                "fields": [
+                    "relationship_types",
+                    "service_categories",
+                    "interest_levels",
+                    "contact_statuses",
+                    "business_types",
+                    "primary_contact",
+                    "state",
+                ]
+            },
+        ),
+    ]
+    ordering = ("name",)
+    actions = ["send_existing_batch_to_segment"]
+
+    def customer_count(self, segment):
+        return segment.customers().count() if segment.pk else "-"
+
+    customer_count.short_description = "Customers"
+
+    def send_existing_batch_to_segment(self, request, queryset):
+        """Action handler for sending a clone of an existing email batch
+        to the Customers of a segment. They are selected by the db when
+        the batch is queued, so none of them are posted with the form.
+        """
+        if len(queryset) != 1:
+            self.message_user(request, "Select exactly one segment to send to.", level=messages.WARNING)
+            return None
+        segment = queryset[0]
+
+        if "preview" in request.POST or "apply" in request.POST:
+            existing_batch = EmailBatch.objects.get(pk=request.POST["selected_batch"])
+            if "preview" in request.POST:
+                customer = segment.customers().first()
+                if customer is None:
+                    self.message_user(request, f"'{segment.name}' has no Customers.", level=messages.WARNING)
+                    return None
+                return _build_batch_preview(request, customer, existing_batch)
+
+            new_batch = existing_batch.clone(request.POST["batch_title"])
+            new_batch.segment = segment
+            new_batch.save()
+            recipient_count = new_batch.add_recipients(segment.customers())
+            self.message_user(
+                request,
+                f"Your email batch '{new_batch.batch_title}' to {recipient_count} prospects in '{segment.name}' "
+                "has been queued for sending! Customers that have unsubscribed will be skipped.",
+            )
+            return HttpResponseRedirect(request.get_full_path())
+
+        return _render_mass_email_form(
+            request, SendExistingEmailBatchForm(), "send_existing_batch_to_segment", queryset, segment.customers()
+        )
+
+    send_existing_batch_to_segment.short_description = "Send existing email batch to selected segment"
+
+
+@admin.register(Suppression)
+class SuppressionAdminModel(admin.ModelAdmin):
+    """Admin View for the suppression list"""
+
+    list_display = ["email", "customer", "reason", "created_at"]
+    list_filter = ["reason"]
+    search_fields = ["email"]
+    raw_id_fields = ["customer"]
+    ordering = ("-created_at",)
+
+
+def _render_mass_email_form(request, form, action, selected, recipients):
+    """Renders the form page of a mass email action.
+
+    Arguments:
+        `form`: The form for the user to fill out.
+        `action`: The name of the admin action the form is submitted to.
+        `selected`: The objects the action was run on, posted back with the
+            form. If all of them were selected with the admin's "select all"
+            only that and one of them (the admin requires one) are posted
+            back, and the admin selects them again from the filters in the url.
+        `recipients`: The Customers the mass email is going to.
+    """
+    select_across = request.POST.get("select_across") == "1"
+    selected = selected.select_related(None).only("pk")
+    context = {
+        "selected": selected[:1] if select_across else selected,
+        "select_across": select_across,
+        "recipient_count": recipients.count(),
+        "form": form,
+        "action": action,
+    }
+    return render(request, "admin/mass_email_form.html", context=context)
+
+
+def _build_batch_preview(request, customer, batch):
+    """Returns the email of the existing `batch` rendered for `customer`."""
+    return HttpResponse(batch_preview(request, batch, customer))
+
+
 def _not_blank(POST, property_name):
     return POST.get(property_name) not in [None, ""]
 
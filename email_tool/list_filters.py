@@ -0,0 +1,203 @@
+""" Admin list filters whose choices are cached.
+
+Django's list filters for a field run a `SELECT DISTINCT` over the whole
+table on every changelist load, and render every value into the filter.
+`CachedChoicesFilter` loads the values in use once, caches them until the
+models they come from change, see `evict_filter_choices()`, and turns into
+a searchable autocomplete once there are too many to list.
+
+The cache is shared by all the processes, so a change saved by any of them
+evicts the choices everywhere. Changes that skip the model signals, e.g.
+`QuerySet.update()`, show up once the choices expire.
+"""
+
+### Python imports ###
+import uuid
+
+### Django imports ###
+from django import forms
+from django.contrib import admin
+from django.contrib.admin.utils import get_fields_from_path
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, JsonResponse
+from django.urls import path, reverse
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+# How long the choices of a filter are kept in the cache, i.e. how long
+# changes that don't evict them take to show up.
+FILTER_CHOICES_TIMEOUT = 15 * 60
+
+# Filters with more choices than this are rendered as an autocomplete.
+FILTER_AUTOCOMPLETE_THRESHOLD = 100
+
+# The number of choices the autocomplete returns at a time.
+FILTER_AUTOCOMPLETE_PAGE_SIZE = 20
+
+
+def filter_choices(model, field_path):
+    """Returns the `(value, label)` of every value of `field_path` in use by
+    the objects of `model`, loading them the first time.
+    """
+    field = get_fields_from_path(model, field_path)[-1]
+    key = _choices_key(model, field, field_path)
+    choices = cache.get(key)
+    if choices is None:
+        choices = _load_choices(model, field, field_path)
+        cache.set(key, choices, FILTER_CHOICES_TIMEOUT)
+    return choices
+
+
+def evict_filter_choices(model):
+    """Evicts the choices of the filters on `model`, and of the filters
+    listing objects of `model`, e.g. Users for a filter on `primary_contact`.
+    """
+    cache.set(_generation_key(model), uuid.uuid4().hex, None)
+
+
+class CachedChoicesFilter(admin.FieldListFilter):
+    """Filters on the values of a field, or the objects of a relation, in
+    use. The choices are loaded only when the filter is rendered.
+
+    Usage:
+        list_filter = [("primary_contact", CachedChoicesFilter)]
+
+    The ModelAdmin must include `CachedChoicesFilterAdminMixin`, which
+    serves the autocomplete.
+    """
+
+    def __init__(self, field, request, params, model, model_admin, field_path):
+        # The same parameters as Django's filters, so their urls keep working.
+        if field.is_relation:
+            self.lookup_kwarg = f"{field_path}__{field.target_field.name}__exact"
+        else:
+            self.lookup_kwarg = f"{field_path}__exact"
+        self.lookup_kwarg_isnull = f"{field_path}__isnull"
+        self.lookup_val = params.get(self.lookup_kwarg)
+        self.lookup_val_isnull = params.get(self.lookup_kwarg_isnull)
+        self.include_empty_choice = field.null
+        self.empty_value_display = model_admin.get_empty_value_display()
+        self.model = model
+        self.admin_site_name = model_admin.admin_site.name
+        super().__init__(field, request, params, model, model_admin, field_path)
+
+    def expected_parameters(self):
+        return [self.lookup_kwarg, self.lookup_kwarg_isnull]
+
+    def has_output(self):
+        # Whether there are any choices isn't known without loading them.
+        return True
+
+    @cached_property
+    def lookup_choices(self):
+        return filter_choices(self.model, self.field_path)
+
+    @property
+    def uses_autocomplete(self):
+        return len(self.lookup_choices) > FILTER_AUTOCOMPLETE_THRESHOLD
+
+    @property
+    def template(self):
+        return "admin/autocomplete_filter.html" if self.uses_autocomplete else "admin/filter.html"
+
+    @property
+    def autocomplete_url(self):
+        opts = self.model._meta
+        return reverse(
+            f"{self.admin_site_name}:{opts.app_label}_{opts.model_name}_filter_choices", args=[self.field_path]
+        )
+
+    def choices(self, changelist):
+        yield {
+            "selected": self.lookup_val is None and not self.lookup_val_isnull,
+            "query_string": changelist.get_query_string(remove=[self.lookup_kwarg, self.lookup_kwarg_isnull]),
+            "display": _("All"),
+        }
+        for value, label in self.lookup_choices:
+            # The autocomplete only needs the chosen value, it searches the rest.
+            if self.uses_autocomplete and value != self.lookup_val:
+                continue
+            yield {
+                "selected": value == self.lookup_val,
+                "query_string": changelist.get_query_string({self.lookup_kwarg: value}, [self.lookup_kwarg_isnull]),
+                "display": label,
+                "value": value,
+            }
+        if self.include_empty_choice:
+            yield {
+                "selected": bool(self.lookup_val_isnull),
+                "query_string": changelist.get_query_string({self.lookup_kwarg_isnull: "True"}, [self.lookup_kwarg]),
+                "display": self.empty_value_display,
+            }
+
+
+class CachedChoicesFilterAdminMixin:
+    """Serves the autocomplete of the `CachedChoicesFilter`s of a ModelAdmin's
+    `list_filter`, in the format of Django's autocomplete.
+    """
+
+    @property
+    def media(self):
+        return super().media + forms.Media(js=["autocomplete_filter.js"])
+
+    def get_urls(self):
+        opts = self.model._meta
+        return [
+            path(
+                "filter-choices/<str:field_path>/",
+                self.admin_site.admin_view(self.filter_choices_view),
+                name=f"{opts.app_label}_{opts.model_name}_filter_choices",
+            ),
+        ] + super().get_urls()
+
+    def filter_choices_view(self, request, field_path):
+        if not self.has_view_or_change_permission(request):
+            raise PermissionDenied
+        if (field_path, CachedChoicesFilter) not in [
+            tuple(entry) for entry in self.list_filter if isinstance(entry, (list, tuple))
+        ]:
+            raise Http404(f"'{field_path}' has no cached list filter.")
+
+        term = request.GET.get("term", "").lower()
+        try:
+            page = max(int(request.GET.get("page", 1)), 1)
+        except ValueError:
+            page = 1
+
+        matches = [(value, label) for value, label in filter_choices(self.model, field_path) if term in label.lower()]
+        start = (page - 1) * FILTER_AUTOCOMPLETE_PAGE_SIZE
+        end = start + FILTER_AUTOCOMPLETE_PAGE_SIZE
+        return JsonResponse(
+            {
+                "results": [{"id": value, "text": label} for value, label in matches[start:end]],
+                "pagination": {"more": end < len(matches)},
+            }
+        )
+
+
+def _load_choices(model, field, field_path):
+    in_use = model._default_manager.exclude(**{f"{field_path}__isnull": True}).order_by().values(field_path)
+    if field.is_relation:
+        objects = field.related_model._default_manager.filter(pk__in=in_use.distinct())
+        choices = [(str(obj.pk), str(obj)) for obj in objects]
+        return sorted(choices, key=lambda choice: choice[1].lower())
+    values = in_use.exclude(**{field_path: ""}).order_by(field_path).distinct().values_list(field_path, flat=True)
+    return [(str(value), str(value)) for value in values]
+
+
+def _choices_key(model, field, field_path):
+    models = [model, field.related_model] if field.is_relation else [model]
+    generation_keys = [_generation_key(model) for model in models]
+    generations = cache.get_many(generation_keys)
+    missing = {key: uuid.uuid4().hex for key in generation_keys if key not in generations}
+    if missing:
+        cache.set_many(missing, None)
+        generations.update(missing)
+
+    generation = ":".join(generations[key] for key in generation_keys)
+    return f"email_tool:filter_choices:{model._meta.label_lower}:{field_path}:{generation}"
+
+
+def _generation_key(model):
+    return f"email_tool:filter_choices_generation:{model._meta.label_lower}"
@@ -0,0 +1,58 @@
+from time import perf_counter
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+
+from email_tool.models import Customer, EmailBatch
+from email_tool.messaging.message import build_email
+from email_tool.messaging.render import BatchRenderer
+
+
+class Command(BaseCommand):
+    """Compares rendering a batch's emails one template render at a time
+    against the compiled `BatchRenderer`. Nothing is saved or sent.
+
+    Compiling the batch's template happens once per batch, and is timed on
+    its own with the compiled template evicted from the cache first.
+    """
+
+    help = "Benchmark email renders per second for an `EmailBatch`"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_token", type=str, help="The token of the EmailBatch to render.")
+        parser.add_argument("--recipients", type=int, default=500, help="The number of mock recipients to render.")
+
+    def handle(self, *args, **options):
+        try:
+            batch = EmailBatch.objects.get(pk=options["batch_token"])
+        except (EmailBatch.DoesNotExist, ValueError):
+            raise CommandError(f"EmailBatch '{options['batch_token']}' does not exist.")
+
+        email_messages = [
+            batch.create_email_message(
+                Customer(
+                    company=f"Mock Company {i}", first_name=f"John {i}", last_name="Smith", email=f"john{i}@smith.com"
+                )
+            )
+            for i in range(options["recipients"])
+        ]
+
+        start = perf_counter()
+        for email_message in email_messages:
+            build_email(email_message)
+        before = len(email_messages) / (perf_counter() - start)
+
+        cache.delete(BatchRenderer(batch)._cache_key(batch))
+        start = perf_counter()
+        renderer = BatchRenderer(batch)
+        compile_seconds = perf_counter() - start
+
+        start = perf_counter()
+        for email_message in email_messages:
+            renderer.build_email(email_message)
+        after = len(email_messages) / (perf_counter() - start)
+
+        self.stdout.write(f"Template render per recipient: {before:,.1f} renders/sec")
+        self.stdout.write(f"Compiled batch renderer:       {after:,.1f} renders/sec")
+        self.stdout.write(f"Compiling the batch template:  {compile_seconds * 1000:,.1f} ms, once per batch")
+        self.stdout.write("Speedup: " + self.style.SUCCESS(f"{after / before:.1f}x"))
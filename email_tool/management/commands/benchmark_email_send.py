@@ -0,0 +1,297 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+from contextlib import ExitStack, redirect_stdout
+from time import perf_counter
+from unittest import mock
+
+from django.contrib import admin
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from email_tool.admin import CustomerAdminModel
+from email_tool.models import (
+    Customer,
+    DeliveryEngine,
+    DeliveryState,
+    EmailBatch,
+    EmailBatchStatus,
+    EmailMessage,
+    ImageResource,
+)
+from email_tool.messaging.batch import claim_next_batch, send_email_batch
+from email_tool.messaging.message import DEFAULT_EMAIL_SENDER
+from email_tool.messaging.smtp_sink import SMTPSink
+
+SEND_PATHS = ["admin", "parallel", "async"]
+
+
+class QueryTimer:
+    """Execute wrapper that counts the queries of every db connection it is
+    installed on, and the time spent in them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            with self._lock:
+                self.queries += 1
+                self.seconds += perf_counter() - started
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class Command(BaseCommand):
+    """End to end benchmark of the mass email send paths against a local SMTP
+    sink server, in a throwaway test database seeded with mock Customers.
+
+    The send paths are:
+        `admin`: The admin "create new email batch" action followed by the
+            `process_email_queue` worker.
+        `parallel`: `send_email_batch` with a pool of `--workers` threads.
+        `async`: A batch using the `Async SMTP` delivery engine.
+
+    For each number of Customers and send path it reports messages per
+    second, db queries per message, the peak RSS of the process and the
+    time spent rendering, talking SMTP and in the ORM. Render and SMTP
+    times are summed over threads and sessions, so for the concurrent
+    paths they can add up to more than the wall clock time. Peak RSS is
+    the high water mark of the whole process, which is why the sizes are
+    run smallest first.
+
+    Write the results to a file with `--output` and compare a later run
+    against it with `--compare`, e.g. before and after a commit.
+
+    NOTE: The test database is created like `manage.py test` does, so the
+    db user needs permission to create databases.
+    """
+
+    help = "Benchmark sending mass email end to end against a local SMTP sink"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--customers", type=int, nargs="+", default=[1000], help="The numbers of Customers to send to."
+        )
+        parser.add_argument(
+            "--paths", nargs="+", choices=SEND_PATHS, default=SEND_PATHS, help="The send paths to run."
+        )
+        parser.add_argument("--workers", type=int, default=4, help="The number of workers of the `parallel` path.")
+        parser.add_argument("--output", type=str, help="Write the results as JSON to this file.")
+        parser.add_argument("--compare", type=str, help="A JSON results file of an earlier run to compare against.")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                with open(options["compare"]) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Can't read results to compare against: {e}")
+
+        old_database_name = connection.settings_dict["NAME"]
+        if connection.vendor == "sqlite":
+            # The worker threads need a database file, they can't reliably share an in-memory one.
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(tempfile.gettempdir(), "email_benchmark.sqlite3")
+        self.stdout.write("Creating the benchmark database...")
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        results = []
+        try:
+            with ExitStack() as stack:
+                sink = stack.enter_context(SMTPSink())
+                if options["verbosity"] < 2:
+                    # The send path prints a line per message.
+                    stack.enter_context(redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+                self._configure(stack, sink)
+                template = self._create_template_batch()
+                for size in sorted(options["customers"]):
+                    self._seed_customers(size)
+                    for path in options["paths"]:
+                        self.stdout.write(f"Sending to {size:,} Customers with the `{path}` path...")
+                        results.append(self._run(path, template, size, options))
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+        for result in results:
+            self._write_result(result)
+
+        report = {
+            "commit": _git_commit(),
+            "created_at": timezone.now().isoformat(),
+            "python": sys.version.split()[0],
+            "database": connection.vendor,
+            "workers": options["workers"],
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Results written to {options['output']}")
+        if baseline is not None:
+            self._compare(baseline, report)
+
+    def _configure(self, stack, sink):
+        """Points the SMTP backend at the sink and lifts the send rate limits."""
+        stack.enter_context(
+            override_settings(
+                EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+                EMAIL_HOST="127.0.0.1",
+                EMAIL_PORT=sink.port,
+                EMAIL_HOST_USER="",
+                EMAIL_HOST_PASSWORD="",
+                EMAIL_USE_TLS=False,
+                EMAIL_USE_SSL=False,
+                EMAIL_SEND_RATE_PER_MINUTE=10 ** 9,
+                EMAIL_SEND_RATE_PER_DAY=10 ** 9,
+                EMAIL_SEND_RATE_BURST=10 ** 9,
+            )
+        )
+        if not DEFAULT_EMAIL_SENDER:
+            # Without EMAIL_USER the sender address is empty, which no SMTP server accepts.
+            for module in ("email_tool.messaging.message", "email_tool.messaging.render"):
+                stack.enter_context(mock.patch(f"{module}.FROM_ADDRESS", "Benchmark <benchmark@example.com>"))
+
+    def _create_template_batch(self):
+        image = ImageResource.objects.create(description="Benchmark", image="email_images/benchmark.png")
+        return EmailBatch.objects.create(
+            batch_title="Benchmark",
+            subject="Benchmark",
+            title="Benchmark",
+            custom_message="This is a benchmark.",
+            call_to_action_button_text="Read more",
+            call_to_action_button_link="https://example.com",
+            company_logo=image,
+            primary_image=image,
+            status=EmailBatchStatus.COMPLETED,
+        )
+
+    def _seed_customers(self, size):
+        existing = Customer.objects.count()
+        Customer.objects.bulk_create(
+            [
+                Customer(
+                    company=f"Mock Company {i}",
+                    first_name=f"John {i}",
+                    last_name="Smith",
+                    email=f"john{i}@example.com",
+                )
+                for i in range(existing, size)
+            ]
+        )
+
+    def _run(self, path, template, size, options):
+        timer = QueryTimer()
+        connection_created.connect(timer.install)
+        connection.execute_wrappers.append(timer)
+        started = perf_counter()
+        try:
+            batch, stats = getattr(self, f"_send_{path}")(template, size, options)
+        finally:
+            elapsed = perf_counter() - started
+            connection.execute_wrappers.remove(timer)
+            connection_created.disconnect(timer.install)
+
+        messages = batch.email_messages.exclude(delivery_state=DeliveryState.SUPPRESSED).count()
+        return {
+            "path": path,
+            "customers": size,
+            "messages": messages,
+            "sent": stats.sent,
+            "failed": stats.failed,
+            "retrying": stats.retrying,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(stats.sent / elapsed, 1),
+            "queries": timer.queries,
+            "queries_per_message": round(timer.queries / max(messages, 1), 2),
+            "peak_rss_mb": round(_peak_rss_mb(), 1),
+            "time": {
+                "render": round(stats.render_seconds, 3),
+                "smtp": round(stats.smtp_seconds, 3),
+                "orm": round(timer.seconds, 3),
+            },
+            "latency_ms": {
+                "p50": round((stats.percentile(50) or 0) * 1000, 2),
+                "p95": round((stats.percentile(95) or 0) * 1000, 2),
+            },
+        }
+
+    def _send_admin(self, template, size, options):
+        request = RequestFactory().post("/", {"apply": "Send", "batch_title": f"Benchmark admin {size}"})
+        request._messages = CookieStorage(request)
+        CustomerAdminModel(Customer, admin.site)._execute_mass_email(request, Customer.objects.all(), template)
+
+        batch = claim_next_batch()
+        return batch, send_email_batch(batch)
+
+    def _send_parallel(self, template, size, options):
+        batch = self._clone(template, f"Benchmark parallel {size}")
+        return batch, send_email_batch(batch, workers=options["workers"])
+
+    def _send_async(self, template, size, options):
+        batch = self._clone(template, f"Benchmark async {size}", delivery_engine=DeliveryEngine.ASYNC_SMTP)
+        return batch, send_email_batch(batch)
+
+    def _clone(self, template, batch_title, **fields):
+        batch = template.clone(batch_title)
+        batch.status, batch.claimed_at = EmailBatchStatus.SENDING, timezone.now()
+        for name, value in fields.items():
+            setattr(batch, name, value)
+        batch.save()
+        batch.add_recipients(Customer.objects.all())
+        return batch
+
+    def _write_result(self, result):
+        time_spent = result["time"]
+        self.stdout.write(
+            "[" + self.style.SUCCESS(result["path"]) + "] "
+            f"{result['customers']:,} customers: {result['messages_per_second']:,.1f} messages/sec, "
+            f"{result['queries_per_message']} queries/message, peak RSS {result['peak_rss_mb']:,.1f} MB, "
+            f"render {time_spent['render']:.2f}s, SMTP {time_spent['smtp']:.2f}s, ORM {time_spent['orm']:.2f}s "
+            f"({result['sent']:,} sent, {result['failed']:,} failed)"
+        )
+
+    def _compare(self, baseline, report):
+        self.stdout.write(f"Compared to {baseline.get('commit') or 'the baseline'}:")
+        previous = {(result["path"], result["customers"]): result for result in baseline.get("results", [])}
+        for result in report["results"]:
+            before = previous.get((result["path"], result["customers"]))
+            if before is None:
+                continue
+            change = (result["messages_per_second"] / max(before["messages_per_second"], 0.1) - 1) * 100
+            style = self.style.SUCCESS if change >= 0 else self.style.ERROR
+            self.stdout.write(
+                f"  {result['path']} {result['customers']:,}: "
+                f"{before['messages_per_second']:,.1f} -> {result['messages_per_second']:,.1f} messages/sec "
+                + style(f"({change:+.1f}%)")
+                + f", {before['queries_per_message']} -> {result['queries_per_message']} queries/message"
+            )
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return result.stdout.decode().strip() or None
@@ -0,0 +1,106 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Lower, Trim
+
+from email_tool.models import Customer, DeliveryState, EmailBatch, EmailMessage, Suppression, SuppressionReason
+from email_tool.messaging.bounces import iter_mailbox, parse_dsn
+
+
+class Command(BaseCommand):
+    """Reads the delivery status notifications (bounces) from a maildir or
+    mbox and puts the addresses that hard bounced on the suppression list,
+    so later batches skip them.
+
+    The mailbox is read one message at a time, and the bounces are written
+    every `--chunk-size` addresses: the EmailMessages that bounced are
+    marked `Bounced` with one UPDATE (and no longer count as sent on their
+    batch), and the addresses are suppressed with one INSERT, linked to the
+    Customer using them. Temporary failures and delays are ignored, the send
+    retries handle those. Processing the same mailbox again doesn't change
+    anything.
+
+    Usage:
+        python manage.py process_bounces /var/mail/bounces
+        python manage.py process_bounces bounces.mbox --dry-run
+    """
+
+    help = "Suppress the email addresses that hard bounced, from a maildir or mbox of bounces"
+
+    def add_arguments(self, parser):
+        parser.add_argument("mailbox", type=str, help="The path of a maildir directory or an mbox file.")
+        parser.add_argument(
+            "--chunk-size", type=int, default=500, help="The number of bounced addresses written at a time."
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Report the bounces without saving anything.")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        read = bounced = 0
+        chunk = {}
+        written = []
+        try:
+            for message in iter_mailbox(options["mailbox"]):
+                read += 1
+                for bounce in parse_dsn(message):
+                    bounced += 1
+                    chunk.setdefault(bounce.recipient, []).append(bounce)
+                if len(chunk) >= options["chunk_size"]:
+                    written.append(self._write(chunk, options["dry_run"]))
+                    chunk = {}
+        except FileNotFoundError as e:
+            raise CommandError(str(e))
+        if chunk:
+            written.append(self._write(chunk, options["dry_run"]))
+        marked = sum(count for count, _ in written)
+        suppressed = sum(count for _, count in written)
+
+        self.stdout.write(
+            "[" + self.style.SUCCESS("Success") + "] "
+            f"{read} message(s) read, {bounced} hard bounce(s), {marked} email(s) marked bounced, "
+            f"{suppressed} address(es) added to the suppression list" + (" (dry run)" if options["dry_run"] else "")
+        )
+
+    def _write(self, bounces, dry_run):
+        """Saves a chunk of `{address: [Bounce]}` and returns how many
+        EmailMessages were marked and addresses suppressed.
+        """
+        emails = set(bounces)
+        message_tokens = {
+            bounce.message_token for found in bounces.values() for bounce in found if bounce.message_token
+        }
+        new_emails = emails - set(Suppression.objects.filter(email__in=emails).values_list("email", flat=True))
+        bounced = EmailMessage.objects.filter(pk__in=message_tokens).exclude(delivery_state=DeliveryState.BOUNCED)
+        if dry_run:
+            return bounced.count(), len(new_emails)
+
+        customer_ids = dict(
+            Customer.objects.annotate(normalized_email=Lower(Trim("email")))
+            .filter(normalized_email__in=new_emails)
+            .values_list("normalized_email", "pk")
+        )
+        with transaction.atomic():
+            # They no longer count as sent on their batches and Customers.
+            sent = list(bounced.filter(send_succeeded=True).values_list("batch_id", "customer_id"))
+            marked = bounced.update(delivery_state=DeliveryState.BOUNCED, send_succeeded=False)
+            for batch_id, count in Counter(batch_id for batch_id, _ in sent if batch_id is not None).items():
+                EmailBatch.objects.filter(pk=batch_id).update(emails_sent=F("emails_sent") - count)
+            sent_per_customer = Counter(customer_id for _, customer_id in sent)
+            for count in set(sent_per_customer.values()):
+                Customer.objects.filter(pk__in=[pk for pk, n in sent_per_customer.items() if n == count]).update(
+                    emails_sent_count=F("emails_sent_count") - count
+                )
+
+            Suppression.objects.bulk_create(
+                [
+                    Suppression(email=email, customer_id=customer_ids.get(email), reason=SuppressionReason.BOUNCED)
+                    for email in new_emails
+                ],
+                ignore_conflicts=True,
+            )
+            Suppression.refresh_customers(new_emails, customer_ids.values())
+        return marked, len(new_emails)
@@ -0,0 +1,81 @@
+import signal
+import sys
+import traceback
+from datetime import timedelta
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from email_tool.messaging.batch import BatchLeaseLost, claim_next_batch, requeue_batch, send_email_batch
+
+# How long a batch that failed with an unexpected error waits before it is sent again.
+FAILED_BATCH_RETRY_DELAY = timedelta(minutes=5)
+
+
+class Command(BaseCommand):
+    """Worker process that sends the mass email batches queued from the admin.
+
+    An error sending one batch is logged and the batch goes back to the
+    queue, the worker carries on with the next one. If the worker is
+    stopped, e.g. by a restart, the batch it was sending goes back to the
+    queue too. If it is killed outright the batch is claimed again once its
+    lease expires, see `messaging.batch.BatchLease`.
+
+    RUN THIS AS A LONG LIVED WORKER PROCESS! (see the `worker` entry in the Procfile)
+    """
+
+    help = "Send queued `EmailBatch` objects in the background"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Send every queued batch and then exit.")
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=5.0,
+            help="Seconds to wait before checking an empty queue again.",
+        )
+
+    def handle(self, *args, **options):
+        # Heroku stops dynos with SIGTERM. Exiting with SystemExit instead
+        # runs the cleanup of the send path, which puts the messages that
+        # weren't tried yet back in the queue.
+        previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self._process_queue(options)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+    def _process_queue(self, options):
+        while True:
+            batch = claim_next_batch()
+
+            if batch is None:
+                if options["once"]:
+                    return
+                sleep(options["poll_interval"])
+                continue
+
+            self.stdout.write(f"Sending {batch}...")
+            try:
+                stats = send_email_batch(batch)
+            except BatchLeaseLost as e:
+                self.stderr.write("[" + self.style.ERROR("Error") + "] " f"Stopped sending {batch}: {e}")
+                continue
+            except (KeyboardInterrupt, SystemExit):
+                requeue_batch(batch)
+                raise
+            except Exception:
+                self.stderr.write(
+                    "[" + self.style.ERROR("Error") + "] " f"Sending {batch} FAILED:\n{traceback.format_exc()}"
+                )
+                requeue_batch(batch, timezone.now() + FAILED_BATCH_RETRY_DELAY)
+                continue
+
+            batch.refresh_from_db()
+            self.stdout.write(
+                "[" + self.style.SUCCESS("Success") + "] "
+                f"{batch}: {batch.emails_initiated} initiated, {batch.emails_skipped} skipped, "
+                f"{stats.connections_opened} SMTP connection(s) opened, "
+                f"{stats.connection_reuses} sends reused an open connection"
+            )
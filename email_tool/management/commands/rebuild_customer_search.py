@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from email_tool.models import Customer
+from email_tool.search import SQLITE_SEARCH_TABLE, build_search_document, index_customers
+
+
+class Command(BaseCommand):
+    """Rebuilds the search documents of all the Customers, see
+    `email_tool.search`.
+
+    They are kept up to date when a Customer is saved, so this is only
+    needed after Customers were changed without saving them, e.g. with
+    `QuerySet.update()` or `bulk_create()`.
+    """
+
+    help = "Rebuild the search documents of the Customers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=500, help="The number of Customers rebuilt at a time.")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+
+        rebuilt = 0
+        with transaction.atomic():
+            if connection.vendor == "sqlite":
+                with connection.cursor() as cursor:
+                    cursor.execute(f"DELETE FROM {SQLITE_SEARCH_TABLE}")
+
+            chunk = []
+            for customer in Customer.objects.order_by("pk").iterator(chunk_size=options["chunk_size"]):
+                customer.search_document = build_search_document(customer)
+                chunk.append(customer)
+                if len(chunk) >= options["chunk_size"]:
+                    rebuilt += self._save(chunk)
+                    chunk = []
+            rebuilt += self._save(chunk)
+
+        self.stdout.write("[" + self.style.SUCCESS("Success") + "] " f"{rebuilt} Customer(s) rebuilt")
+
+    def _save(self, customers):
+        Customer.objects.bulk_update(customers, ["search_document"])
+        index_customers(customers)
+        return len(customers)
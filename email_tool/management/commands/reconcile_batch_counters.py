@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from email_tool.models import EmailBatch, count_batch_emails
+
+
+class Command(BaseCommand):
+    """Recomputes the `emails_sent` and `unsubscribe_count` counters of
+    every `EmailBatch` from its EmailMessages, with one grouped query, and
+    saves the batches whose counters drifted.
+
+    The counters are updated as the emails change state, so this is only
+    needed after the EmailMessages were changed some other way, e.g. by hand
+    in the db.
+
+    Usage:
+        python manage.py reconcile_batch_counters
+        python manage.py reconcile_batch_counters --dry-run
+    """
+
+    help = "Recompute the sent and unsubscribe counters of the email batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Report the drifted batches without saving them.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            batches = list(
+                EmailBatch.objects.select_for_update().only("batch_title", "emails_sent", "unsubscribe_count")
+            )
+            counters = count_batch_emails()
+            drifted = []
+            for batch in batches:
+                sent, unsubscribed = counters.get(batch.pk, (0, 0))
+                if (batch.emails_sent, batch.unsubscribe_count) == (sent, unsubscribed):
+                    continue
+                self.stdout.write(
+                    f"{batch}: {batch.emails_sent} -> {sent} sent, "
+                    f"{batch.unsubscribe_count} -> {unsubscribed} unsubscribed"
+                )
+                batch.emails_sent, batch.unsubscribe_count = sent, unsubscribed
+                drifted.append(batch)
+            if not options["dry_run"]:
+                EmailBatch.objects.bulk_update(drifted, ["emails_sent", "unsubscribe_count"], batch_size=500)
+
+        self.stdout.write(
+            "[" + self.style.SUCCESS("Success") + "] "
+            f"{len(drifted)} batch(es) reconciled" + (" (dry run)" if options["dry_run"] else "")
+        )
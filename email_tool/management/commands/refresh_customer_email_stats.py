@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Max
+from django.db.models.functions import Coalesce
+
+from email_tool.models import Customer, EmailMessage, Suppression, normalize_email
+
+
+class Command(BaseCommand):
+    """Recomputes the `last_emailed_at`, `emails_sent_count` and `is_dnc`
+    columns of every Customer and saves the Customers whose values are
+    out of date.
+
+    The emails sent are counted with one grouped query over the
+    EmailMessages, and the suppression list is loaded once. The columns
+    are updated as emails are sent and addresses suppressed, so this is
+    needed once to fill them in, and after Customers' email addresses or
+    the EmailMessages were changed some other way, e.g. by an import.
+
+    Usage:
+        python manage.py refresh_customer_email_stats
+        python manage.py refresh_customer_email_stats --dry-run
+    """
+
+    help = "Recompute the last emailed, emails sent and do not contact columns of the Customers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size", type=int, default=500, help="The number of Customers saved with each UPDATE."
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Report the changes without saving them.")
+
+    def handle(self, *args, **options):
+        sent = {
+            customer_id: (last_emailed_at, count)
+            for customer_id, last_emailed_at, count in EmailMessage.objects.filter(send_succeeded=True)
+            .values_list("customer_id")
+            .annotate(last_emailed_at=Max(Coalesce("last_attempt_at", "created_at")), count=Count("pk"))
+            .order_by()
+        }
+        suppressed_emails, suppressed_ids = set(), set()
+        for email, customer_id in Suppression.objects.values_list("email", "customer_id").iterator():
+            suppressed_emails.add(email)
+            suppressed_ids.add(customer_id)
+
+        changed = []
+        customers = Customer.objects.values_list("pk", "email", "last_emailed_at", "emails_sent_count", "is_dnc")
+        for pk, email, *current in customers.iterator():
+            last_emailed_at, count = sent.get(pk, (None, 0))
+            is_dnc = pk in suppressed_ids or normalize_email(email) in suppressed_emails
+            if current != [last_emailed_at, count, is_dnc]:
+                changed.append(
+                    Customer(pk=pk, last_emailed_at=last_emailed_at, emails_sent_count=count, is_dnc=is_dnc)
+                )
+
+        if not options["dry_run"]:
+            Customer.objects.bulk_update(
+                changed, ["last_emailed_at", "emails_sent_count", "is_dnc"], batch_size=options["chunk_size"]
+            )
+
+        self.stdout.write(
+            "[" + self.style.SUCCESS("Success") + "] "
+            f"{len(changed)} Customer(s) refreshed" + (" (dry run)" if options["dry_run"] else "")
+        )
@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from email_tool.models import EmailBatch, EmailBatchStatus
+from email_tool.messaging.batch import BATCH_LEASE, claim_batch, release_in_flight, send_email_batch
+
+
+class Command(BaseCommand):
+    """Restarts an `EmailBatch` that was interrupted, e.g. by a crash or a
+    deploy, from where it stopped. Messages that were already sent or
+    failed are never sent again.
+
+    Messages left in the `Sending` state were being sent when the batch
+    stopped, so they may have been delivered. By default they are marked
+    `Failed`, pass `--resend-in-flight` to send them again instead.
+
+    A batch that is still being sent by a worker isn't touched. A `Sending`
+    batch can only be resumed once its worker's claim on it expired, see
+    `messaging.batch.BatchLease`.
+    """
+
+    help = "Resume sending an interrupted `EmailBatch`"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_token", type=str, help="The token of the EmailBatch to resume.")
+        parser.add_argument(
+            "--resend-in-flight",
+            action="store_true",
+            help="Send the messages that were in flight when the batch stopped again.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            batch = EmailBatch.objects.get(pk=options["batch_token"])
+        except (EmailBatch.DoesNotExist, ValueError):
+            raise CommandError(f"EmailBatch '{options['batch_token']}' does not exist.")
+
+        # Claimed like the queue worker does, only if nobody is sending it.
+        batch = claim_batch(batch.pk, statuses=[EmailBatchStatus.QUEUED, EmailBatchStatus.COMPLETED])
+        if batch is None:
+            raise CommandError(
+                f"{options['batch_token']} is being sent by a worker. If the worker died, "
+                f"it can be resumed {BATCH_LEASE.total_seconds() / 60:.0f} minutes after its last progress."
+            )
+
+        in_flight_count = release_in_flight(batch, resend=options["resend_in_flight"])
+        if in_flight_count:
+            self.stdout.write(f"{in_flight_count} message(s) were in flight when the batch stopped.")
+
+        self.stdout.write(f"Resuming {batch}...")
+        send_email_batch(batch)
+
+        batch.refresh_from_db()
+        self.stdout.write(
+            "[" + self.style.SUCCESS("Success") + "] "
+            f"{batch}: {batch.emails_initiated} initiated, {batch.emails_skipped} skipped"
+        )
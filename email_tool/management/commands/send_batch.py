@@ -0,0 +1,93 @@
+from django.core.exceptions import FieldError, ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from email_tool.models import Customer, CustomerSegment, EmailBatch, EmailBatchStatus
+from email_tool.messaging.batch import claim_batch, release_in_flight, send_email_batch
+
+
+class Command(BaseCommand):
+    """Sends an `EmailBatch` right away with a pool of worker threads, each
+    holding its own SMTP connection, instead of waiting for the queue worker.
+
+    The Customers of the `--segment` and those matching the `--filter`
+    options that aren't recipients of the batch yet are added to it first. The workers then take turns
+    claiming the next page of due messages, so nobody gets the email twice.
+
+    Usage:
+        python manage.py send_batch <batch_token> --workers 4 \\
+            --filter relationship_type=Prospect --filter state__in=NY,NJ
+        python manage.py send_batch <batch_token> --segment "NY prospects"
+    """
+
+    help = "Send an `EmailBatch` with a pool of parallel workers"
+
+    def add_arguments(self, parser):
+        parser.add_argument("batch_token", type=str, help="The token of the EmailBatch to send.")
+        parser.add_argument(
+            "--filter",
+            action="append",
+            default=[],
+            metavar="LOOKUP=VALUE",
+            help="Customer field lookup of the recipients to add, can be repeated. "
+            "Values of `__in` lookups are comma separated.",
+        )
+        parser.add_argument("--segment", type=str, help="The name of a Customer segment to add as recipients.")
+        parser.add_argument("--workers", type=int, default=4, help="The number of messages sent in parallel.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1.")
+
+        try:
+            batch = EmailBatch.objects.get(pk=options["batch_token"])
+        except (EmailBatch.DoesNotExist, ValidationError, ValueError):
+            raise CommandError(f"EmailBatch '{options['batch_token']}' does not exist.")
+
+        if options["segment"]:
+            try:
+                segment = CustomerSegment.objects.get(name=options["segment"])
+            except CustomerSegment.DoesNotExist:
+                raise CommandError(f"Customer segment '{options['segment']}' does not exist.")
+            batch.add_recipients(segment.customers())
+            if batch.segment_id is None:
+                batch.segment = segment
+                batch.save(update_fields=["segment"])
+
+        if options["filter"]:
+            try:
+                batch.add_recipients(Customer.objects.filter(**self._parse_filters(options["filter"])))
+            except (FieldError, ValidationError, ValueError) as e:
+                raise CommandError(f"Invalid customer filter: {e}")
+
+        # Claimed like the queue worker does, so it won't send the batch at the same time.
+        batch = claim_batch(batch.pk, statuses=[EmailBatchStatus.QUEUED, EmailBatchStatus.COMPLETED])
+        if batch is None:
+            raise CommandError(f"{options['batch_token']} is already being sent.")
+        release_in_flight(batch)
+
+        self.stdout.write(f"Sending {batch} with {options['workers']} worker(s)...")
+        stats = send_email_batch(batch, workers=options["workers"])
+
+        self.stdout.write(
+            "[" + self.style.SUCCESS("Success") + "] "
+            f"{batch}: {stats.sent} sent, {stats.failed} failed, {stats.retrying} waiting for a retry "
+            f"in {stats.elapsed:.1f}s ({stats.throughput:.1f} messages/sec)"
+        )
+        if stats.latencies:
+            self.stdout.write(
+                f"Latency per message: p50 {stats.percentile(50) * 1000:.0f} ms, "
+                f"p95 {stats.percentile(95) * 1000:.0f} ms"
+            )
+        self.stdout.write(
+            f"{stats.connections_opened} SMTP connection(s) opened, "
+            f"{stats.connection_reuses} sends reused an open connection"
+        )
+
+    def _parse_filters(self, filters):
+        lookups = {}
+        for item in filters:
+            lookup, separator, value = item.partition("=")
+            if not separator or not lookup:
+                raise CommandError(f"Invalid customer filter '{item}', expected LOOKUP=VALUE.")
+            lookups[lookup] = value.split(",") if lookup.endswith("__in") else value
+        return lookups
@@ -0,0 +1,203 @@
+""" Asyncio SMTP delivery engine for large email batches. """
+
+### Python imports ###
+import asyncio
+import smtplib
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+### Django imports ###
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.message import sanitize_address
+from django.db import connections
+
+### Third Party imports ###
+import aiosmtplib
+
+# The outcome of sending one message, `seconds` is how long the send took.
+SendResult = namedtuple("SendResult", ["sent", "error", "seconds"])
+
+
+def as_smtplib_error(error):
+    """Returns the `smtplib` equivalent of an `aiosmtplib` error, so failed
+    sends are classified the same way whichever engine sent them.
+    """
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return smtplib.SMTPRecipientsRefused({e.recipient: (e.code, e.message) for e in error.recipients})
+    if isinstance(error, aiosmtplib.SMTPResponseException):
+        return smtplib.SMTPResponseException(error.code, error.message)
+    if isinstance(error, (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError)):
+        return smtplib.SMTPServerDisconnected(str(error))
+    return error
+
+
+class AsyncSMTPBackend(BaseEmailBackend):
+    """Email backend that sends over `sessions` concurrent SMTP sessions
+    from one asyncio event loop, instead of a thread per connection.
+
+    The messages are put on a queue that holds at most `queue_size` of
+    them and each session takes the next one as soon as its last send is
+    done, so a session stays busy and open for the whole run. When the
+    sessions fall behind, queuing more messages waits for room.
+
+    It is a regular Django email backend, so it can be passed as the
+    `connection` of `mail_templated.send_mail()`. `send_all()` returns the
+    result of each message instead of raising. Errors are converted to
+    their `smtplib` equivalents, see `as_smtplib_error()`.
+
+    Usage:
+        backend = AsyncSMTPBackend(sessions=8)
+        send_mail("email/simple.html", context, FROM_ADDRESS, [email], connection=backend)
+    """
+
+    def __init__(
+        self,
+        host=None,
+        port=None,
+        username=None,
+        password=None,
+        use_tls=None,
+        use_ssl=None,
+        timeout=None,
+        sessions=None,
+        queue_size=None,
+        max_reconnects=3,
+        fail_silently=False,
+        **kwargs,
+    ):
+        super().__init__(fail_silently=fail_silently)
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        self.username = settings.EMAIL_HOST_USER if username is None else username
+        self.password = settings.EMAIL_HOST_PASSWORD if password is None else password
+        self.use_tls = settings.EMAIL_USE_TLS if use_tls is None else use_tls
+        self.use_ssl = settings.EMAIL_USE_SSL if use_ssl is None else use_ssl
+        self.timeout = settings.EMAIL_TIMEOUT if timeout is None else timeout
+        self.sessions = sessions or settings.EMAIL_ASYNC_SESSIONS
+        self.queue_size = queue_size or settings.EMAIL_ASYNC_QUEUE_SIZE
+        self.max_reconnects = max_reconnects
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    @property
+    def reuse_count(self):
+        """The number of messages that were sent over an already open connection."""
+        return max(self.messages_sent - self.connections_opened, 0)
+
+    def send_messages(self, email_messages):
+        """Sends `email_messages` and returns how many were sent. Unless
+        `fail_silently`, the first error is raised after everything else
+        was sent.
+        """
+        results = self.send_all(email_messages)
+        errors = [result.error for result in results if result.error is not None]
+        if errors and not self.fail_silently:
+            raise errors[0]
+        return sum(1 for result in results if result.sent)
+
+    def send_all(self, email_messages, before_send=None):
+        """Sends `email_messages` and returns a `SendResult` for each of
+        them, in the same order.
+
+        Arguments:
+            `email_messages`: The Django `EmailMessage`s to send.
+            `before_send`: (Optional) A blocking callable that is called
+                before each message is queued, e.g. to wait for the send
+                rate budget. It runs outside of the event loop. If it
+                returns `False` nothing more is queued, and the messages
+                that weren't get `None` instead of a result.
+        """
+        email_messages = list(email_messages)
+        if not email_messages:
+            return []
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._send_all(email_messages, before_send))
+        finally:
+            loop.close()
+
+    async def _send_all(self, email_messages, before_send):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        results = [None] * len(email_messages)
+        sessions = [
+            loop.create_task(self._session(queue, results)) for _ in range(min(self.sessions, len(email_messages)))
+        ]
+
+        # `before_send` may query the db, which Django doesn't allow from
+        # the event loop, so it runs on a thread of its own.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                for index, email in enumerate(email_messages):
+                    if before_send is not None and await loop.run_in_executor(executor, before_send) is False:
+                        break
+                    await queue.put((index, email))
+            finally:
+                for _ in sessions:
+                    await queue.put(None)
+                await asyncio.gather(*sessions)
+                await loop.run_in_executor(executor, connections.close_all)
+        return results
+
+    async def _session(self, queue, results):
+        """Sends the messages taken from `queue` over one SMTP session until
+        it gets `None`.
+        """
+        smtp = aiosmtplib.SMTP(
+            hostname=self.host,
+            port=self.port,
+            username=self.username or None,
+            password=self.password or None,
+            use_tls=self.use_ssl,
+            start_tls=self.use_tls,
+            timeout=self.timeout,
+        )
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                index, email = item
+                started = time.perf_counter()
+                try:
+                    sent, error = await self._send(smtp, email), None
+                except Exception as e:
+                    sent, error = False, as_smtplib_error(e)
+                results[index] = SendResult(sent, error, time.perf_counter() - started)
+        finally:
+            if smtp.is_connected:
+                try:
+                    await smtp.quit()
+                except (aiosmtplib.SMTPException, OSError):
+                    smtp.close()
+
+    async def _send(self, smtp, email):
+        """Sends `email` over `smtp`, connecting first if the session isn't
+        open, and returns if it was sent.
+        """
+        encoding = email.encoding or settings.DEFAULT_CHARSET
+        recipients = [sanitize_address(address, encoding) for address in email.recipients()]
+        if not recipients:
+            return False
+        from_email = sanitize_address(email.from_email, encoding)
+        message = email.message().as_bytes(linesep="\r\n")
+
+        reconnects = 0
+        while True:
+            if not smtp.is_connected:
+                await smtp.connect()
+                self.connections_opened += 1
+            try:
+                await smtp.sendmail(from_email, recipients, message)
+                break
+            except aiosmtplib.SMTPServerDisconnected:
+                if reconnects >= self.max_reconnects:
+                    raise
+                reconnects += 1
+                smtp.close()
+
+        self.messages_sent += 1
+        return True
@@ -0,0 +1,593 @@
+""" Background delivery of queued mass email batches. """
+
+### Python imports ###
+import math
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import islice
+from smtplib import SMTPException
+
+### Django imports ###
+from django.db import connections
+from django.db.models import F, Min, Q
+from django.utils import timezone
+
+### User-defined imports ###
+from email_tool.models import Customer, DeliveryEngine, DeliveryState, EmailBatch, EmailBatchStatus, EmailMessage
+from email_tool.messaging.async_smtp import AsyncSMTPBackend
+from email_tool.messaging.connection import BatchConnection
+from email_tool.messaging.render import BatchRenderer
+from email_tool.messaging.retry import RELAY_RETRY_DELAY, SendDeferred, is_transient, next_attempt_at
+from email_tool.messaging.suppression import SuppressionList
+from email_tool.messaging.throttle import SendRateLimiter, throttle_code
+
+# The number of messages sent between writing results back to the db,
+# i.e. how often a batch checkpoints its progress.
+SEND_CHUNK_SIZE = 200
+
+# The EmailMessage columns the send path uses. The Customer columns are
+# the ones the template reads, see `BatchRenderer.customer_columns`.
+# `batch` is read for every row fetched through `batch.email_messages`.
+SEND_FIELDS = [
+    "batch",
+    "customer",
+    "template_file",
+    "delivery_state",
+    "attempts",
+    "next_attempt_at",
+    "last_error",
+    "send_succeeded",
+]
+
+# Latencies kept for the percentiles of a run, a uniform sample once
+# more messages than this were sent.
+MAX_LATENCY_SAMPLES = 10000
+
+# A worker renews its claim on the batch it is sending at most this often,
+# in seconds, see `BatchLease`.
+LEASE_RENEW_INTERVAL = 60
+
+# A `Sending` batch whose claim wasn't renewed for this long was abandoned,
+# e.g. its worker was killed, and is claimed again.
+BATCH_LEASE = timedelta(minutes=15)
+
+
+class BatchLeaseLost(Exception):
+    """Raised when another worker claimed the batch being sent, as its
+    lease had expired.
+    """
+
+
+def claim_next_batch():
+    """Moves the oldest queued EmailBatch to `Sending` and returns it.
+
+    A batch left `Sending` by a worker that died is claimed again once its
+    lease expired, and its messages that were in flight are settled, see
+    `release_in_flight()`. Returns `None` when nothing is queued, or all
+    queued batches are waiting for retries that aren't due yet.
+    """
+    claimable = EmailBatch.objects.filter(
+        (Q(status=EmailBatchStatus.QUEUED) & _due()) | _lease_expired(timezone.now())
+    ).order_by("created_at")
+    for batch_token in claimable.values_list("token", flat=True):
+        batch = claim_batch(batch_token)
+        if batch is not None:
+            release_in_flight(batch)
+            return batch
+    return None
+
+
+def claim_batch(batch_token, statuses=(EmailBatchStatus.QUEUED,)):
+    """Moves the EmailBatch `batch_token` to `Sending` if it is in one of
+    `statuses`, or is `Sending` but was abandoned, and returns it. Returns
+    `None` if it is being sent by another worker.
+
+    The status change is a conditional UPDATE, so if several workers try
+    to claim the same batch only one of them gets it.
+    """
+    now = timezone.now()
+    claimed = EmailBatch.objects.filter(Q(status__in=statuses) | _lease_expired(now), pk=batch_token).update(
+        status=EmailBatchStatus.SENDING, claimed_at=now
+    )
+    return EmailBatch.objects.get(pk=batch_token) if claimed else None
+
+
+def release_in_flight(batch, resend=False):
+    """Settles the messages of `batch` that an interrupted send left
+    `Sending` and returns how many there were. They may have been
+    delivered, so they are marked `Failed`, unless `resend`.
+    """
+    in_flight = batch.email_messages.filter(delivery_state=DeliveryState.SENDING)
+    if resend:
+        return in_flight.update(delivery_state=DeliveryState.QUEUED, next_attempt_at=None)
+    return in_flight.update(
+        delivery_state=DeliveryState.FAILED, last_error="The send was interrupted, it may have been delivered."
+    )
+
+
+def requeue_batch(batch, retry_at=None):
+    """Puts `batch` back in the queue after sending it stopped early, to be
+    sent again from `retry_at`. Does nothing if another worker claimed it
+    in the meantime.
+    """
+    EmailBatch.objects.filter(pk=batch.pk, status=EmailBatchStatus.SENDING, claimed_at=batch.claimed_at).update(
+        status=EmailBatchStatus.QUEUED, next_attempt_at=retry_at
+    )
+
+
+class BatchLease:
+    """The claim of a worker on the batch it is sending.
+
+    The claim is renewed as the batch is sent, at most every
+    `LEASE_RENEW_INTERVAL` seconds, so a batch whose worker died can be
+    told apart from one that is still being sent. Use `sleep()` to wait
+    without letting the lease expire. Both raise `BatchLeaseLost` if
+    another worker claimed the batch in the meantime.
+    """
+
+    def __init__(self, batch):
+        self.batch = batch
+        self._lock = threading.Lock()
+        self._renewed = time.monotonic()
+
+    def renew(self):
+        with self._lock:
+            if time.monotonic() - self._renewed < LEASE_RENEW_INTERVAL:
+                return
+            now = timezone.now()
+            renewed = EmailBatch.objects.filter(pk=self.batch.pk, claimed_at=self.batch.claimed_at).update(
+                claimed_at=now
+            )
+            if not renewed:
+                raise BatchLeaseLost(f"{self.batch} was claimed by another worker.")
+            self.batch.claimed_at = now
+            self._renewed = time.monotonic()
+
+    def sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, LEASE_RENEW_INTERVAL))
+            self.renew()
+
+
+def prepare_email_batch(batch: EmailBatch):
+    """Creates the EmailMessages of the recipients of `batch` that don't
+    have one yet, all in the `Queued` state except recipients on the
+    suppression list, which are `Suppressed`.
+
+    The recipients are streamed from the db a chunk at a time, loading only
+    the columns needed, and each chunk is created with `bulk_create` (which
+    also skips the post_save signal and auditlog). Preparing a batch again
+    after it was interrupted only creates the missing messages.
+    """
+    suppressed = SuppressionList.load()
+    recipients = (
+        batch.recipients.exclude(emailmessage__batch=batch).only("id", "email").iterator(chunk_size=SEND_CHUNK_SIZE)
+    )
+
+    skipped = 0
+    while True:
+        email_messages = []
+        for customer in islice(recipients, SEND_CHUNK_SIZE):
+            email_message = batch.create_email_message(customer)
+            if customer in suppressed:
+                email_message.delivery_state, email_message.send_succeeded = DeliveryState.SUPPRESSED, False
+                skipped += 1
+            email_messages.append(email_message)
+        if not email_messages:
+            break
+        EmailMessage.objects.bulk_create(email_messages)
+
+    EmailBatch.objects.filter(pk=batch.pk).update(emails_skipped=F("emails_skipped") + skipped)
+
+
+class BatchSendStats:
+    """Counts and per message latencies collected while sending a batch.
+    Safe to share between the threads of a parallel send.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.latencies = []
+        self.attempted = 0
+        self.sent = 0
+        self.failed = 0
+        self.retrying = 0
+        self.connections_opened = 0
+        self.connection_reuses = 0
+        self.render_seconds = 0.0
+        self.smtp_seconds = 0.0
+
+    def add_time(self, render=0.0, smtp=0.0):
+        """Adds time spent rendering emails and talking to the relay."""
+        with self._lock:
+            self.render_seconds += render
+            self.smtp_seconds += smtp
+
+    def record(self, email_message, seconds):
+        with self._lock:
+            self.attempted += 1
+            if len(self.latencies) < MAX_LATENCY_SAMPLES:
+                self.latencies.append(seconds)
+            else:
+                # Reservoir sampling, so memory doesn't grow with the batch.
+                index = random.randrange(self.attempted)
+                if index < MAX_LATENCY_SAMPLES:
+                    self.latencies[index] = seconds
+            if email_message.delivery_state == DeliveryState.SENT:
+                self.sent += 1
+            elif email_message.delivery_state == DeliveryState.QUEUED:
+                self.retrying += 1
+            else:
+                self.failed += 1
+
+    def add_connection(self, connection: BatchConnection):
+        with self._lock:
+            self.connections_opened += connection.connections_opened
+            self.connection_reuses += connection.reuse_count
+
+    def stop(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def throughput(self):
+        """Messages attempted per second."""
+        return self.attempted / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, percent):
+        """The latency in seconds that `percent` % of the sends were
+        faster than (nearest rank), or `None` before anything was sent.
+        """
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        rank = math.ceil(percent / 100 * len(ordered))
+        return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def send_email_batch(batch: EmailBatch, workers=1):
+    """Sends the `Queued` EmailMessages of `batch`, after preparing any
+    that are missing.
+
+    Messages are sent in chunks of `SEND_CHUNK_SIZE`. A chunk is moved to
+    `Sending` before it is sent and the results are written back when it
+    is done, so an interrupted batch can be picked up again with the
+    `resume_batch` command without resending to anyone.
+
+    With more than one worker, a pool of threads each sends over its own
+    SMTP connection. The workers take turns taking the next chunk of due
+    messages, so no message is sent by two workers. All of them still
+    share the send rate budget.
+
+    Batches using the `Async SMTP` delivery engine send each chunk over
+    several concurrent SMTP sessions, see `messaging.async_smtp`.
+
+    Sends that fail with a temporary error are retried later, see
+    `messaging.retry`. If retries are still waiting when everything that
+    is due has been sent, the batch goes back to the queue until the
+    first retry is due. If sending can't go on at all, e.g. the SMTP relay
+    can't be reached, the batch goes back to the queue with the messages
+    that weren't tried, see `SendDeferred`.
+
+    The batch is expected to be claimed, see `claim_batch()`, and the
+    claim is renewed while it is sent, see `BatchLease`.
+
+    Returns the `BatchSendStats` of the run.
+    """
+    prepare_email_batch(batch)
+
+    lease = BatchLease(batch)
+    renderer = BatchRenderer(batch)
+    limiter = SendRateLimiter(sleep=lease.sleep)
+    stats = BatchSendStats()
+
+    deferred = None
+    try:
+        if workers > 1:
+            pages = _DuePages(batch)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    pool.submit(_send_partition, batch, pages, renderer, limiter, lease, stats) for _ in range(workers)
+                ]
+                for future in futures:
+                    try:
+                        future.result()
+                    except SendDeferred as e:
+                        deferred = e
+        else:
+            try:
+                _send_partition(batch, None, renderer, limiter, lease, stats)
+            except SendDeferred as e:
+                deferred = e
+    finally:
+        limiter.release()
+    stats.stop()
+
+    claimed = EmailBatch.objects.filter(pk=batch.pk, claimed_at=batch.claimed_at)
+    queued = _queued_messages(batch)
+    if queued.exists():
+        if deferred is not None:
+            print(f"Sending {batch} is put off until {deferred.retry_at}: {deferred}")
+            retry_at = deferred.retry_at
+        else:
+            retry_at = queued.aggregate(Min("next_attempt_at"))["next_attempt_at__min"]
+        claimed.update(status=EmailBatchStatus.QUEUED, next_attempt_at=retry_at)
+    else:
+        claimed.update(status=EmailBatchStatus.COMPLETED, next_attempt_at=None)
+    return stats
+
+
+def _due():
+    return Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now())
+
+
+def _lease_expired(now):
+    return Q(status=EmailBatchStatus.SENDING) & (Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - BATCH_LEASE))
+
+
+def _queued_messages(batch):
+    return batch.email_messages.filter(delivery_state=DeliveryState.QUEUED)
+
+
+class _DuePages:
+    """Hands out the pks of the due queued messages of a batch a page at a
+    time to the workers of a parallel send, each page to one worker.
+
+    Pages are read with keyset pagination rather than from an open cursor,
+    which on SQLite would block the workers' writes.
+    """
+
+    def __init__(self, batch):
+        self._lock = threading.Lock()
+        self._due = _queued_messages(batch).filter(_due()).order_by("pk").values_list("pk", flat=True)
+        self._last_pk = None
+
+    def __iter__(self):
+        while True:
+            with self._lock:
+                due = self._due if self._last_pk is None else self._due.filter(pk__gt=self._last_pk)
+                page = list(due[:SEND_CHUNK_SIZE])
+                if page:
+                    self._last_pk = page[-1]
+            if not page:
+                return
+            yield page
+
+
+def _queued_chunks(batch, renderer, pages=None):
+    """Yields the queued messages of `batch` in chunks, with only the
+    columns needed to send them. Without `pages` every due message is
+    sent, otherwise the still queued messages of each page of pks.
+    """
+    customer_fields = [f"customer__{column}" for column in renderer.customer_columns]
+    queued = (
+        _queued_messages(batch).select_related("customer").only(*SEND_FIELDS, *customer_fields).order_by("created_at")
+    )
+    if pages is None:
+        while True:
+            chunk = list(queued.filter(_due())[:SEND_CHUNK_SIZE])
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for pks in pages:
+            chunk = list(queued.filter(pk__in=pks))
+            if chunk:
+                yield chunk
+
+
+def _send_partition(batch, pages, renderer, limiter, lease, stats):
+    """Sends the messages of one worker over its own SMTP connection, or
+    its own sessions for the async engine.
+    """
+    try:
+        if batch.delivery_engine == DeliveryEngine.ASYNC_SMTP:
+            backend = AsyncSMTPBackend()
+            for chunk in _queued_chunks(batch, renderer, pages):
+                lease.renew()
+                _send_chunk_async(batch, chunk, backend, limiter, renderer, stats)
+            stats.add_connection(backend)
+        else:
+            connection = BatchConnection()
+            try:
+                connection.open()
+            except (OSError, SMTPException) as e:
+                # Before any message was taken, so the whole partition stays queued.
+                raise SendDeferred(
+                    f"Couldn't connect to the SMTP relay: {e}", timezone.now() + RELAY_RETRY_DELAY
+                ) from e
+            try:
+                for chunk in _queued_chunks(batch, renderer, pages):
+                    lease.renew()
+                    _send_chunk(batch, chunk, connection, limiter, renderer, stats)
+            finally:
+                connection.close()
+            stats.add_connection(connection)
+    finally:
+        if threading.current_thread() is not threading.main_thread():
+            # Django opens a db connection per thread, pool threads have to close theirs.
+            connections.close_all()
+
+
+def _mark_sending(chunk):
+    EmailMessage.objects.filter(pk__in=[email_message.pk for email_message in chunk]).update(
+        delivery_state=DeliveryState.SENDING,
+        attempts=F("attempts") + 1,
+        last_attempt_at=timezone.now(),
+    )
+    for email_message in chunk:
+        email_message.attempts += 1
+
+
+def _send_chunk(batch, chunk, connection, limiter, renderer, stats):
+    _mark_sending(chunk)
+
+    done = []
+    in_flight = None
+    try:
+        for email_message in chunk:
+            in_flight = email_message
+            started = time.perf_counter()
+            # A failed send must not abort the rest of the batch.
+            try:
+                print(f"Sending email '{email_message.template_file}' to '{email_message.customer.email}'...")
+                email = renderer.build_email(email_message)
+                stats.add_time(render=time.perf_counter() - started)
+                sent, error = _send(connection, limiter, email, stats), None
+            except (BatchLeaseLost, SendDeferred):
+                # Stopped while waiting for the send rate budget, nothing was sent.
+                in_flight = None
+                raise
+            except Exception as e:
+                print(f"Sending email to '{email_message.customer.email}' FAILED: {e}")
+                sent, error = False, e
+            _set_result(email_message, sent, error)
+            stats.record(email_message, time.perf_counter() - started)
+            done.append(email_message)
+            in_flight = None
+    finally:
+        # Runs even if the worker is stopped mid chunk. The messages that
+        # weren't tried yet go back to the queue, the one being sent when
+        # it stopped stays `Sending` since it may have been delivered.
+        done_pks = {email_message.pk for email_message in done}
+        not_tried = [
+            email_message.pk
+            for email_message in chunk
+            if email_message.pk not in done_pks and email_message is not in_flight
+        ]
+        _record_results(batch, done, not_tried)
+
+
+def _send_chunk_async(batch, chunk, backend, limiter, renderer, stats):
+    """Sends `chunk` with the async engine. If sending is interrupted the
+    whole chunk stays `Sending`, as any of it may have been delivered.
+    If sending stops while waiting for the send rate budget, e.g. the
+    daily budget is spent, the messages that weren't sent yet go back to
+    the queue and the error is raised once the results are written.
+    """
+    _mark_sending(chunk)
+
+    done, to_send, emails = [], [], []
+    started = time.perf_counter()
+    for email_message in chunk:
+        try:
+            emails.append(renderer.build_email(email_message))
+            to_send.append(email_message)
+        except Exception as e:
+            print(f"Rendering email to '{email_message.customer.email}' FAILED: {e}")
+            _set_result(email_message, False, e)
+            done.append(email_message)
+    stats.add_time(render=time.perf_counter() - started)
+
+    stopped = []
+
+    def before_send():
+        try:
+            limiter.acquire()
+        except (BatchLeaseLost, SendDeferred) as e:
+            stopped.append(e)
+            return False
+        return True
+
+    print(f"Sending {len(emails)} emails over {backend.sessions} concurrent SMTP sessions...")
+    results = backend.send_all(emails, before_send=before_send)
+
+    throttled_with, not_tried = None, []
+    for email_message, result in zip(to_send, results):
+        if result is None:
+            not_tried.append(email_message.pk)
+            continue
+        if throttle_code(result.error) is not None:
+            throttled_with = throttle_code(result.error)
+        elif result.sent:
+            limiter.succeeded()
+        if result.error is not None:
+            print(f"Sending email to '{email_message.customer.email}' FAILED: {result.error}")
+        _set_result(email_message, result.sent, result.error)
+        stats.record(email_message, result.seconds)
+        stats.add_time(smtp=result.seconds)
+        done.append(email_message)
+
+    # Throttled messages are retried later like other temporary errors.
+    if throttled_with is not None:
+        limiter.throttled(throttled_with)
+    _record_results(batch, done, not_tried)
+    if stopped:
+        raise stopped[0]
+
+
+def _set_result(email_message, sent, error):
+    """Moves `email_message` to its state after a send attempt. Temporary
+    errors schedule a retry, or move the message to the dead letter list
+    once it is out of attempts.
+    """
+    email_message.send_succeeded = sent
+    email_message.next_attempt_at = None
+    email_message.last_error = "" if error is None else str(error)[:512]
+
+    if sent:
+        email_message.delivery_state = DeliveryState.SENT
+    elif error is not None and is_transient(error):
+        email_message.next_attempt_at = next_attempt_at(email_message.attempts)
+        if email_message.next_attempt_at is None:
+            email_message.delivery_state = DeliveryState.DEAD_LETTER
+        else:
+            email_message.delivery_state = DeliveryState.QUEUED
+    else:
+        email_message.delivery_state = DeliveryState.FAILED
+
+
+def _record_results(batch, done, not_tried):
+    sent = [email_message.pk for email_message in done if email_message.send_succeeded]
+    not_sent = [email_message for email_message in done if not email_message.send_succeeded]
+
+    EmailMessage.objects.filter(pk__in=sent).update(
+        delivery_state=DeliveryState.SENT, send_succeeded=True, next_attempt_at=None, last_error=""
+    )
+    EmailMessage.objects.bulk_update(not_sent, ["delivery_state", "send_succeeded", "next_attempt_at", "last_error"])
+    EmailMessage.objects.filter(pk__in=not_tried).update(
+        delivery_state=DeliveryState.QUEUED, attempts=F("attempts") - 1
+    )
+
+    # Messages waiting for a retry are counted once they are finished.
+    finished = sum(1 for email_message in done if email_message.delivery_state != DeliveryState.QUEUED)
+    EmailBatch.objects.filter(pk=batch.pk).update(
+        emails_initiated=F("emails_initiated") + finished, emails_sent=F("emails_sent") + len(sent)
+    )
+    Customer.record_sent([email_message.customer_id for email_message in done if email_message.send_succeeded])
+
+
+def _send(connection, limiter, email, stats):
+    """Sends `email` within the send rate budget. A throttling reply from
+    the relay slows the limiter down, and the error is raised so the email
+    is retried later like after any temporary error, see `messaging.retry`.
+    """
+    limiter.acquire()
+    try:
+        sent = _timed_send(connection, email, stats)
+    except Exception as e:
+        if throttle_code(e) is not None:
+            limiter.throttled(throttle_code(e))
+        raise
+    limiter.succeeded()
+    return sent
+
+
+def _timed_send(connection, email, stats):
+    started = time.perf_counter()
+    try:
+        return connection.send(email)
+    finally:
+        stats.add_time(smtp=time.perf_counter() - started)
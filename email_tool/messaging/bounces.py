@@ -0,0 +1,116 @@
+""" Reads delivery status notifications (bounces) from a local mailbox. """
+
+### Python imports ###
+import mailbox
+import os
+import uuid
+from collections import namedtuple
+from email import message_from_binary_file, policy
+
+### User-defined imports ###
+from email_tool.models import normalize_email
+from email_tool.messaging.message import MESSAGE_TOKEN_HEADER
+
+# A failed delivery to `recipient`. `message_token` is the token of the
+# EmailMessage that bounced, if the DSN returned our headers.
+Bounce = namedtuple("Bounce", ["recipient", "status", "diagnostic", "message_token"])
+
+
+def iter_mailbox(path):
+    """Yields the messages of the maildir or mbox at `path` one at a
+    time, so a large mailbox is never loaded into memory at once.
+    """
+    if os.path.isdir(path):
+        box = mailbox.Maildir(path, factory=None, create=False)
+    elif os.path.isfile(path):
+        box = mailbox.mbox(path, create=False)
+    else:
+        raise FileNotFoundError(f"No maildir or mbox at '{path}'.")
+
+    try:
+        for key in box.iterkeys():
+            with box.get_file(key) as f:
+                yield message_from_binary_file(f, policy=policy.default)
+    finally:
+        box.close()
+
+
+def parse_dsn(message):
+    """Returns the hard bounces reported by `message`, a delivery status
+    notification (RFC 3464). Anything else, including delays and
+    temporary (4.x.x) failures, returns nothing.
+    """
+    if message.get_content_type() != "multipart/report":
+        return []
+    if message.get_param("report-type", "").lower() != "delivery-status":
+        return []
+
+    message_token = None
+    recipient_fields = []
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if content_type == "message/delivery-status":
+            # The first block holds the per-message fields, the rest one per recipient.
+            recipient_fields = _status_blocks(part)[1:]
+        elif content_type in ("message/rfc822", "text/rfc822-headers") and message_token is None:
+            message_token = _returned_message_token(part)
+
+    bounces = []
+    for fields in recipient_fields:
+        recipient = _address(fields.get("final-recipient") or fields.get("original-recipient"))
+        status = (fields.get("status") or "").strip()
+        if not recipient or (fields.get("action") or "").strip().lower() != "failed" or not status.startswith("5"):
+            continue
+        diagnostic = " ".join((fields.get("diagnostic-code") or "").split())
+        bounces.append(Bounce(normalize_email(recipient), status, diagnostic, message_token))
+    return bounces
+
+
+def _status_blocks(part):
+    """Returns the header blocks of a `message/delivery-status` part as
+    dicts with lowercase field names.
+    """
+    payload = part.get_payload()
+    if isinstance(payload, list):
+        return [{name.lower(): str(value) for name, value in block.items()} for block in payload]
+
+    # Some servers send the report as plain text.
+    blocks = []
+    for text in payload.replace("\r\n", "\n").split("\n\n"):
+        fields = {}
+        for line in text.split("\n"):
+            name, separator, value = line.partition(":")
+            if separator and not line[:1].isspace():
+                fields[name.strip().lower()] = value.strip()
+        if fields:
+            blocks.append(fields)
+    return blocks
+
+
+def _address(field):
+    """Returns the address of a `Final-Recipient: rfc822; <address>` field."""
+    if not field:
+        return ""
+    _, _, address = field.rpartition(";")
+    return address.strip().strip("<>")
+
+
+def _returned_message_token(part):
+    """Returns the EmailMessage token in the headers of the returned
+    message, or `None`.
+    """
+    if part.get_content_type() == "message/rfc822":
+        payload = part.get_payload()
+        returned = payload[0] if isinstance(payload, list) and payload else None
+        token = returned.get(MESSAGE_TOKEN_HEADER) if returned is not None else None
+    else:
+        token = None
+        for line in part.get_content().splitlines():
+            name, _, value = line.partition(":")
+            if name.strip().lower() == MESSAGE_TOKEN_HEADER.lower():
+                token = value
+                break
+    try:
+        return uuid.UUID(str(token).strip()) if token else None
+    except ValueError:
+        return None
@@ -0,0 +1,65 @@
+""" SMTP connection management for sending email batches. """
+
+### Python imports ###
+from smtplib import SMTPServerDisconnected
+
+### Django imports ###
+from django.core import mail
+
+
+class BatchConnection:
+    """Keeps a single email backend connection open for the length of a
+    batch, so each message doesn't pay for its own TLS handshake and login.
+
+    If the server drops the session the connection is reopened and the
+    message is sent again, up to `max_reconnects` times in a row.
+
+    Usage:
+        with BatchConnection() as connection:
+            connection.send(email)
+    """
+
+    def __init__(self, max_reconnects=3):
+        self.backend = mail.get_connection(fail_silently=False)
+        self.max_reconnects = max_reconnects
+        self.connections_opened = 0
+        self.messages_sent = 0
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def reuse_count(self):
+        """The number of messages that were sent over an already open connection."""
+        return max(self.messages_sent - self.connections_opened, 0)
+
+    def open(self):
+        if self.backend.open():
+            self.connections_opened += 1
+
+    def close(self):
+        self.backend.close()
+
+    def send(self, email):
+        """Sends `email` over the shared connection and returns if it
+        was accepted by the server.
+        """
+        reconnects = 0
+        while True:
+            try:
+                sent = self.backend.send_messages([email]) == 1
+                break
+            except SMTPServerDisconnected:
+                if reconnects >= self.max_reconnects:
+                    raise
+                reconnects += 1
+                self.close()
+                self.open()
+
+        if sent:
+            self.messages_sent += 1
+        return sent
@@ -0,0 +1,61 @@
+""" Builds the outgoing email for an `EmailMessage` record. """
+
+### Django imports ###
+from django.conf import settings
+
+### Third Party imports ###
+from decouple import config
+from mail_templated import EmailMessage as TemplatedEmail
+
+DEFAULT_EMAIL_SENDER = config("EMAIL_USER", "")
+FROM_ADDRESS = f"Fidelis Partners <{DEFAULT_EMAIL_SENDER}>"
+
+# Identifies the EmailMessage an email was sent for, e.g. in the copy of
+# its headers a bounce returns, see `messaging.bounces`.
+MESSAGE_TOKEN_HEADER = "X-Email-Message-Token"
+
+
+def build_email(email_message, connection=None):
+    """Renders the template of `email_message` for its customer and
+    returns the email ready to be sent.
+
+    Arguments:
+        `email_message`: The `EmailMessage` model instance being sent.
+        `connection`: (Optional) The email backend the email will be sent
+            through. If not provided the default backend is used.
+    """
+    customer = email_message.customer
+    context = {
+        "customer": customer,
+        "unsubscribe_link": unsubscribe_link(email_message),
+        "email_message": email_message,
+    }
+    return TemplatedEmail(
+        f"email/{email_message.template_file}",
+        context,
+        FROM_ADDRESS,
+        [customer.email],
+        connection=connection,
+        headers=email_headers(email_message),
+        render=True,
+    )
+
+
+def email_headers(email_message):
+    """The headers of the email for `email_message`: its token, and the
+    RFC 8058 one-click unsubscribe headers that let mail clients show an
+    unsubscribe button which POSTs to `unsubscribe_one_click_link()`.
+    """
+    return {
+        MESSAGE_TOKEN_HEADER: str(email_message.token),
+        "List-Unsubscribe": f"<{unsubscribe_one_click_link(email_message)}>",
+        "List-Unsubscribe-Post": "List-Unsubscribe=One-Click",
+    }
+
+
+def unsubscribe_link(email_message):
+    return f"{settings.UNSUBSCRIBE_ROUTE_BASE}/{email_message.token}"
+
+
+def unsubscribe_one_click_link(email_message):
+    return f"{unsubscribe_link(email_message)}/one-click"
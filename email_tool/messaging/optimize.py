@@ -0,0 +1,157 @@
+""" Shrinks rendered email html: CSS inlining and minification. """
+
+### Python imports ###
+import re
+
+### Third Party imports ###
+import rcssmin
+from bs4 import BeautifulSoup, Comment, NavigableString
+import soupsieve
+from soupsieve import SelectorSyntaxError
+
+# Whitespace only text in these elements is never rendered.
+_WHITESPACE_INSENSITIVE = {"html", "head", "body", "table", "thead", "tbody", "tfoot", "tr", "ul", "ol"}
+# Text in these elements is kept exactly as it is.
+_PRESERVE_WHITESPACE = {"pre", "textarea", "style", "script"}
+
+
+def optimize_html(html):
+    """Returns `html` with its CSS inlined and minified, see
+    `inline_css()` and `minify_html()`.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    inline_css(soup)
+    minify_html(soup)
+    return soup.decode(formatter="minimal")
+
+
+def inline_css(soup):
+    """Moves the rules of the `<style>` blocks of `soup` into the `style`
+    attributes of the elements they match, so email clients that ignore
+    `<style>` blocks show the same thing.
+
+    The declarations are applied in cascade order: `!important` first,
+    then the existing `style` attribute, then selector specificity, then
+    source order. Rules that can't be inlined stay in the `<style>`
+    block: at-rules like `@media`, selectors with pseudo-classes, the
+    universal selector `*` (it would be copied onto every element), and
+    selectors that match nothing in the body, as those are usually aimed
+    at markup the email client adds, e.g. `.ExternalClass`. Conditional
+    comments aren't touched.
+    """
+    body = soup.body or soup
+    matched = {}
+    order = 0
+    for style in soup.find_all("style"):
+        kept = []
+        for prelude, block in _parse_rules(rcssmin.cssmin(style.string or "")):
+            if prelude.startswith("@"):
+                kept.append(f"{prelude}{{{block}}}")
+                continue
+            declarations = _parse_declarations(block)
+            not_inlined = []
+            for selector in prelude.split(","):
+                elements = _select(body, selector)
+                if not elements:
+                    not_inlined.append(selector)
+                    continue
+                specificity = _specificity(selector)
+                for element in elements:
+                    for name, value, important in declarations:
+                        order += 1
+                        matched.setdefault(id(element), (element, []))[1].append(
+                            ((important, False, specificity, order), name, value)
+                        )
+            if not_inlined:
+                kept.append(f"{','.join(not_inlined)}{{{block}}}")
+        if kept:
+            style.string = "".join(kept)
+        else:
+            style.decompose()
+
+    for element, declarations in matched.values():
+        for name, value, important in _parse_declarations(element.get("style", "")):
+            order += 1
+            declarations.append(((important, True, (0, 0, 0), order), name, value))
+        style = {}
+        for _, name, value in sorted(declarations, key=lambda declaration: declaration[0]):
+            style.pop(name, None)
+            style[name] = value
+        element["style"] = ";".join(f"{name}:{value}" for name, value in style.items())
+
+
+def minify_html(soup):
+    """Removes comments, except conditional comments, and collapses the
+    whitespace of `soup`. Whitespace that can't be rendered, like the
+    indentation between table rows, is removed.
+    """
+    for text in soup.find_all(string=True):
+        if isinstance(text, Comment):
+            if not (text.startswith("[if") or text.startswith("<![endif]")):
+                text.extract()
+            continue
+        if type(text) is not NavigableString or text.find_parent(_PRESERVE_WHITESPACE) is not None:
+            continue
+        if not text.strip() and text.parent.name in _WHITESPACE_INSENSITIVE:
+            text.extract()
+        else:
+            text.replace_with(re.sub(r"\s+", " ", text))
+
+
+def _parse_rules(css):
+    """Yields the `(prelude, block)` of each top level rule of minified `css`."""
+    depth = 0
+    start = 0
+    prelude = ""
+    for i, char in enumerate(css):
+        if char == "{":
+            if depth == 0:
+                prelude, start = css[start:i].strip(), i + 1
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                yield prelude, css[start:i]
+                start = i + 1
+
+
+def _parse_declarations(block):
+    """Returns the `(name, value, important)` of each declaration of a
+    rule block or a `style` attribute.
+    """
+    declarations = []
+    for declaration in block.split(";"):
+        name, separator, value = declaration.partition(":")
+        if not separator or not name.strip():
+            continue
+        value = value.strip()
+        important = value.lower().replace(" ", "").endswith("!important")
+        declarations.append((name.strip(), value, important))
+    return declarations
+
+
+def _select(body, selector):
+    """Returns the elements of `body` matched by `selector`, or nothing if
+    it can't be inlined.
+    """
+    selector = selector.strip()
+    if ":" in re.sub(r"\[[^\]]*\]", "", selector) or _specificity(selector) == (0, 0, 0):
+        return []
+    try:
+        matched = body.select(selector)
+        # `select()` only matches descendants.
+        if body.name == "body" and soupsieve.match(selector, body):
+            matched.append(body)
+    except (SelectorSyntaxError, NotImplementedError):
+        return []
+    return matched
+
+
+def _specificity(selector):
+    """Returns the CSS specificity of a selector without pseudo-classes."""
+    attributes = re.findall(r"\[[^\]]*\]", selector)
+    selector = re.sub(r"\[[^\]]*\]", "", selector)
+    ids = len(re.findall(r"#[\w-]+", selector))
+    classes = len(re.findall(r"\.[\w-]+", selector)) + len(attributes)
+    elements = len(re.findall(r"(?:^|[\s>+~])[a-zA-Z][\w-]*", selector))
+    return ids, classes, elements
@@ -0,0 +1,97 @@
+""" Caches the rendered previews of mass email. """
+
+### Python imports ###
+import hashlib
+import os
+import uuid
+
+### Django imports ###
+from django.core.cache import cache
+from django.template.loader import get_template, render_to_string
+
+# How long a rendered preview is kept in the cache.
+PREVIEW_CACHE_TIMEOUT = 60 * 60
+
+# Previews are cached under a generation that changes when what they show
+# changes, see `evict_batch_previews()` and `evict_image_previews()`. The
+# cache is shared by all the processes, so that evicts them everywhere. A
+# generation that was culled from the cache is replaced by a new one,
+# which only evicts more.
+_IMAGES_GENERATION_KEY = "email_tool:preview_generation:images"
+
+
+def batch_preview(request, batch, customer):
+    """Returns the preview of the email of the existing `batch` for
+    `customer`.
+    """
+
+    def render():
+        context = {
+            "customer": customer,
+            "email_message": batch.create_email_message(customer),
+            "unsubscribe_link": "https://www.google.com",
+        }
+        return render_to_string(f"email/{batch.template_file}", context, request)
+
+    values = [
+        batch.subject,
+        batch.title,
+        batch.custom_message,
+        batch.call_to_action_button_text,
+        batch.call_to_action_button_link,
+        batch.image_ids,
+        customer_values(customer),
+    ]
+    return cached_preview(batch.pk, batch.template_file, values, render)
+
+
+def cached_preview(batch_token, template_file, values, render):
+    """Returns the preview of the batch `batch_token` (`None` for a batch
+    that isn't saved yet) rendered with `template_file` for the form
+    `values`, calling `render()` to render it the first time.
+
+    `values` must hold everything else the preview shows, e.g. the form
+    values and the Customer's fields, as the cache key is a hash of them.
+    """
+    template = get_template(f"email/{template_file}").origin.name
+    key = _preview_key(batch_token, [template_file, os.path.getmtime(template), *values])
+    html = cache.get(key)
+    if html is None:
+        html = render()
+        cache.set(key, html, PREVIEW_CACHE_TIMEOUT)
+    return html
+
+
+def customer_values(customer):
+    """The values of `customer` a preview may show. Its pk isn't one, the
+    mock Customers of previews get a new one every time.
+    """
+    return [getattr(customer, field.attname) for field in customer._meta.concrete_fields if not field.primary_key]
+
+
+def evict_batch_previews(batch_token):
+    """Evicts the previews of the batch `batch_token`."""
+    cache.set(_batch_generation_key(batch_token), uuid.uuid4().hex, None)
+
+
+def evict_image_previews():
+    """Evicts all the previews, as any of them may show a changed image."""
+    cache.set(_IMAGES_GENERATION_KEY, uuid.uuid4().hex, None)
+
+
+def _preview_key(batch_token, values):
+    generation_keys = [_IMAGES_GENERATION_KEY]
+    if batch_token is not None:
+        generation_keys.append(_batch_generation_key(batch_token))
+    generations = cache.get_many(generation_keys)
+    missing = {key: uuid.uuid4().hex for key in generation_keys if key not in generations}
+    if missing:
+        cache.set_many(missing, None)
+        generations.update(missing)
+
+    fingerprint = hashlib.sha1(repr([generations[key] for key in generation_keys] + list(values)).encode())
+    return f"email_tool:preview:{batch_token or 'new'}:{fingerprint.hexdigest()}"
+
+
+def _batch_generation_key(batch_token):
+    return f"email_tool:preview_generation:batch:{batch_token}"
@@ -0,0 +1,177 @@
+""" Renders the email of a whole batch from a single template render. """
+
+### Python imports ###
+import hashlib
+import os
+import re
+import uuid
+
+### Django imports ###
+from django.core import mail
+from django.core.cache import cache
+from django.template.loader import get_template
+from django.utils.html import conditional_escape
+
+### Third Party imports ###
+from mail_templated import EmailMessage as TemplatedEmail
+
+### User-defined imports ###
+from email_tool.models import Customer, EmailBatch
+from email_tool.messaging.message import FROM_ADDRESS, email_headers, unsubscribe_link
+from email_tool.messaging.optimize import optimize_html
+from email_tool.messaging.tracking import add_tracking
+
+# How long a compiled batch template is kept in the cache.
+SKELETON_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+class _RecipientPlaceholder:
+    """Stands in for the customer while the batch template is rendered.
+    Every attribute the template reads becomes a marker that is filled
+    in per recipient, and its name is recorded in `_fields`.
+    """
+
+    def __init__(self, marker):
+        self._marker = marker
+        self._fields = set()
+
+    def __getattr__(self, name):
+        self._fields.add(name)
+        return self._marker(f"customer.{name}")
+
+
+class BatchRenderer:
+    """Compiles the template of an EmailBatch once and produces each
+    recipient's email by filling in the per-recipient values.
+
+    The template is rendered a single time with the batch-wide context
+    (image URLs, title, custom message, call to action) and markers in
+    place of the `customer` and `unsubscribe_link` values. Each part of
+    that result is split on the markers, so rendering a recipient is
+    just joining strings. The html gets open and click tracking, see
+    `messaging.tracking`, and is rendered with its CSS inlined and
+    minified, see `optimize_html()`.
+
+    The compiled template is cached, keyed by the batch token, the
+    template's mtime and the batch's content, so later sends of the batch
+    (e.g. retries) reuse it, as do the other worker processes since the
+    cache is shared, see `CACHES` in the settings.
+
+    NOTE: Per-recipient values may only be output, e.g.
+    `{{ customer.first_name }}`. Using them in `{% if %}` tags or
+    filters would act on the marker instead of the recipient's value.
+
+    Usage:
+        renderer = BatchRenderer(batch)
+        for email_message in email_messages:
+            connection.send(renderer.build_email(email_message))
+    """
+
+    def __init__(self, batch: EmailBatch):
+        self.template_name = f"email/{batch.template_file}"
+        cache_key = self._cache_key(batch)
+        compiled = cache.get(cache_key)
+        if compiled is None:
+            compiled = self._compile_template(batch)
+            cache.set(cache_key, compiled, SKELETON_CACHE_TIMEOUT)
+        self.customer_fields, self.subject, self.body, self.content_subtype, self.alternatives = compiled
+
+    def _cache_key(self, batch):
+        template = get_template(self.template_name).origin.name
+        content = batch.create_email_message(Customer())
+        fingerprint = hashlib.sha1(
+            repr(
+                [
+                    content.subject,
+                    content.title,
+                    content.custom_message,
+                    content.call_to_action_button_text,
+                    content.call_to_action_button_link,
+                    content.get_company_logo_absolute_url,
+                    content.get_company_secondary_logo_absolute_url,
+                    content.get_primary_image_absolute_url,
+                ]
+            ).encode()
+        ).hexdigest()
+        return f"email_tool:batch_skeleton:{batch.pk}:{batch.template_file}:{os.path.getmtime(template)}:{fingerprint}"
+
+    def _compile_template(self, batch):
+        """Renders the batch's template once and returns the compiled
+        `(customer_fields, subject, body, content_subtype, alternatives)`.
+        """
+        self._marker_prefix = f"__recipient_{uuid.uuid4().hex}_"
+        self._marker_pattern = re.compile(rf"{self._marker_prefix}([\w.]+?)__")
+
+        customer = _RecipientPlaceholder(self._marker)
+        context = {
+            "customer": customer,
+            "unsubscribe_link": self._marker("unsubscribe_link"),
+            "email_message": batch.create_email_message(Customer()),
+        }
+        skeleton = TemplatedEmail(self.template_name, context, render=True)
+
+        # The subject and a plain text body are rendered with autoescape
+        # off by mail_templated, html is escaped.
+        is_html_body = skeleton.content_subtype == "html"
+        alternatives = [
+            (self._compile(content, html=mimetype == "text/html"), mimetype)
+            for content, mimetype in skeleton.alternatives
+        ]
+        return (
+            sorted(customer._fields),
+            self._compile(skeleton.subject, html=False),
+            self._compile(skeleton.body, html=is_html_body),
+            skeleton.content_subtype,
+            alternatives,
+        )
+
+    @property
+    def customer_columns(self):
+        """The Customer columns needed to send, i.e. the email address and
+        the fields the template reads.
+        """
+        columns = {field.attname for field in Customer._meta.concrete_fields}
+        return sorted(columns.intersection(self.customer_fields) | {"email"})
+
+    def _marker(self, name):
+        return f"{self._marker_prefix}{name}__"
+
+    def _compile(self, text, html):
+        """Splits `text` into a list alternating between literal text
+        and the names of the per-recipient values, which are escaped
+        if it is `html`.
+        """
+        if html and text:
+            text = optimize_html(add_tracking(text, self._marker("message_token"), self._marker_prefix))
+        return self._marker_pattern.split(text or ""), html
+
+    def _fill(self, compiled, values):
+        parts, escape = compiled
+        filled = list(parts)
+        for i in range(1, len(filled), 2):
+            value = values[filled[i]]
+            filled[i] = conditional_escape(value) if escape else str(value)
+        return "".join(filled)
+
+    def recipient_values(self, email_message):
+        customer = email_message.customer
+        values = {f"customer.{field}": getattr(customer, field) for field in self.customer_fields}
+        values["unsubscribe_link"] = unsubscribe_link(email_message)
+        values["message_token"] = email_message.token
+        return values
+
+    def build_email(self, email_message, connection=None):
+        """Returns the email for `email_message` ready to be sent."""
+        values = self.recipient_values(email_message)
+        email = mail.EmailMultiAlternatives(
+            self._fill(self.subject, values),
+            self._fill(self.body, values),
+            FROM_ADDRESS,
+            [email_message.customer.email],
+            connection=connection,
+            headers=email_headers(email_message),
+        )
+        email.content_subtype = self.content_subtype
+        for compiled, mimetype in self.alternatives:
+            email.attach_alternative(self._fill(compiled, values), mimetype)
+        return email
@@ -0,0 +1,64 @@
+""" Classification and retry scheduling of failed sends. """
+
+### Python imports ###
+import random
+from datetime import timedelta
+from smtplib import SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
+
+### Django imports ###
+from django.db import OperationalError
+from django.utils import timezone
+
+# Attempts a message gets before it is moved to the dead letter list.
+MAX_ATTEMPTS = 5
+
+# The retry delay doubles with every attempt, starting at BASE and
+# capped at MAX, in seconds.
+BASE_RETRY_DELAY = 60
+MAX_RETRY_DELAY = 60 * 60
+
+# How long a batch waits before trying again when the SMTP relay can't be reached.
+RELAY_RETRY_DELAY = timedelta(minutes=5)
+
+
+class SendDeferred(Exception):
+    """Raised when nothing more can be sent until `retry_at`, e.g. the SMTP
+    relay can't be reached. The batch goes back to the queue until then,
+    with the messages that weren't tried.
+    """
+
+    def __init__(self, message, retry_at):
+        super().__init__(message)
+        self.retry_at = retry_at
+
+
+def is_transient(error):
+    """Returns if a send that failed with `error` may succeed when tried
+    again later, e.g. a dropped connection, a timeout, a 4xx reply or the
+    db being busy while the send rate budget was taken. Anything else,
+    like a 5xx reply or a broken template, is permanent.
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in error.recipients.values())
+    if isinstance(error, SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    # Timeouts and connection errors are all OSErrors.
+    return isinstance(error, (SMTPServerDisconnected, OSError, OperationalError))
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter for a message that failed its
+    `attempts`th attempt. Half of the delay is random, so retries of a
+    batch that failed all at once are spread out.
+    """
+    delay = min(BASE_RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+    return timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+def next_attempt_at(attempts):
+    """Returns when a transiently failed message should be retried, or
+    `None` if it has used up its attempts.
+    """
+    if attempts >= MAX_ATTEMPTS:
+        return None
+    return timezone.now() + retry_delay(attempts)
@@ -0,0 +1,119 @@
+""" A local SMTP server that accepts and discards email, for benchmarks and tests. """
+
+### Python imports ###
+import asyncio
+import threading
+
+
+class SMTPSink:
+    """A minimal SMTP server on an asyncio event loop in a background thread.
+
+    Every message is accepted and counted, and kept in `messages` as
+    `(recipients, data)` if `keep_messages` is set. It also counts the
+    sessions opened and the most that were open at the same time.
+    Subclasses can refuse recipients by overriding `rcpt_reply()`.
+
+    With `messages_per_session` set, a session is dropped once it sent
+    that many messages, like relays that limit messages per connection.
+
+    Usage:
+        with SMTPSink() as sink:
+            ...  # send to 127.0.0.1:sink.port
+        print(sink.message_count)
+    """
+
+    def __init__(self, delay=0, keep_messages=False, messages_per_session=None):
+        self.delay = delay
+        self.keep_messages = keep_messages
+        self.messages_per_session = messages_per_session
+        self.messages = []
+        self.message_count = 0
+        self.connections = 0
+        self.open_sessions = 0
+        self.peak_sessions = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._session, "127.0.0.1", 0))
+            self.port = self.server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def rcpt_reply(self, address):
+        """The reply to `RCPT TO:<address>`."""
+        return b"250 OK\r\n"
+
+    async def _session(self, reader, writer):
+        self.connections += 1
+        self.open_sessions += 1
+        self.peak_sessions = max(self.peak_sessions, self.open_sessions)
+        recipients = []
+        session_messages = 0
+        try:
+            writer.write(b"220 sink ESMTP\r\n")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode().strip()
+                verb = command[:4].upper()
+
+                if verb in ("EHLO", "HELO"):
+                    writer.write(b"250 sink\r\n")
+                elif verb == "MAIL":
+                    recipients = []
+                    writer.write(b"250 OK\r\n")
+                elif verb == "RCPT":
+                    address = command.split(":", 1)[1].strip().strip("<>")
+                    reply = self.rcpt_reply(address)
+                    if reply.startswith(b"250"):
+                        recipients.append(address)
+                    writer.write(reply)
+                elif verb == "DATA":
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    data = await reader.readuntil(b"\r\n.\r\n")
+                    if self.delay:
+                        await asyncio.sleep(self.delay)
+                    self.message_count += 1
+                    if self.keep_messages:
+                        self.messages.append((recipients, data))
+                    writer.write(b"250 OK\r\n")
+                    session_messages += 1
+                    if self.messages_per_session and session_messages >= self.messages_per_session:
+                        await writer.drain()
+                        break
+                elif verb in ("RSET", "NOOP"):
+                    writer.write(b"250 OK\r\n")
+                elif verb == "QUIT":
+                    writer.write(b"221 Bye\r\n")
+                    break
+                else:
+                    writer.write(b"502 Not implemented\r\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.open_sessions -= 1
+            writer.close()
@@ -0,0 +1,83 @@
+""" In-memory suppression list used while sending email batches. """
+
+### Python imports ###
+import math
+from hashlib import blake2b
+
+### User-defined imports ###
+from email_tool.models import Customer, Suppression, normalize_email
+
+# Above this many suppressed addresses the list is held in a Bloom filter
+# instead of a set, to keep the worker's memory bounded.
+BLOOM_FILTER_THRESHOLD = 100000
+
+
+class BloomFilter:
+    """A fixed size, probabilistic set of strings. Membership tests never
+    give false negatives, and give false positives at about the
+    `error_rate` it was sized for.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray(math.ceil(self.size / 8))
+
+    def _positions(self, value):
+        # Double hashing, see Kirsch & Mitzenmacher "Less Hashing, Same Performance".
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big")
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self._positions(value))
+
+
+class SuppressionList:
+    """The suppression list loaded into memory once per batch, so checking
+    a Customer doesn't cost a query.
+
+    Small lists are held in a set. Lists larger than `BLOOM_FILTER_THRESHOLD`
+    are held in a Bloom filter, and the rare positive is confirmed with a
+    query so a false positive never skips a Customer.
+
+    Usage:
+        suppressed = SuppressionList.load()
+        if customer in suppressed:
+            ...
+    """
+
+    def __init__(self, emails, customer_ids, exact=True):
+        self.emails = emails
+        self.customer_ids = customer_ids
+        self.exact = exact
+
+    @classmethod
+    def load(cls):
+        count = Suppression.objects.count()
+        rows = Suppression.objects.values_list("email", "customer_id").iterator()
+
+        if count <= BLOOM_FILTER_THRESHOLD:
+            emails, customer_ids = set(), set()
+            exact = True
+        else:
+            emails, customer_ids = BloomFilter(count), BloomFilter(count)
+            exact = False
+
+        for email, customer_id in rows:
+            emails.add(email)
+            if customer_id is not None:
+                customer_ids.add(str(customer_id))
+
+        return cls(emails, customer_ids, exact)
+
+    def __contains__(self, customer: Customer):
+        maybe_suppressed = normalize_email(customer.email) in self.emails or str(customer.pk) in self.customer_ids
+        if maybe_suppressed and not self.exact:
+            return customer.is_suppressed()
+        return maybe_suppressed
@@ -0,0 +1,204 @@
+""" Send rate limiting for the SMTP relay. """
+
+### Python imports ###
+import threading
+import time
+from datetime import datetime, time as day_start, timedelta
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+
+### Django imports ###
+from django.conf import settings
+from django.utils import timezone
+
+### User-defined imports ###
+from email_tool.models import SendRateBudget
+from email_tool.messaging.retry import SendDeferred
+
+# SMTP replies the relay uses to tell us to slow down.
+THROTTLE_CODES = (421, 451, 452)
+
+# Bounds of the backoff after a throttling reply, in seconds.
+MIN_BACKOFF = 30
+MAX_BACKOFF = 15 * 60
+
+# The adaptive rate is never lowered below this many sends per minute.
+MIN_RATE_PER_MINUTE = 1
+
+# How many tokens a worker takes out of the shared budget at a time.
+RESERVE_BLOCK = 20
+
+# The `SendRateBudget` fields the limiter reads and writes.
+BUDGET_FIELDS = ("tokens", "refilled_at", "rate_per_minute", "day", "sent_today", "backoff_seconds", "backoff_until")
+
+
+def throttle_code(error):
+    """Returns the throttling reply a send failed with, or `None` if the
+    relay didn't ask us to slow down. Relays throttle at `RCPT TO` too, so
+    the replies to the refused recipients are checked as well.
+    """
+    if isinstance(error, SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values() if code in THROTTLE_CODES]
+        return codes[0] if codes else None
+    if isinstance(error, SMTPResponseException) and error.smtp_code in THROTTLE_CODES:
+        return error.smtp_code
+    return None
+
+
+class SendRateLimiter:
+    """Token bucket scheduler in front of the SMTP relay with a per minute
+    and a per day budget.
+
+    `acquire()` blocks until the budget allows one more send. Once the day's
+    budget is spent it raises `SendDeferred` instead of waiting for the
+    next day, so the batch goes back to the queue until then. When the
+    relay answers with a throttling reply, `throttled()` halves the send
+    rate and pauses sending with an exponential backoff, and each
+    `succeeded()` send afterwards raises the rate again by one per minute
+    until it is back to the configured rate.
+
+    The budget lives in a `SendRateBudget` row, so it survives restarts and
+    is shared by every worker sending from the same mailbox. A worker takes
+    up to `reserve_block` tokens out of it at a time and hands them to its
+    threads from memory, so most sends don't touch the db. The bucket never
+    holds more than `burst` tokens, so a block is never larger than that
+    either. Tokens a worker didn't use go back with `release()`.
+
+    The row is written with a compare-and-set `UPDATE` rather than under a
+    row lock: a worker whose write lost the race reads the row again. So
+    workers never wait on each other's transactions, and on SQLite a
+    single statement write waits for the busy timeout where a read followed
+    by a write in one transaction fails with "database is locked".
+
+    Other workers notice a throttling reply the next time they reserve
+    tokens, i.e. after at most `reserve_block` more sends.
+    """
+
+    def __init__(self, per_minute=None, per_day=None, burst=None, mailbox=None, sleep=time.sleep, reserve_block=None):
+        self.per_minute = per_minute or settings.EMAIL_SEND_RATE_PER_MINUTE
+        self.per_day = per_day or settings.EMAIL_SEND_RATE_PER_DAY
+        self.burst = burst or settings.EMAIL_SEND_RATE_BURST
+        self.mailbox = mailbox if mailbox is not None else settings.EMAIL_HOST_USER
+        self.sleep = sleep
+        self.reserve_block = reserve_block or RESERVE_BLOCK
+        # Tokens taken out of the shared budget that weren't used yet.
+        self._reserved = 0
+        # Sends that succeeded while recovering from throttling, added to
+        # the rate with the next write.
+        self._successes = 0
+        self._recovering = False
+        self._lock = threading.Lock()
+
+    def _budget(self):
+        budget, _ = SendRateBudget.objects.get_or_create(
+            mailbox=self.mailbox,
+            defaults={"tokens": self.burst, "rate_per_minute": self.per_minute},
+        )
+        return budget, {field: getattr(budget, field) for field in BUDGET_FIELDS}
+
+    def _save(self, budget, read):
+        """Writes `budget` unless another worker changed the row since it
+        was `read`. Returns whether it was written.
+        """
+        changes = {field: getattr(budget, field) for field in BUDGET_FIELDS}
+        return SendRateBudget.objects.filter(pk=budget.pk, **read).update(**changes) == 1
+
+    def _refill(self, budget, now):
+        elapsed = (now - budget.refilled_at).total_seconds()
+        budget.rate_per_minute = min(budget.rate_per_minute, self.per_minute)
+        budget.tokens = min(self.burst, budget.tokens + max(elapsed, 0) * budget.rate_per_minute / 60)
+        budget.refilled_at = now
+
+        today = timezone.localdate(now)
+        if budget.day != today:
+            budget.day = today
+            budget.sent_today = 0
+
+        if self._successes:
+            budget.backoff_seconds = 0
+            budget.rate_per_minute = min(budget.rate_per_minute + self._successes, self.per_minute)
+
+    def _seconds_until_allowed(self, budget, now):
+        if budget.backoff_until is not None and budget.backoff_until > now:
+            return (budget.backoff_until - now).total_seconds()
+        if budget.tokens < 1:
+            return (1 - budget.tokens) * 60 / budget.rate_per_minute
+        return 0
+
+    def _reserve(self):
+        """Takes a block of tokens out of the shared budget. Returns 0 once
+        it did, or how many seconds to wait before there are any.
+        """
+        while True:
+            budget, read = self._budget()
+            now = timezone.now()
+            self._refill(budget, now)
+            if budget.sent_today >= self.per_day:
+                tomorrow = datetime.combine(budget.day + timedelta(days=1), day_start())
+                raise SendDeferred(
+                    f"The daily limit of {self.per_day} emails was reached.", timezone.make_aware(tomorrow)
+                )
+            wait = self._seconds_until_allowed(budget, now)
+            reserved = 0
+            if wait <= 0:
+                reserved = int(min(self.reserve_block, budget.tokens, self.per_day - budget.sent_today))
+                budget.tokens -= reserved
+                budget.sent_today += reserved
+            if self._save(budget, read):
+                self._reserved += reserved
+                self._successes = 0
+                self._recovering = budget.backoff_seconds > 0 or budget.rate_per_minute < self.per_minute
+                return wait
+
+    def acquire(self):
+        """Blocks until one more message may be sent, and takes it out of
+        the budget. Raises `SendDeferred` if the daily budget is spent.
+        """
+        while True:
+            with self._lock:
+                if self._reserved:
+                    self._reserved -= 1
+                    return
+                wait = self._reserve()
+            if wait > 0:
+                self.sleep(wait)
+
+    def throttled(self, smtp_code=None):
+        """Slows down after the relay answered with a throttling reply. The
+        tokens this worker reserved go back, they can't be used while
+        sending is paused.
+        """
+        with self._lock:
+            while True:
+                budget, read = self._budget()
+                now = timezone.now()
+                budget.backoff_seconds = min(max(budget.backoff_seconds * 2, MIN_BACKOFF), MAX_BACKOFF)
+                budget.backoff_until = now + timedelta(seconds=budget.backoff_seconds)
+                budget.rate_per_minute = max(budget.rate_per_minute / 2, MIN_RATE_PER_MINUTE)
+                budget.tokens = 0
+                budget.refilled_at = now
+                budget.sent_today = max(budget.sent_today - self._reserved, 0)
+                if self._save(budget, read):
+                    break
+            self._reserved = 0
+            self._successes = 0
+            self._recovering = True
+        print(f"SMTP relay is throttling ({smtp_code}), pausing sends for {budget.backoff_seconds:.0f} seconds.")
+
+    def succeeded(self):
+        """Speeds back up towards the configured rate after a send."""
+        if not self._recovering:
+            return
+        with self._lock:
+            self._successes += 1
+
+    def release(self):
+        """Gives the tokens this worker reserved but didn't use back to the
+        shared budget, so other workers can use them.
+        """
+        with self._lock:
+            while self._reserved:
+                budget, read = self._budget()
+                budget.tokens = min(self.burst, budget.tokens + self._reserved)
+                budget.sent_today = max(budget.sent_today - self._reserved, 0)
+                if self._save(budget, read):
+                    self._reserved = 0
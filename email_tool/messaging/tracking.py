@@ -0,0 +1,193 @@
+""" Open and click tracking of mass email. """
+
+### Python imports ###
+import atexit
+import base64
+import logging
+import threading
+from urllib.parse import urlencode
+
+### Django imports ###
+from django.conf import settings
+from django.core.signing import Signer
+from django.db import connections, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils.crypto import constant_time_compare
+
+### Third Party imports ###
+from bs4 import BeautifulSoup
+
+### User-defined imports ###
+from email_tool.models import EmailBatch, EmailMessage
+
+logger = logging.getLogger(__name__)
+
+# A transparent 1x1 gif.
+TRACKING_PIXEL = base64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7")
+
+# The most rows written by one UPDATE of a flush. Each row takes five
+# query parameters and SQLite allows 999.
+FLUSH_CHUNK_SIZE = 150
+
+_signer = Signer(salt="email_tool.tracking.click")
+
+
+def open_pixel_url(message_token):
+    return f"{settings.EMAIL_ROUTE_BASE}/open/{message_token}.gif"
+
+
+def click_url(message_token, url):
+    """The tracked link to `url` in the email `message_token`. The url is
+    signed so the click endpoint can't be used as an open redirect.
+    """
+    return f"{settings.EMAIL_ROUTE_BASE}/click/{message_token}?{urlencode({'url': url, 'sig': sign_url(url)})}"
+
+
+def sign_url(url):
+    return _signer.signature(url)
+
+
+def is_signed_url(url, signature):
+    return bool(url) and bool(signature) and constant_time_compare(_signer.signature(url), signature)
+
+
+def add_tracking(html, message_token, placeholder_prefix=None):
+    """Returns `html` with its web links going through the click endpoint
+    and the open pixel at the end of the body.
+
+    `message_token` may be a placeholder that is filled in later. Links
+    containing `placeholder_prefix` aren't tracked, as their url isn't
+    known yet and can't be signed. Neither are unsubscribe links.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    for link in soup.find_all("a", href=True):
+        href = link["href"].strip()
+        if not href.lower().startswith(("http://", "https://")) or href.startswith(settings.UNSUBSCRIBE_ROUTE_BASE):
+            continue
+        if placeholder_prefix and placeholder_prefix in href:
+            continue
+        link["href"] = click_url(message_token, href)
+
+    pixel = soup.new_tag(
+        "img", src=open_pixel_url(message_token), width="1", height="1", alt="", style="display:block;border:0"
+    )
+    (soup.body or soup).append(pixel)
+    return soup.decode(formatter="minimal")
+
+
+class TrackingBuffer:
+    """Write-behind buffer of tracking hits.
+
+    Hits are added up per email in memory and each flush adds them to the
+    emails and their batches with bulk UPDATEs of `FLUSH_CHUNK_SIZE` rows,
+    instead of an UPDATE per hit. A background thread flushes every `flush_interval` seconds,
+    or as soon as `max_pending` emails have hits. What is still buffered
+    when the process exits is flushed then.
+
+    Counts are kept per process, so hits recorded by a process that is
+    killed before it flushes are lost. They are counters, not a log.
+
+    Usage:
+        tracking_buffer.record(message_token, opens=1)
+    """
+
+    def __init__(self, flush_interval=None, max_pending=None):
+        self.flush_interval = flush_interval or settings.EMAIL_TRACKING_FLUSH_INTERVAL
+        self.max_pending = max_pending or settings.EMAIL_TRACKING_BUFFER_SIZE
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def record(self, message_token, opens=0, clicks=0):
+        with self._lock:
+            counts = self._pending.setdefault(message_token, [0, 0])
+            counts[0] += opens
+            counts[1] += clicks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="tracking-flush", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Writes the buffered hits to the db and returns how many emails
+        had hits. If that fails they are put back to be written next time.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        try:
+            _write_counts(pending)
+        except Exception:
+            with self._lock:
+                for message_token, (opens, clicks) in pending.items():
+                    counts = self._pending.setdefault(message_token, [0, 0])
+                    counts[0] += opens
+                    counts[1] += clicks
+            raise
+        return len(pending)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing the email tracking buffer failed, retrying later.")
+            finally:
+                connections.close_all()
+
+
+def _write_counts(pending):
+    """Adds the `{message_token: [opens, clicks]}` counts to the emails and
+    their batches, all or nothing. Tokens of emails that don't exist are
+    ignored.
+    """
+    message_tokens = list(pending)
+    batch_counts = {}
+    with transaction.atomic():
+        for start in range(0, len(message_tokens), FLUSH_CHUNK_SIZE):
+            chunk = message_tokens[start : start + FLUSH_CHUNK_SIZE]
+            batch_ids = dict(EmailMessage.objects.filter(pk__in=chunk).values_list("pk", "batch_id"))
+            _add_counts(EmailMessage, {pk: pending[pk] for pk in batch_ids})
+            for message_token, batch_id in batch_ids.items():
+                if batch_id is not None:
+                    counts = batch_counts.setdefault(batch_id, [0, 0])
+                    counts[0] += pending[message_token][0]
+                    counts[1] += pending[message_token][1]
+
+        batch_ids = list(batch_counts)
+        for start in range(0, len(batch_ids), FLUSH_CHUNK_SIZE):
+            _add_counts(EmailBatch, {pk: batch_counts[pk] for pk in batch_ids[start : start + FLUSH_CHUNK_SIZE]})
+
+
+def _add_counts(model, counts):
+    """Adds `[opens, clicks]` to the counters of each of the `{pk: counts}`
+    rows of `model` with a single UPDATE.
+    """
+    if not counts:
+        return
+
+    def increments(index):
+        return Case(
+            *[When(pk=pk, then=Value(values[index])) for pk, values in counts.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+
+    model.objects.filter(pk__in=list(counts)).update(
+        open_count=F("open_count") + increments(0), click_count=F("click_count") + increments(1)
+    )
+
+
+tracking_buffer = TrackingBuffer()
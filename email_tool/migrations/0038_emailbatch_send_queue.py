@@ -0,0 +1,41 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:23
+
+from django.db import migrations, models
+
+
+def mark_existing_batches_completed(apps, schema_editor):
+    """Batches created before the send queue existed were already sent."""
+    db_alias = schema_editor.connection.alias
+    EmailBatch = apps.get_model("email_tool", "EmailBatch")
+    EmailBatch.objects.using(db_alias).update(status="Completed")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0037_remove_customer_quote"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailbatch",
+            name="recipients",
+            field=models.ManyToManyField(
+                blank=True,
+                help_text="The Customers this batch was queued to send to.",
+                related_name="queued_email_batches",
+                to="email_tool.Customer",
+            ),
+        ),
+        migrations.AddField(
+            model_name="emailbatch",
+            name="status",
+            field=models.CharField(
+                choices=[("Queued", "Queued"), ("Sending", "Sending"), ("Completed", "Completed")],
+                default="Queued",
+                help_text="Queued batches are sent in the background by the `process_email_queue` worker.",
+                max_length=16,
+            ),
+        ),
+        migrations.RunPython(mark_existing_batches_completed, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_suppressions(apps, schema_editor):
+    """Adds every Customer that has unsubscribed from an EmailMessage to the suppression list."""
+    db_alias = schema_editor.connection.alias
+    Customer = apps.get_model("email_tool", "Customer")
+    Suppression = apps.get_model("email_tool", "Suppression")
+
+    unsubscribed = Customer.objects.using(db_alias).filter(emailmessage__unsubscribed=True).distinct()
+    Suppression.objects.using(db_alias).bulk_create(
+        [
+            Suppression(email=(customer.email or "").strip().lower(), customer=customer, reason="Unsubscribed")
+            for customer in unsubscribed.iterator()
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0038_emailbatch_send_queue"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Suppression",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("email", models.EmailField(help_text="The normalized email address.", max_length=254, unique=True)),
+                (
+                    "reason",
+                    models.CharField(
+                        choices=[("Unsubscribed", "Unsubscribed"), ("Bounced", "Bounced")],
+                        default="Unsubscribed",
+                        max_length=16,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "customer",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="The Customer the email address belonged to when it was suppressed.",
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="suppressions",
+                        to="email_tool.Customer",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(backfill_suppressions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:29
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0039_suppression"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SendRateBudget",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("mailbox", models.CharField(max_length=254, unique=True)),
+                (
+                    "tokens",
+                    models.FloatField(default=0, help_text="Sends currently available in the per minute bucket."),
+                ),
+                ("refilled_at", models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    "rate_per_minute",
+                    models.FloatField(help_text="The current send rate, lowered while the relay is throttling."),
+                ),
+                ("day", models.DateField(default=django.utils.timezone.localdate)),
+                ("sent_today", models.IntegerField(default=0)),
+                ("backoff_seconds", models.FloatField(default=0)),
+                ("backoff_until", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:29
+
+from django.db import migrations, models
+
+
+def set_delivery_state(apps, schema_editor):
+    """Messages sent before delivery states existed either succeeded or failed."""
+    db_alias = schema_editor.connection.alias
+    EmailMessage = apps.get_model("email_tool", "EmailMessage")
+    EmailMessage.objects.using(db_alias).filter(send_succeeded=True).update(delivery_state="Sent", attempts=1)
+    EmailMessage.objects.using(db_alias).filter(send_succeeded=False).update(delivery_state="Failed", attempts=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0040_sendratebudget"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailmessage",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0, help_text="The number of times sending was attempted."),
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="delivery_state",
+            field=models.CharField(
+                choices=[
+                    ("Queued", "Queued"),
+                    ("Sending", "Sending"),
+                    ("Sent", "Sent"),
+                    ("Failed", "Failed"),
+                    ("Suppressed", "Suppressed"),
+                ],
+                default="Queued",
+                help_text="Where this email is in its delivery. `Sending` means a send was started but its result is unknown.",
+                max_length=16,
+            ),
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="last_attempt_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(set_delivery_state, migrations.RunPython.noop),
+    ]
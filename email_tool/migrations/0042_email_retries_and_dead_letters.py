@@ -0,0 +1,63 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0041_emailmessage_delivery_state"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeadLetterEmailMessage",
+            fields=[],
+            options={
+                "verbose_name": "Dead letter email",
+                "verbose_name_plural": "Dead letter emails",
+                "proxy": True,
+                "indexes": [],
+                "constraints": [],
+            },
+            bases=("email_tool.emailmessage",),
+        ),
+        migrations.AddField(
+            model_name="emailbatch",
+            name="next_attempt_at",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="If the batch is waiting to retry failed sends, when the next one is due.",
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="last_error",
+            field=models.CharField(blank=True, default="", max_length=512),
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="next_attempt_at",
+            field=models.DateTimeField(
+                blank=True, help_text="When a send that failed with a temporary error will be retried.", null=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="emailmessage",
+            name="delivery_state",
+            field=models.CharField(
+                choices=[
+                    ("Queued", "Queued"),
+                    ("Sending", "Sending"),
+                    ("Sent", "Sent"),
+                    ("Failed", "Failed"),
+                    ("Dead Letter", "Dead Letter"),
+                    ("Suppressed", "Suppressed"),
+                ],
+                default="Queued",
+                help_text="Where this email is in its delivery. `Sending` means a send was started but its result is unknown.",
+                max_length=16,
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0042_email_retries_and_dead_letters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailbatch",
+            name="delivery_engine",
+            field=models.CharField(
+                choices=[("SMTP", "SMTP"), ("Async SMTP", "Async SMTP")],
+                default="SMTP",
+                help_text="Async SMTP sends over several concurrent SMTP sessions, use it for large batches.",
+                max_length=16,
+            ),
+        ),
+    ]
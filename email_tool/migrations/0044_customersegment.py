@@ -0,0 +1,145 @@
+# Generated by Django 3.0.7 on 2026-10-18 10:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import multiselectfield.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("email_tool", "0043_emailbatch_delivery_engine"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CustomerSegment",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=128, unique=True)),
+                ("description", models.TextField(blank=True, help_text="What this segment is for.")),
+                (
+                    "relationship_types",
+                    multiselectfield.db.fields.MultiSelectField(
+                        blank=True,
+                        choices=[
+                            ("CUSTOMER", "Customer"),
+                            ("PROSPECT", "Prospect"),
+                            ("PARTNER", "Partner"),
+                            ("OTHER", "Other"),
+                            ("NOT_SET", "Not Set"),
+                        ],
+                        help_text="Customers with any of these relationship types. Leave blank for all.",
+                        max_length=39,
+                    ),
+                ),
+                (
+                    "service_categories",
+                    multiselectfield.db.fields.MultiSelectField(
+                        blank=True,
+                        choices=[
+                            ("IT", "IT"),
+                            ("STEEL_VIKING", "Steel Viking"),
+                            ("IT_AND_STEEL_VIKING", "It and Steel Viking"),
+                            ("NOT_SET", "Not set"),
+                            ("OTHER", "Other"),
+                        ],
+                        help_text="Customers in any of these service categories. Leave blank for all.",
+                        max_length=49,
+                    ),
+                ),
+                (
+                    "interest_levels",
+                    multiselectfield.db.fields.MultiSelectField(
+                        blank=True,
+                        choices=[
+                            ("ONE", "1 – No interest, initial prospect, some interest in the past but has cooled"),
+                            (
+                                "TWO",
+                                "2 – Promising and ongoing interaction with prospect, meetings happening, possible work identified",
+                            ),
+                            (
+                                "THREE",
+                                "3 – Work identified and statement made that prospect wants to ultimately work with us – path forward",
+                            ),
+                            (
+                                "FOUR",
+                                "4 – Real opportunity for work under consideration, specific work and timeframe identified, Fidelis identified as serious contender",
+                            ),
+                            ("FIVE", "5 – Nearing work approval"),
+                        ],
+                        help_text="Customers with any of these interest levels. Leave blank for all.",
+                        max_length=23,
+                    ),
+                ),
+                (
+                    "contact_statuses",
+                    multiselectfield.db.fields.MultiSelectField(
+                        blank=True,
+                        choices=[
+                            ("NOT_SET", "Not Set"),
+                            ("BAD_NUMBER", "Bad Number"),
+                            ("VOICEMAIL", "Voicemail"),
+                            ("SETUP_CALLBACK", "Setup Callback"),
+                            ("WARM", "Warm"),
+                            ("HOT", "Hot"),
+                        ],
+                        help_text="Customers with any of these phone contact statuses. Leave blank for all.",
+                        max_length=52,
+                        verbose_name="Phone contact statuses",
+                    ),
+                ),
+                (
+                    "business_types",
+                    multiselectfield.db.fields.MultiSelectField(
+                        blank=True,
+                        choices=[
+                            ("OTHER", "Other"),
+                            ("MANUFACTURING", "Manufacturing"),
+                            ("HEALTHCARE", "Healthcare"),
+                            ("FINANCE", "Finance"),
+                        ],
+                        help_text="Customers with any of these business types. Leave blank for all.",
+                        max_length=38,
+                    ),
+                ),
+                (
+                    "state",
+                    models.CharField(
+                        blank=True, help_text="Only Customers in this state. Leave blank for all.", max_length=200
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "primary_contact",
+                    models.ForeignKey(
+                        blank=True,
+                        help_text="Only Customers with this primary contact. Leave blank for all.",
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Customer segment",
+                "ordering": ["name"],
+            },
+        ),
+        migrations.AddField(
+            model_name="emailbatch",
+            name="segment",
+            field=models.ForeignKey(
+                blank=True,
+                help_text="The Customer segment this batch was queued to send to, if any.",
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="email_batches",
+                to="email_tool.CustomerSegment",
+            ),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.7 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0044_customersegment"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailbatch",
+            name="click_count",
+            field=models.PositiveIntegerField(
+                default=0, help_text="The number of tracked link clicks in the emails of this batch."
+            ),
+        ),
+        migrations.AddField(
+            model_name="emailbatch",
+            name="open_count",
+            field=models.PositiveIntegerField(default=0, help_text="The number of opens of the emails of this batch."),
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="click_count",
+            field=models.PositiveIntegerField(default=0, help_text="The number of tracked link clicks."),
+        ),
+        migrations.AddField(
+            model_name="emailmessage",
+            name="open_count",
+            field=models.PositiveIntegerField(
+                default=0, help_text="The number of times the email was opened, as far as the tracking pixel can tell."
+            ),
+        ),
+    ]
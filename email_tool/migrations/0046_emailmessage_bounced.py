@@ -0,0 +1,31 @@
+# Generated by Django 3.0.7 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0045_email_tracking_counters"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="emailmessage",
+            name="delivery_state",
+            field=models.CharField(
+                choices=[
+                    ("Queued", "Queued"),
+                    ("Sending", "Sending"),
+                    ("Sent", "Sent"),
+                    ("Failed", "Failed"),
+                    ("Dead Letter", "Dead Letter"),
+                    ("Suppressed", "Suppressed"),
+                    ("Bounced", "Bounced"),
+                ],
+                default="Queued",
+                help_text="Where this email is in its delivery. `Sending` means a send was started but its result is unknown.",
+                max_length=16,
+            ),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 3.0.7 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+def count_emails(apps, schema_editor):
+    """The counters start from what the existing EmailMessages record."""
+    db_alias = schema_editor.connection.alias
+    EmailBatch = apps.get_model("email_tool", "EmailBatch")
+    EmailMessage = apps.get_model("email_tool", "EmailMessage")
+    rows = (
+        EmailMessage.objects.using(db_alias)
+        .filter(batch__isnull=False)
+        .values_list("batch_id")
+        .annotate(
+            sent=models.Count("pk", filter=models.Q(send_succeeded=True)),
+            unsubscribed=models.Count("pk", filter=models.Q(unsubscribed=True)),
+        )
+        .order_by()
+    )
+    batches = []
+    for batch_id, sent, unsubscribed in rows:
+        batches.append(EmailBatch(pk=batch_id, emails_sent=sent, unsubscribe_count=unsubscribed))
+    EmailBatch.objects.using(db_alias).bulk_update(batches, ["emails_sent", "unsubscribe_count"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0046_emailmessage_bounced"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailbatch",
+            name="emails_sent",
+            field=models.PositiveIntegerField(
+                default=0, help_text="The number of emails of this batch that were sent successfully."
+            ),
+        ),
+        migrations.AddField(
+            model_name="emailbatch",
+            name="unsubscribe_count",
+            field=models.PositiveIntegerField(
+                default=0, help_text="The number of emails of this batch that Customers used to unsubscribe."
+            ),
+        ),
+        migrations.RunPython(count_emails, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 3.0.7 on 2026-10-18 11:18
+
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+# The number of Customers written with each UPDATE.
+CHUNK_SIZE = 500
+
+
+def fill_email_stats(apps, schema_editor):
+    """The columns start from what the existing EmailMessages and the
+    suppression list record, like `refresh_customer_email_stats` does.
+    """
+    db_alias = schema_editor.connection.alias
+    Customer = apps.get_model("email_tool", "Customer")
+    EmailMessage = apps.get_model("email_tool", "EmailMessage")
+    Suppression = apps.get_model("email_tool", "Suppression")
+
+    sent = {
+        customer_id: (last_emailed_at, count)
+        for customer_id, last_emailed_at, count in EmailMessage.objects.using(db_alias)
+        .filter(send_succeeded=True)
+        .values_list("customer_id")
+        .annotate(last_emailed_at=models.Max(Coalesce("last_attempt_at", "created_at")), count=models.Count("pk"))
+        .order_by()
+    }
+    suppressed_emails, suppressed_ids = set(), set()
+    for email, customer_id in Suppression.objects.using(db_alias).values_list("email", "customer_id").iterator():
+        suppressed_emails.add(email)
+        suppressed_ids.add(customer_id)
+
+    customers = []
+    for pk, email in Customer.objects.using(db_alias).values_list("pk", "email").iterator():
+        last_emailed_at, count = sent.get(pk, (None, 0))
+        is_dnc = pk in suppressed_ids or (email or "").strip().lower() in suppressed_emails
+        if last_emailed_at is not None or is_dnc:
+            customers.append(Customer(pk=pk, last_emailed_at=last_emailed_at, emails_sent_count=count, is_dnc=is_dnc))
+    Customer.objects.using(db_alias).bulk_update(
+        customers, ["last_emailed_at", "emails_sent_count", "is_dnc"], batch_size=CHUNK_SIZE
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0047_emailbatch_counters"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customer",
+            name="emails_sent_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, help_text="The number of emails sent successfully to this Customer."
+            ),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="is_dnc",
+            field=models.BooleanField(
+                db_index=True,
+                default=False,
+                editable=False,
+                help_text="Whether this Customer, or anyone else using their email address, is on the suppression list.",
+                verbose_name="Do not contact",
+            ),
+        ),
+        migrations.AddField(
+            model_name="customer",
+            name="last_emailed_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                editable=False,
+                help_text="When the last email to this Customer was sent successfully.",
+                null=True,
+                verbose_name="Last emailed",
+            ),
+        ),
+        migrations.RunPython(fill_email_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.0.7 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0048_customer_email_stats"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="customer",
+            index=models.Index(fields=["company"], name="customer_company_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="emailbatch",
+            index=models.Index(fields=["batch_title"], name="emailbatch_title_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=models.Index(
+                condition=models.Q(send_succeeded=True),
+                fields=["customer", "-created_at"],
+                name="emailmsg_customer_sent_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=models.Index(
+                condition=models.Q(unsubscribed=True), fields=["customer"], name="emailmsg_unsubscribed_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=models.Index(fields=["batch", "send_succeeded"], name="emailmsg_batch_sent_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=models.Index(fields=["batch", "delivery_state"], name="emailmsg_batch_state_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="emailmessage",
+            index=models.Index(fields=["-created_at"], name="emailmsg_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="nextactionitem",
+            index=models.Index(
+                condition=models.Q(completed__isnull=True),
+                fields=["assignee", "target_date"],
+                name="nextaction_open_assignee_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="nextactionitem",
+            index=models.Index(
+                condition=models.Q(completed__isnull=True),
+                fields=["customer", "target_date"],
+                name="nextaction_open_customer_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="nextactionitem",
+            index=models.Index(fields=["-target_date"], name="nextaction_target_date_idx"),
+        ),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 3.0.7 on 2026-10-18 11:26
+
+from django.db import migrations, models
+
+# Frozen copies of `email_tool.search` as it was when this migration was
+# written, so changing the app doesn't change what this migration does.
+SQLITE_SEARCH_TABLE = "email_tool_customer_search"
+DOCUMENT_FIELDS = ["company", "first_name", "last_name", "email", "city", "master_company"]
+LABEL_FIELDS = ["service_category", "business_type", "relationship_type", "contact_status"]
+
+# The number of Customers loaded and written at a time.
+CHUNK_SIZE = 500
+
+
+def build_search_document(customer):
+    values = [getattr(customer, name) for name in DOCUMENT_FIELDS]
+    for name in LABEL_FIELDS:
+        value = getattr(customer, name)
+        values.append(dict(customer._meta.get_field(name).flatchoices).get(value, value))
+    return " ".join(str(value).strip() for value in values if value)
+
+
+def create_search_index(apps, schema_editor):
+    """Indexes the search documents, see `email_tool.search`, and fills
+    them in for the existing Customers a chunk at a time.
+    """
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        schema_editor.execute(
+            "CREATE INDEX customer_search_tsv_idx ON email_tool_customer "
+            "USING gin (to_tsvector('simple', search_document))"
+        )
+        schema_editor.execute(
+            "CREATE INDEX customer_search_trgm_idx ON email_tool_customer USING gin (search_document gin_trgm_ops)"
+        )
+    elif connection.vendor == "sqlite":
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE {SQLITE_SEARCH_TABLE} USING fts5(customer_id UNINDEXED, document)"
+        )
+
+    Customer = apps.get_model("email_tool", "Customer")
+    customers = (
+        Customer.objects.using(connection.alias)
+        .only("pk", *DOCUMENT_FIELDS, *LABEL_FIELDS)
+        .order_by("pk")
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    chunk = []
+    for customer in customers:
+        customer.search_document = build_search_document(customer)
+        chunk.append(customer)
+        if len(chunk) >= CHUNK_SIZE:
+            _save_search_documents(Customer, chunk, connection)
+            chunk = []
+    _save_search_documents(Customer, chunk, connection)
+
+
+def _save_search_documents(Customer, customers, connection):
+    if not customers:
+        return
+    Customer.objects.using(connection.alias).bulk_update(customers, ["search_document"])
+    if connection.vendor == "sqlite":
+        pk_field = Customer._meta.pk
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {SQLITE_SEARCH_TABLE} (customer_id, document) VALUES (%s, %s)",
+                [
+                    (pk_field.get_db_prep_value(customer.pk, connection), customer.search_document)
+                    for customer in customers
+                ],
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS customer_search_tsv_idx")
+        schema_editor.execute("DROP INDEX IF EXISTS customer_search_trgm_idx")
+    elif connection.vendor == "sqlite":
+        schema_editor.execute(f"DROP TABLE IF EXISTS {SQLITE_SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0049_hot_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customer",
+            name="search_document",
+            field=models.TextField(
+                blank=True,
+                default="",
+                editable=False,
+                help_text="The text this Customer is found by, see `email_tool.search`.",
+            ),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.7 on 2026-10-18 11:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("email_tool", "0050_customer_search"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="emailbatch",
+            name="claimed_at",
+            field=models.DateTimeField(
+                blank=True,
+                editable=False,
+                help_text="When the worker sending this batch last renewed its claim on it. A `Sending` batch whose claim expired was abandoned and is sent again.",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.7 on 2026-10-18 12:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Indexes the Customers by their normalized email address, see
+    `normalize_email()`, so looking up who uses a suppressed address
+    doesn't scan the table. Django 3.0 indexes can't hold expressions.
+    """
+
+    dependencies = [
+        ("email_tool", "0051_emailbatch_claimed_at"),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "CREATE INDEX customer_email_normalized_idx ON email_tool_customer ((LOWER(TRIM(email))))",
+            "DROP INDEX customer_email_normalized_idx",
+        ),
+    ]
@@ -2,22 +2,31 @@
 
 ### Python imports ###
 import uuid
+from collections import Counter
 from enum import Enum
 from datetime import datetime, timedelta
 
 ### Django imports ###
-from django.db import models
+from django.core.exceptions import EmptyResultSet
+from django.db import connections, models, router, transaction
+from django.db.models.functions import Lower, Trim
 from django.utils.html import escape, mark_safe, format_html
 from django.contrib.auth.models import User
 from django.template.defaultfilters import truncatechars
 from django.conf import settings
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 
 ### Third Party imports ###
 from phone_field import PhoneField
 from ckeditor.fields import RichTextField
 from auditlog.registry import auditlog
 from gsheets import mixins
+from multiselectfield import MultiSelectField
+
+### User-defined imports ###
+from email_tool.search import SEARCHED_FIELDS, build_search_document
 
 
 class ImageCategory(models.TextChoices):
@@ -36,6 +45,40 @@ class NextActionItemStatus(models.TextChoices):
     COMPLETED = "Completed"
 
 
+class EmailBatchStatus(models.TextChoices):
+    """Send status of an Email Batch: Queued, Sending, Completed"""
+
+    QUEUED = "Queued"
+    SENDING = "Sending"
+    COMPLETED = "Completed"
+
+
+class DeliveryEngine(models.TextChoices):
+    """How an Email Batch is delivered: SMTP, Async SMTP"""
+
+    SMTP = "SMTP", "SMTP"
+    ASYNC_SMTP = "Async SMTP", "Async SMTP"
+
+
+class DeliveryState(models.TextChoices):
+    """Delivery state of an Email Message: Queued, Sending, Sent, Failed, Suppressed, Bounced"""
+
+    QUEUED = "Queued"
+    SENDING = "Sending"
+    SENT = "Sent"
+    FAILED = "Failed"
+    DEAD_LETTER = "Dead Letter"
+    SUPPRESSED = "Suppressed"
+    BOUNCED = "Bounced"
+
+
+class SuppressionReason(models.TextChoices):
+    """Why an email address was suppressed: Unsubscribed, Bounced"""
+
+    UNSUBSCRIBED = "Unsubscribed"
+    BOUNCED = "Bounced"
+
+
 class ServiceCategory(Enum):
     """ Enum for service category the customer is seeking. """
 
@@ -200,30 +243,244 @@ class Customer(mixins.SheetPushableMixin, models.Model):
     website = models.URLField(max_length=200, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
 
+    # Kept up to date as emails are sent and addresses suppressed,
+    # `refresh_customer_email_stats` recomputes them.
+    last_emailed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        db_index=True,
+        verbose_name="Last emailed",
+        help_text="When the last email to this Customer was sent successfully.",
+    )
+    is_dnc = models.BooleanField(
+        default=False,
+        editable=False,
+        db_index=True,
+        verbose_name="Do not contact",
+        help_text="Whether this Customer, or anyone else using their email address, is on the suppression list.",
+    )
+    emails_sent_count = models.PositiveIntegerField(
+        default=0, editable=False, help_text="The number of emails sent successfully to this Customer."
+    )
+    search_document = models.TextField(
+        blank=True,
+        default="",
+        editable=False,
+        help_text="The text this Customer is found by, see `email_tool.search`.",
+    )
+
     def __str__(self):
         """ Returns a string representation of all Customer fields for a nicer display. """
         return f"{self.company}"
 
-    def last_emailed_at(self):
-        """Queries this customers EmailMessage to find the
-        timestamp of the last email we sent.
+    # The email address as it was loaded, see `save()`.
+    _loaded_email = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        customer = super().from_db(db, field_names, values)
+        customer._loaded_email = customer.__dict__.get("email")
+        return customer
+
+    def save(self, *args, **kwargs):
+        """Saves the Customer, and looks up `is_dnc` again when it is new or
+        its email address changed. The search document is rebuilt unless
+        `update_fields` leaves out every field it is built from.
         """
-        sent_emails = EmailMessage.objects.filter(customer=self, send_succeeded=True).order_by("created_at").all()
-        if len(sent_emails) > 0:
-            return sent_emails[0].created_at
-        return None
-
-    def is_dnc(self):
-        """Queries this customers EmailMessage to determine if
-        they've unsubsubscribe in response to any of them.
+        update_fields = kwargs.get("update_fields")
+        email_changed = self._state.adding or self.__dict__.get("email", self._loaded_email) != self._loaded_email
+        if email_changed and (update_fields is None or "email" in update_fields):
+            self.is_dnc = self.is_suppressed()
+            if update_fields is not None:
+                kwargs["update_fields"] = update_fields = {*update_fields, "is_dnc"}
+
+        if update_fields is None:
+            self.search_document = build_search_document(self)
+        elif not SEARCHED_FIELDS.isdisjoint(update_fields):
+            self.search_document = build_search_document(self)
+            kwargs["update_fields"] = {*update_fields, "search_document"}
+        super().save(*args, **kwargs)
+        self._loaded_email = self.__dict__.get("email", self._loaded_email)
+
+    def is_suppressed(self):
+        """Queries the suppression list to determine if this customer,
+        or anyone else using their email address, has unsubscribed.
+        Unlike `is_dnc`, this is always current, so it is what sending
+        checks.
         """
-        return EmailMessage.objects.filter(customer=self, unsubscribed=True).count() > 0
+        return Suppression.objects.filter(
+            models.Q(customer=self) | models.Q(email=normalize_email(self.email))
+        ).exists()
+
+    @classmethod
+    def record_sent(cls, customer_ids, sent_at=None):
+        """Counts an email sent to each of the Customers `customer_ids`,
+        with one UPDATE per number of emails a Customer was sent.
+        """
+        sent_at = sent_at or timezone.now()
+        counts = Counter(customer_ids)
+        for count in set(counts.values()):
+            cls.objects.filter(pk__in=[pk for pk, sent in counts.items() if sent == count]).update(
+                last_emailed_at=sent_at, emails_sent_count=models.F("emails_sent_count") + count
+            )
 
     @property
     def short_description(self):
         """ Truncates the description field to the specified length. """
         return truncatechars(self.description, 100)
 
+    class Meta:
+        indexes = [
+            # The admin's ordering.
+            models.Index(fields=["company"], name="customer_company_idx"),
+            # `customer_email_normalized_idx` on `LOWER(TRIM(email))`, the
+            # suppression list lookups, is created by migration 0052.
+        ]
+
+
+def normalize_email(email):
+    """Normalizes an email address for suppression list lookups."""
+    return (email or "").strip().lower()
+
+
+class Suppression(models.Model):
+    """An email address that must not receive mass email anymore. Mass
+    email batches load the whole suppression list once and skip the
+    Customers that are on it.
+    """
+
+    email = models.EmailField(max_length=254, unique=True, help_text="The normalized email address.")
+    customer = models.ForeignKey(
+        Customer,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="suppressions",
+        help_text="The Customer the email address belonged to when it was suppressed.",
+    )
+    reason = models.CharField(
+        choices=SuppressionReason.choices, max_length=16, default=SuppressionReason.UNSUBSCRIBED.value
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Suppressed: {self.email}"
+
+    @classmethod
+    def add_customer(cls, customer: Customer, reason=SuppressionReason.UNSUBSCRIBED):
+        """Adds the customer's email address to the suppression list. If
+        the address is already suppressed this does nothing.
+        """
+        cls.add_email(customer.email, customer.pk, reason)
+
+    @classmethod
+    def add_email(cls, email: str, customer_id=None, reason=SuppressionReason.UNSUBSCRIBED):
+        """Adds `email` to the suppression list with a single INSERT. If
+        the address is already suppressed this does nothing.
+        """
+        email = normalize_email(email)
+        cls.objects.bulk_create([cls(email=email, customer_id=customer_id, reason=reason)], ignore_conflicts=True)
+        # Everyone using the address is on the list now, whether it was
+        # already there or not.
+        suppressed = models.Q(normalized_email=email)
+        if customer_id:
+            suppressed |= models.Q(pk=customer_id)
+        Customer.objects.annotate(normalized_email=Lower(Trim("email"))).filter(suppressed).update(is_dnc=True)
+
+    @classmethod
+    def refresh_customers(cls, emails, customer_ids=()):
+        """Updates `Customer.is_dnc` of the Customers `customer_ids` and of
+        those using one of `emails`, after they were added to or removed
+        from the suppression list. The Customers are found with the
+        `customer_email_normalized_idx` index, see migration 0052.
+        """
+        normalized = {normalize_email(email) for email in emails}
+        customer_ids = set(customer_ids).union(
+            Customer.objects.annotate(normalized_email=Lower(Trim("email")))
+            .filter(normalized_email__in=normalized)
+            .values_list("pk", flat=True)
+        )
+        if not customer_ids:
+            return
+
+        suppressed = cls.objects.filter(
+            models.Q(customer=models.OuterRef("pk")) | models.Q(email=Lower(Trim(models.OuterRef("email"))))
+        )
+        Customer.objects.filter(pk__in=customer_ids).update(is_dnc=models.Exists(suppressed))
+
+
+class CustomerSegment(models.Model):
+    """A named, saved selection of Customers defined by filter criteria,
+    that mass email batches can be sent to. The Customers are selected
+    by the db when the batch is queued, see `EmailBatch.add_recipients()`.
+
+    Criteria that are left blank don't filter, a Customer has to match
+    one of the values of each criterion that is set.
+    """
+
+    name = models.CharField(max_length=128, unique=True)
+    description = models.TextField(blank=True, help_text="What this segment is for.")
+    relationship_types = MultiSelectField(
+        choices=[(relationship.name, relationship.value) for relationship in RelationshipType],
+        blank=True,
+        help_text="Customers with any of these relationship types. Leave blank for all.",
+    )
+    service_categories = MultiSelectField(
+        choices=[(service.name, service.value) for service in ServiceCategory],
+        blank=True,
+        help_text="Customers in any of these service categories. Leave blank for all.",
+    )
+    interest_levels = MultiSelectField(
+        choices=[(level.name, level.value) for level in InterestLevel],
+        blank=True,
+        help_text="Customers with any of these interest levels. Leave blank for all.",
+    )
+    contact_statuses = MultiSelectField(
+        choices=[(status.name, status.value) for status in ContactStatus],
+        blank=True,
+        verbose_name="Phone contact statuses",
+        help_text="Customers with any of these phone contact statuses. Leave blank for all.",
+    )
+    business_types = MultiSelectField(
+        choices=[(business.name, business.value) for business in BusinessType],
+        blank=True,
+        help_text="Customers with any of these business types. Leave blank for all.",
+    )
+    primary_contact = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        blank=True,
+        null=True,
+        related_name="+",
+        help_text="Only Customers with this primary contact. Leave blank for all.",
+    )
+    state = models.CharField(
+        max_length=200, blank=True, help_text="Only Customers in this state. Leave blank for all."
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Segment: {self.name}"
+
+    def customers(self):
+        """Returns a queryset of the Customers in this segment."""
+        lookups = {
+            "relationship_type__in": self.relationship_types,
+            "service_category__in": self.service_categories,
+            "interest_level__in": self.interest_levels,
+            "contact_status__in": self.contact_statuses,
+            "business_type__in": self.business_types,
+            "primary_contact": self.primary_contact_id,
+            "state__iexact": self.state,
+        }
+        return Customer.objects.filter(**{lookup: value for lookup, value in lookups.items() if value})
+
+    class Meta:
+        ordering = ["name"]
+        verbose_name = "Customer segment"
+
 
 class ImageResource(models.Model):
     """Database record of image resources. Creating a relationship with
@@ -262,6 +519,21 @@ class EmailTemplate(Enum):
 DEFAULT_IMAGE_URL = "https://cdn0.iconfinder.com/data/icons/feather/96/no-512.png"
 
 
+def resolve_image_urls(company_logo_id, alt_company_logo_id, primary_image_id):
+    """Returns the urls of the images of an email by name. The
+    ImageResources are loaded with a single query and the storage
+    backend builds each url once.
+    """
+    images = ImageResource.objects.in_bulk({company_logo_id, alt_company_logo_id, primary_image_id} - {None})
+    urls = {pk: image.image.url for pk, image in images.items()}
+    company_logo = urls.get(company_logo_id, DEFAULT_IMAGE_URL)
+    return {
+        "company_logo": company_logo,
+        "company_secondary_logo": urls.get(alt_company_logo_id, company_logo),
+        "primary_image": urls.get(primary_image_id, DEFAULT_IMAGE_URL),
+    }
+
+
 class EmailMessage(models.Model):
     """ Persistence for an email we've sent to customer. """
 
@@ -273,6 +545,18 @@ class EmailMessage(models.Model):
         blank=True,
         help_text="Indicates that an email has been sent and whether it succeeded or failed.",
     )
+    delivery_state = models.CharField(
+        choices=DeliveryState.choices,
+        max_length=16,
+        default=DeliveryState.QUEUED.value,
+        help_text="Where this email is in its delivery. `Sending` means a send was started but its result is unknown.",
+    )
+    attempts = models.PositiveIntegerField(default=0, help_text="The number of times sending was attempted.")
+    last_attempt_at = models.DateTimeField(null=True, blank=True)
+    next_attempt_at = models.DateTimeField(
+        null=True, blank=True, help_text="When a send that failed with a temporary error will be retried."
+    )
+    last_error = models.CharField(max_length=512, blank=True, default="")
     template_file = models.CharField(
         max_length=256,
         choices=[(templ.value, templ.name) for templ in EmailTemplate],
@@ -311,6 +595,10 @@ class EmailMessage(models.Model):
 
     # Results filled by customer interaction with email
     unsubscribed = models.BooleanField(default=False, blank=True)
+    open_count = models.PositiveIntegerField(
+        default=0, help_text="The number of times the email was opened, as far as the tracking pixel can tell."
+    )
+    click_count = models.PositiveIntegerField(default=0, help_text="The number of tracked link clicks.")
 
     batch = models.ForeignKey(
         "EmailBatch",
@@ -323,25 +611,97 @@ class EmailMessage(models.Model):
     def __str__(self):
         return f"Email sent to {self.customer}"
 
+    @classmethod
+    def mark_unsubscribed(cls, message_token):
+        """Unsubscribes the Customer the email `message_token` was sent to
+        and returns whether the email exists.
+
+        The email is marked with a targeted UPDATE instead of `save()`, so
+        no signal or audit log entry is written. It is counted on its batch
+        the first time only, and the address is added to the suppression
+        list so future batches skip it.
+        """
+        found = cls.objects.filter(pk=message_token).values_list("batch_id", "customer_id", "customer__email").first()
+        if found is None:
+            return False
+
+        batch_id, customer_id, email = found
+        with transaction.atomic():
+            unsubscribed = cls.objects.filter(pk=message_token, unsubscribed=False).update(unsubscribed=True)
+            if unsubscribed and batch_id is not None:
+                EmailBatch.objects.filter(pk=batch_id).update(unsubscribe_count=models.F("unsubscribe_count") + 1)
+            Suppression.add_email(email, customer_id)
+        return True
+
+    @cached_property
+    def image_urls(self):
+        """The urls of the images of this email. An email of a batch that
+        has the batch's images uses the batch's urls, so they are resolved
+        once per batch instead of once per email.
+        """
+        images = (self.company_logo_id, self.alt_company_logo_id, self.primary_image_id)
+        if EmailMessage.batch.is_cached(self) and self.batch is not None and self.batch.image_ids == images:
+            return self.batch.image_urls
+        return resolve_image_urls(*images)
+
     @property
     def get_company_logo_absolute_url(self):
-        if self.company_logo is None:
-            return DEFAULT_IMAGE_URL
-        return self.company_logo.image.url
+        return self.image_urls["company_logo"]
 
     @property
     def get_company_secondary_logo_absolute_url(self):
         """Returns alt_company_logo if there is one, otherwise returns company_logo."""
-        if self.alt_company_logo is not None:
-            return self.alt_company_logo.image.url
-        else:
-            return self.company_logo.image.url
+        return self.image_urls["company_secondary_logo"]
 
     @property
     def get_primary_image_absolute_url(self):
-        if self.primary_image is None:
-            return DEFAULT_IMAGE_URL
-        return self.primary_image.image.url
+        return self.image_urls["primary_image"]
+
+    class Meta:
+        indexes = [
+            # A Customer's sent emails, latest first.
+            models.Index(
+                fields=["customer", "-created_at"],
+                name="emailmsg_customer_sent_idx",
+                condition=models.Q(send_succeeded=True),
+            ),
+            # The few emails Customers used to unsubscribe.
+            models.Index(fields=["customer"], name="emailmsg_unsubscribed_idx", condition=models.Q(unsubscribed=True)),
+            # Counting a batch's sent emails, see `count_batch_emails()`.
+            models.Index(fields=["batch", "send_succeeded"], name="emailmsg_batch_sent_idx"),
+            # The send queue of a batch, see `messaging.batch`.
+            models.Index(fields=["batch", "delivery_state"], name="emailmsg_batch_state_idx"),
+            # The admin's ordering.
+            models.Index(fields=["-created_at"], name="emailmsg_created_idx"),
+        ]
+
+
+class DeadLetterEmailMessage(EmailMessage):
+    """EmailMessages that failed with temporary errors until they ran out
+    of attempts. They can be requeued from the admin.
+    """
+
+    class Meta:
+        proxy = True
+        verbose_name = "Dead letter email"
+        verbose_name_plural = "Dead letter emails"
+
+
+def count_batch_emails():
+    """Returns the `(emails_sent, unsubscribe_count)` of every EmailBatch
+    with emails by its pk, counted from the EmailMessages with one grouped
+    query.
+    """
+    rows = (
+        EmailMessage.objects.filter(batch__isnull=False)
+        .values_list("batch_id")
+        .annotate(
+            sent=models.Count("pk", filter=models.Q(send_succeeded=True)),
+            unsubscribed=models.Count("pk", filter=models.Q(unsubscribed=True)),
+        )
+        .order_by()
+    )
+    return {batch_id: (sent, unsubscribed) for batch_id, sent, unsubscribed in rows}
 
 
 class EmailBatch(models.Model):
@@ -402,30 +762,109 @@ class EmailBatch(models.Model):
         default=0,
         help_text="The number of emails skipped in this batch due to Customers that have unsubscribed.",
     )
+    # Kept up to date as the emails change state, `reconcile_batch_counters` recomputes them.
+    emails_sent = models.PositiveIntegerField(
+        default=0, help_text="The number of emails of this batch that were sent successfully."
+    )
+    unsubscribe_count = models.PositiveIntegerField(
+        default=0, help_text="The number of emails of this batch that Customers used to unsubscribe."
+    )
     archived = models.BooleanField(
         default=False,
         help_text="If checked, this Email Batch will be archived and hidden from the default list view.",
     )
+    open_count = models.PositiveIntegerField(default=0, help_text="The number of opens of the emails of this batch.")
+    click_count = models.PositiveIntegerField(
+        default=0, help_text="The number of tracked link clicks in the emails of this batch."
+    )
+
+    #
+    # Send queue
+    #
+
+    recipients = models.ManyToManyField(
+        Customer,
+        related_name="queued_email_batches",
+        blank=True,
+        help_text="The Customers this batch was queued to send to.",
+    )
+    status = models.CharField(
+        choices=EmailBatchStatus.choices,
+        max_length=16,
+        default=EmailBatchStatus.QUEUED.value,
+        help_text="Queued batches are sent in the background by the `process_email_queue` worker.",
+    )
+    next_attempt_at = models.DateTimeField(
+        null=True, blank=True, help_text="If the batch is waiting to retry failed sends, when the next one is due."
+    )
+    claimed_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text="When the worker sending this batch last renewed its claim on it. "
+        "A `Sending` batch whose claim expired was abandoned and is sent again.",
+    )
+    delivery_engine = models.CharField(
+        choices=DeliveryEngine.choices,
+        max_length=16,
+        default=DeliveryEngine.SMTP.value,
+        help_text="Async SMTP sends over several concurrent SMTP sessions, use it for large batches.",
+    )
+    segment = models.ForeignKey(
+        CustomerSegment,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="email_batches",
+        help_text="The Customer segment this batch was queued to send to, if any.",
+    )
 
     def __str__(self):
         return f"Email batch: {self.batch_title}"
 
-    def emails_sent(self):
-        """Queries for the number of emails that succeeded to
-        send for this batch.
-        """
-        return EmailMessage.objects.filter(batch=self, send_succeeded=True).count()
+    def add_recipients(self, customers):
+        """Adds the Customers of the `customers` queryset to the recipients,
+        skipping those that already are, and returns how many were added.
 
-    def unsubscribe_count(self):
-        """Queries for the number of emails in this batch that customers
-        have used to unsubscribe.
+        The rows are copied with a single `INSERT ... SELECT`, so the
+        Customers are selected inside the db and neither they nor their
+        ids are loaded into memory, however many there are.
         """
-        return EmailMessage.objects.filter(batch=self, unsubscribed=True).count()
+        Recipient = EmailBatch.recipients.through
+        db = router.db_for_write(Recipient)
+        connection = connections[db]
+        quote = connection.ops.quote_name
+        if not customers.query.is_sliced:
+            customers = customers.order_by()
+        try:
+            selected_sql, selected_params = customers.values("pk").query.get_compiler(db).as_sql()
+        except EmptyResultSet:
+            return 0
+
+        table = quote(Recipient._meta.db_table)
+        batch_column = quote(Recipient._meta.get_field("emailbatch").column)
+        customer_column = quote(Recipient._meta.get_field("customer").column)
+        customer_pk = quote(Customer._meta.pk.column)
+        batch_id = self._meta.pk.get_db_prep_value(self.pk, connection)
+        sql = (
+            f"INSERT INTO {table} ({batch_column}, {customer_column}) "
+            f"SELECT CAST(%s AS {self._meta.pk.db_type(connection)}), customer.{customer_pk} "
+            f"FROM {quote(Customer._meta.db_table)} customer "
+            f"WHERE customer.{customer_pk} IN ({selected_sql}) AND NOT EXISTS ("
+            f"SELECT 1 FROM {table} existing "
+            f"WHERE existing.{batch_column} = %s AND existing.{customer_column} = customer.{customer_pk})"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [batch_id, *selected_params, batch_id])
+            return cursor.rowcount
 
     def create_email_message(self, customer: Customer):
         """Uses the values stored in this instance to create a new
         EmailMessage object. It has NOT been saved to the DB yet tho,
         so edits may still take place.
+
+        The images are only set by id, the email gets their urls from
+        this batch, see `image_urls`.
         """
         return EmailMessage(
             customer=customer,
@@ -435,14 +874,21 @@ class EmailBatch(models.Model):
             custom_message=self.custom_message,
             call_to_action_button_text=self.call_to_action_button_text,
             call_to_action_button_link=self.call_to_action_button_link,
-            company_logo=self.company_logo,
-            alt_company_logo=self.alt_company_logo,
             company_logo_id=self.company_logo_id,
-            primary_image=self.primary_image,
+            alt_company_logo_id=self.alt_company_logo_id,
             primary_image_id=self.primary_image_id,
             batch=self,
         )
 
+    @property
+    def image_ids(self):
+        return self.company_logo_id, self.alt_company_logo_id, self.primary_image_id
+
+    @cached_property
+    def image_urls(self):
+        """The urls of the images of this batch, shared by all its emails."""
+        return resolve_image_urls(*self.image_ids)
+
     def clone(self, new_batch_title: str):
         """Constructs a new EmailBatch instance with all the same
         field values except for the `batch_title`. It does not get
@@ -461,6 +907,7 @@ class EmailBatch(models.Model):
             alt_company_logo=self.alt_company_logo,
             primary_image=self.primary_image,
             primary_image_id=self.primary_image_id,
+            delivery_engine=self.delivery_engine,
         )
 
     @property
@@ -471,6 +918,29 @@ class EmailBatch(models.Model):
     class Meta:
         verbose_name = "Email batch"
         verbose_name_plural = "Email batches"
+        indexes = [
+            # The admin's ordering.
+            models.Index(fields=["batch_title"], name="emailbatch_title_idx"),
+        ]
+
+
+class SendRateBudget(models.Model):
+    """Persisted state of the send rate limiter for a mailbox, so restarting
+    the email worker doesn't reset how much of the SMTP relay's per minute
+    and per day budget has been used.
+    """
+
+    mailbox = models.CharField(max_length=254, unique=True)
+    tokens = models.FloatField(default=0, help_text="Sends currently available in the per minute bucket.")
+    refilled_at = models.DateTimeField(default=timezone.now)
+    rate_per_minute = models.FloatField(help_text="The current send rate, lowered while the relay is throttling.")
+    day = models.DateField(default=timezone.localdate)
+    sent_today = models.IntegerField(default=0)
+    backoff_seconds = models.FloatField(default=0)
+    backoff_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Send rate budget: {self.mailbox}"
 
 
 class NextActionItem(models.Model):
@@ -506,6 +976,23 @@ class NextActionItem(models.Model):
 
         verbose_name = "Next Action Item"
         verbose_name_plural = "Next Action Items"
+        indexes = [
+            # Open items are looked up by assignee and by Customer, by
+            # target date. Completed items are the bulk of the table and
+            # are left out.
+            models.Index(
+                fields=["assignee", "target_date"],
+                name="nextaction_open_assignee_idx",
+                condition=models.Q(completed__isnull=True),
+            ),
+            models.Index(
+                fields=["customer", "target_date"],
+                name="nextaction_open_customer_idx",
+                condition=models.Q(completed__isnull=True),
+            ),
+            # The admin's ordering.
+            models.Index(fields=["-target_date"], name="nextaction_target_date_idx"),
+        ]
 
     """Method definitions for NextActionItem."""
 
@@ -540,4 +1027,5 @@ class NextActionItem(models.Model):
 auditlog.register(Customer)
 auditlog.register(EmailBatch)
 auditlog.register(EmailMessage)
+auditlog.register(CustomerSegment)
 auditlog.register(NextActionItem)
@@ -0,0 +1,102 @@
+""" Full-text search of Customers, used by the Customer changelist.
+
+Each Customer stores a search document, see `build_search_document()`.
+On PostgreSQL it is indexed with a `simple` tsvector GIN index, for whole
+words, and a pg_trgm GIN index, for partial and misspelled words. SQLite
+has neither, so in development the documents are copied into an FTS5
+table that is searched by word prefix instead.
+"""
+
+### Django imports ###
+from django.db import connections
+from django.db.models import BooleanField, FloatField
+from django.db.models.expressions import RawSQL
+
+# The FTS5 table holding the search documents on SQLite.
+SQLITE_SEARCH_TABLE = "email_tool_customer_search"
+
+# The fields whose values are searched, and those searched by their label.
+DOCUMENT_FIELDS = ["company", "first_name", "last_name", "email", "city", "master_company"]
+LABEL_FIELDS = ["service_category", "business_type", "relationship_type", "contact_status"]
+SEARCHED_FIELDS = frozenset(DOCUMENT_FIELDS + LABEL_FIELDS)
+
+
+def build_search_document(customer):
+    """Returns the text `customer` is found by. Choices are searched by
+    their label, e.g. "Steel Viking" instead of `STEEL_VIKING`.
+    """
+    values = [getattr(customer, name) for name in DOCUMENT_FIELDS]
+    for name in LABEL_FIELDS:
+        value = getattr(customer, name)
+        values.append(dict(customer._meta.get_field(name).flatchoices).get(value, value))
+    return " ".join(str(value).strip() for value in values if value)
+
+
+def search_customers(queryset, search_term):
+    """Returns the Customers of `queryset` matching `search_term`, annotated
+    with their `search_rank`, higher being more relevant. Returns `None` if
+    the database has no full-text search, so the caller can fall back to a
+    plain search.
+    """
+    search_term = " ".join(search_term.split())
+    vendor = connections[queryset.db].vendor
+    if not search_term or vendor not in ("postgresql", "sqlite"):
+        return None
+
+    table = connections[queryset.db].ops.quote_name(queryset.model._meta.db_table)
+    if vendor == "postgresql":
+        # The expressions are the ones indexed, see migration 0050.
+        vector = f"to_tsvector('simple', {table}.search_document)"
+        query = "plainto_tsquery('simple', %s)"
+        matches = RawSQL(
+            f"({vector} @@ {query} OR {table}.search_document %%> %s)",
+            (search_term, search_term),
+            output_field=BooleanField(),
+        )
+        rank = RawSQL(
+            f"ts_rank({vector}, {query}) + word_similarity(%s, {table}.search_document)",
+            (search_term, search_term),
+            output_field=FloatField(),
+        )
+        return queryset.filter(matches).annotate(search_rank=rank)
+
+    # Every word is matched as a prefix, quoted so it can't be read as FTS5 syntax.
+    query = " ".join('"{}"*'.format(word.replace('"', '""')) for word in search_term.split())
+    pk_column = connections[queryset.db].ops.quote_name(queryset.model._meta.pk.column)
+    matching = RawSQL(f"SELECT customer_id FROM {SQLITE_SEARCH_TABLE} WHERE {SQLITE_SEARCH_TABLE} MATCH %s", (query,))
+    # FTS5's rank is lower for better matches.
+    rank = RawSQL(
+        f"SELECT -rank FROM {SQLITE_SEARCH_TABLE} "
+        f"WHERE {SQLITE_SEARCH_TABLE} MATCH %s AND customer_id = {table}.{pk_column}",
+        (query,),
+        output_field=FloatField(),
+    )
+    return queryset.filter(pk__in=matching).annotate(search_rank=rank)
+
+
+def index_customers(customers, using="default"):
+    """Copies the search documents of `customers` into the SQLite search
+    table. PostgreSQL indexes the stored documents itself.
+    """
+    connection = connections[using]
+    if connection.vendor != "sqlite" or not customers:
+        return
+
+    pk_field = customers[0]._meta.pk
+    rows = [(pk_field.get_db_prep_value(customer.pk, connection), customer.search_document) for customer in customers]
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {SQLITE_SEARCH_TABLE} WHERE customer_id = %s", [row[:1] for row in rows])
+        cursor.executemany(f"INSERT INTO {SQLITE_SEARCH_TABLE} (customer_id, document) VALUES (%s, %s)", rows)
+
+
+def unindex_customer(customer, using="default"):
+    """Removes a deleted Customer from the SQLite search table."""
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {SQLITE_SEARCH_TABLE} WHERE customer_id = %s",
+            [customer._meta.pk.get_db_prep_value(customer.pk, connection)],
+        )
@@ -1,12 +1,21 @@
 """ Module containing Django Signals handler functions. """
-from django.conf import settings
-from django.db.models.signals import post_save
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from mail_templated import send_mail
-from email_tool.models import EmailMessage
-from decouple import config
-
-DEFAULT_EMAIL_SENDER = config("EMAIL_USER", "")
+from django.utils import timezone
+from email_tool.list_filters import evict_filter_choices
+from email_tool.models import (
+    Customer,
+    DeliveryState,
+    EmailBatch,
+    EmailMessage,
+    ImageResource,
+    NextActionItem,
+    Suppression,
+)
+from email_tool.messaging.message import build_email
+from email_tool.messaging.preview import evict_batch_previews, evict_image_previews
+from email_tool.search import index_customers, unindex_customer
 
 
 @receiver(post_save, sender=EmailMessage)
@@ -20,34 +29,88 @@ def execute_email_send(sender, instance, created, **kwargs):
 
     This then updates that EmailMessage instance to show if the send
     completed successfully.
+
+    EmailMessages that belong to an EmailBatch are skipped here, they are
+    sent by the `process_email_queue` worker over a shared connection.
     """
-    if created:  # Only if this is a new instance to the database
+    if created and instance.batch_id is None:  # Only if this is a new instance to the database
         # Actually sends an email after the `EmailMessage` object has
         # been created in the database
         customer = instance.customer
 
-        if not customer.is_dnc():
-            instance.custom_message
-            unsubscribe_link = f"{settings.UNSUBSCRIBE_ROUTE_BASE}/{instance.token}"
-            context = {
-                "customer": customer,
-                "unsubscribe_link": unsubscribe_link,
-                "email_message": instance,
-            }
+        if not customer.is_suppressed():
             print(f"Sending email '{instance.template_file}' to '{customer.email}'...")
-            result = send_mail(
-                f"email/{instance.template_file}",
-                context,
-                f"Fidelis Partners <{DEFAULT_EMAIL_SENDER}>",
-                [customer.email],
-                fail_silently=False,
-            )
+            # Errors are recorded on the instance instead of propagating
+            # out of save(). Only batch messages are retried.
+            try:
+                result = build_email(instance).send(fail_silently=False)
+            except Exception as e:
+                print(f"Sending email to '{customer.email}' FAILED: {e}")
+                result = 0
+                instance.last_error = str(e)[:512]
 
             # Save if the mail was able to send to the EmailMessage instance
             instance.send_succeeded = result == 1
+            instance.delivery_state = DeliveryState.SENT if instance.send_succeeded else DeliveryState.FAILED
+            instance.attempts += 1
+            instance.last_attempt_at = timezone.now()
+            if instance.send_succeeded:
+                Customer.record_sent([customer.pk], instance.last_attempt_at)
 
         else:
             instance.send_succeeded = False
+            instance.delivery_state = DeliveryState.SUPPRESSED
             print(f"Customer '{customer.email}' is unsubscribed, NO EMAIL SENT.")
 
         instance.save()
+
+
+@receiver(post_save, sender=Customer)
+def index_customer(sender, instance, using, update_fields, **kwargs):
+    """Keeps the SQLite search table current, see `email_tool.search`."""
+    if update_fields is None or "search_document" in update_fields:
+        index_customers([instance], using)
+
+
+@receiver(post_delete, sender=Customer)
+def unindex_deleted_customer(sender, instance, using, **kwargs):
+    unindex_customer(instance, using)
+
+
+@receiver(post_save, sender=Suppression)
+@receiver(post_delete, sender=Suppression)
+def refresh_suppressed_customers(sender, instance, **kwargs):
+    """Keeps `Customer.is_dnc` current when the suppression list is edited
+    one address at a time, e.g. in the admin. Bulk changes refresh the
+    Customers themselves, see `Suppression.refresh_customers()`.
+    """
+    Suppression.refresh_customers([instance.email], [instance.customer_id] if instance.customer_id else [])
+
+
+@receiver(post_save, sender=EmailBatch)
+@receiver(post_delete, sender=EmailBatch)
+def evict_batch_preview_cache(sender, instance, **kwargs):
+    """The cached previews of a batch are stale once it changes."""
+    evict_batch_previews(instance.pk)
+
+
+@receiver(post_save, sender=ImageResource)
+@receiver(post_delete, sender=ImageResource)
+def evict_image_preview_cache(sender, instance, **kwargs):
+    """Any cached preview may show an image that changed."""
+    evict_image_previews()
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+@receiver(post_save, sender=NextActionItem)
+@receiver(post_delete, sender=NextActionItem)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def evict_list_filter_choices(sender, update_fields=None, **kwargs):
+    """The cached list filter choices on a model, or listing its objects,
+    are stale once it changes. Logging in only saves `last_login`, which
+    no filter shows.
+    """
+    if update_fields != {"last_login"}:
+        evict_filter_choices(sender)
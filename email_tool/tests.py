@@ -1 +1,1549 @@
-# Create your tests here.
+### Python imports ###
+import datetime
+import email
+import io
+import mailbox
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+import uuid
+from smtplib import SMTPRecipientsRefused, SMTPResponseException
+from unittest import mock
+
+### Django imports ###
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models.functions import Lower, Trim
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+### Third Party imports ###
+from bs4 import BeautifulSoup
+from mail_templated import send_mail
+
+### User-defined imports ###
+from email_tool.models import (
+    Customer,
+    CustomerSegment,
+    DeliveryEngine,
+    DeliveryState,
+    EmailBatch,
+    EmailBatchStatus,
+    EmailMessage,
+    ImageResource,
+    NextActionItem,
+    SendRateBudget,
+    Suppression,
+)
+from email_tool.messaging.async_smtp import AsyncSMTPBackend
+from email_tool import list_filters as list_filters_module
+from email_tool.list_filters import filter_choices
+from email_tool.messaging import batch as batch_module
+from email_tool.messaging.batch import (
+    BATCH_LEASE,
+    SEND_CHUNK_SIZE,
+    BatchLease,
+    BatchLeaseLost,
+    _queued_chunks,
+    claim_batch,
+    claim_next_batch,
+    prepare_email_batch,
+    send_email_batch,
+)
+from email_tool.messaging import preview as preview_module
+from email_tool.messaging.message import build_email
+from email_tool.messaging.optimize import optimize_html
+from email_tool.messaging.preview import cached_preview
+from email_tool.messaging.render import BatchRenderer
+from email_tool.messaging.bounces import Bounce, iter_mailbox, parse_dsn
+from email_tool.messaging.connection import BatchConnection
+from email_tool.messaging.retry import MAX_ATTEMPTS, is_transient, next_attempt_at
+from email_tool.messaging.smtp_sink import SMTPSink
+from email_tool.messaging.suppression import BloomFilter, SuppressionList
+from email_tool.messaging.throttle import MIN_BACKOFF, SendRateLimiter, throttle_code
+from email_tool.messaging.tracking import TrackingBuffer, add_tracking, click_url
+from email_tool.search import search_customers
+
+
+class StandInSMTPServer(SMTPSink):
+    """Refuses recipients starting with `reject` with a 550 reply, and
+    recipients starting with `busy` with a temporary 451 reply.
+    """
+
+    def rcpt_reply(self, address):
+        if address.startswith("reject"):
+            return b"550 No such user\r\n"
+        if address.startswith("busy"):
+            return b"451 Try again later\r\n"
+        return super().rcpt_reply(address)
+
+
+class StandInSMTPServerMixin:
+    def setUp(self):
+        super().setUp()
+        self.smtp_server = StandInSMTPServer(delay=0.005, keep_messages=True)
+        self.smtp_server.start()
+        self.addCleanup(self.smtp_server.stop)
+        settings_override = override_settings(
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=self.smtp_server.port,
+            EMAIL_HOST_USER="",
+            EMAIL_HOST_PASSWORD="",
+            EMAIL_USE_TLS=False,
+            EMAIL_USE_SSL=False,
+            EMAIL_TIMEOUT=10,
+            UNSUBSCRIBE_ROUTE_BASE="http://testserver/email/unsubscribe",
+            EMAIL_SEND_RATE_PER_MINUTE=100000,
+            EMAIL_SEND_RATE_BURST=100000,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def received_by(self):
+        return sorted(address for recipients, _ in self.smtp_server.messages for address in recipients)
+
+
+def create_batch(batch_title, **fields):
+    image = ImageResource.objects.create(description="Logo", image="email_images/logo.png")
+    content = {
+        "subject": "News",
+        "title": "Title",
+        "custom_message": "Message",
+        "call_to_action_button_text": "Go",
+        "call_to_action_button_link": "http://example.com",
+        "company_logo": image,
+        "primary_image": image,
+    }
+    return EmailBatch.objects.create(batch_title=batch_title, **{**content, **fields})
+
+
+class AsyncSMTPBackendTests(StandInSMTPServerMixin, SimpleTestCase):
+    def test_sends_over_bounded_number_of_sessions(self):
+        emails = [mail.EmailMessage("Hi", "Body", "sender@example.com", [f"c{i}@example.com"]) for i in range(30)]
+        backend = AsyncSMTPBackend(sessions=3)
+
+        self.assertEqual(backend.send_messages(emails), 30)
+        self.assertEqual(self.received_by(), sorted(f"c{i}@example.com" for i in range(30)))
+        self.assertEqual(self.smtp_server.connections, 3)
+        self.assertEqual(self.smtp_server.peak_sessions, 3)
+        self.assertEqual(backend.reuse_count, 27)
+
+    def test_queue_applies_backpressure(self):
+        emails = [mail.EmailMessage("Hi", "Body", "sender@example.com", [f"c{i}@example.com"]) for i in range(20)]
+        backend = AsyncSMTPBackend(sessions=1, queue_size=2)
+        ahead = []
+
+        def before_send():
+            ahead.append(len(ahead) - len(self.smtp_server.messages))
+
+        backend.send_all(emails, before_send=before_send)
+        # Queued, plus the one being sent and the one being handed over.
+        self.assertLessEqual(max(ahead), 2 + 1 + 1)
+
+    def test_results_of_refused_recipients(self):
+        emails = [
+            mail.EmailMessage("Hi", "Body", "sender@example.com", [address])
+            for address in ["ok@example.com", "reject@example.com", "busy@example.com"]
+        ]
+        sent, rejected, busy = AsyncSMTPBackend(sessions=2).send_all(emails)
+
+        self.assertTrue(sent.sent)
+        self.assertIsNone(sent.error)
+        self.assertFalse(rejected.sent)
+        self.assertIsInstance(rejected.error, SMTPRecipientsRefused)
+        self.assertFalse(is_transient(rejected.error))
+        self.assertFalse(busy.sent)
+        self.assertTrue(is_transient(busy.error))
+        self.assertEqual(self.received_by(), ["ok@example.com"])
+
+    def test_send_messages_raises_unless_fail_silently(self):
+        email = mail.EmailMessage("Hi", "Body", "sender@example.com", ["reject@example.com"])
+
+        with self.assertRaises(SMTPRecipientsRefused):
+            AsyncSMTPBackend().send_messages([email])
+        self.assertEqual(AsyncSMTPBackend(fail_silently=True).send_messages([email]), 0)
+
+    def test_send_mail_interface(self):
+        context = {
+            "customer": Customer(first_name="Ada"),
+            "email_message": EmailMessage(subject="News"),
+            "unsubscribe_link": "http://testserver/email/unsubscribe/x",
+        }
+        sent = send_mail(
+            "email/simple.html", context, "sender@example.com", ["ada@example.com"], connection=AsyncSMTPBackend()
+        )
+
+        self.assertEqual(sent, 1)
+        self.assertIn(b"Subject: Ada, News", self.smtp_server.messages[0][1])
+
+
+class AsyncBatchDeliveryTests(StandInSMTPServerMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        image = ImageResource.objects.create(description="Logo", image="email_images/logo.png")
+        self.batch = EmailBatch.objects.create(
+            batch_title="Async",
+            subject="News",
+            title="Title",
+            custom_message="Message",
+            call_to_action_button_text="Go",
+            call_to_action_button_link="http://example.com",
+            company_logo=image,
+            primary_image=image,
+            delivery_engine=DeliveryEngine.ASYNC_SMTP,
+        )
+
+    def test_batch_is_sent_by_the_async_engine(self):
+        addresses = [f"c{i}@example.com" for i in range(12)] + ["reject@example.com", "busy@example.com"]
+        self.batch.recipients.set([Customer.objects.create(first_name="C", email=address) for address in addresses])
+
+        # The sender comes from the EMAIL_USER environment variable.
+        with mock.patch("email_tool.messaging.render.FROM_ADDRESS", "Sender <sender@example.com>"):
+            stats = send_email_batch(self.batch)
+
+        self.assertEqual(self.received_by(), sorted(addresses[:12]))
+        self.assertEqual((stats.sent, stats.failed, stats.retrying), (12, 1, 1))
+        states = dict(self.batch.email_messages.values_list("customer__email", "delivery_state"))
+        self.assertEqual(states["reject@example.com"], DeliveryState.FAILED)
+        self.assertEqual(states["busy@example.com"], DeliveryState.QUEUED)
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.status, EmailBatchStatus.QUEUED)
+        self.assertEqual(self.batch.emails_initiated, 13)
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend")
+class SendRateTests(StandInSMTPServerMixin, TransactionTestCase):
+    def send(self, delivery_engine, addresses):
+        batch = create_batch("Throttled", delivery_engine=delivery_engine)
+        batch.recipients.set([Customer.objects.create(first_name="C", email=address) for address in addresses])
+        with mock.patch("email_tool.messaging.render.FROM_ADDRESS", "Sender <sender@example.com>"):
+            send_email_batch(batch)
+        batch.refresh_from_db()
+        return batch
+
+    def test_throttle_code(self):
+        refused = SMTPRecipientsRefused(
+            {"a@example.com": (550, b"No such user"), "b@example.com": (452, b"Slow down")}
+        )
+
+        self.assertEqual(throttle_code(refused), 452)
+        self.assertEqual(throttle_code(SMTPResponseException(421, b"Slow down")), 421)
+        self.assertIsNone(throttle_code(SMTPResponseException(450, b"Mailbox busy")))
+        self.assertIsNone(throttle_code(SMTPRecipientsRefused({"a@example.com": (550, b"No such user")})))
+
+    def assertThrottledOnce(self, batch):
+        email_message = batch.email_messages.get()
+        self.assertEqual((email_message.delivery_state, email_message.attempts), (DeliveryState.QUEUED, 1))
+        self.assertEqual(SendRateBudget.objects.get().backoff_seconds, MIN_BACKOFF)
+        self.assertEqual(self.received_by(), [])
+
+    def test_throttling_at_rcpt_slows_down(self):
+        self.assertThrottledOnce(self.send(DeliveryEngine.SMTP, ["busy@example.com"]))
+
+    def test_throttling_at_rcpt_slows_down_the_async_engine(self):
+        self.assertThrottledOnce(self.send(DeliveryEngine.ASYNC_SMTP, ["busy@example.com"]))
+
+    def assertPutOffUntilTomorrow(self, batch):
+        tomorrow = datetime.datetime.combine(timezone.localdate() + datetime.timedelta(days=1), datetime.time())
+        self.assertEqual(batch.status, EmailBatchStatus.QUEUED)
+        self.assertEqual(batch.next_attempt_at, timezone.make_aware(tomorrow))
+        self.assertEqual(len(self.received_by()), 2)
+        unsent = batch.email_messages.get(delivery_state=DeliveryState.QUEUED)
+        self.assertEqual(unsent.attempts, 0)
+
+    @override_settings(EMAIL_SEND_RATE_PER_DAY=2)
+    def test_daily_limit_puts_the_batch_back_in_the_queue(self):
+        self.assertPutOffUntilTomorrow(
+            self.send(DeliveryEngine.SMTP, ["a@example.com", "b@example.com", "c@example.com"])
+        )
+
+    @override_settings(EMAIL_SEND_RATE_PER_DAY=2)
+    def test_daily_limit_puts_the_async_batch_back_in_the_queue(self):
+        self.assertPutOffUntilTomorrow(
+            self.send(DeliveryEngine.ASYNC_SMTP, ["a@example.com", "b@example.com", "c@example.com"])
+        )
+
+    def test_tokens_are_reserved_in_blocks(self):
+        limiter = SendRateLimiter(per_minute=6000, per_day=1000, burst=100, mailbox="m", reserve_block=20)
+        with CaptureQueriesContext(connection) as queries:
+            for _ in range(50):
+                limiter.acquire()
+
+        # Three blocks of 20, each read and written once, the row is created
+        # with the first one.
+        self.assertLessEqual(len(queries), 3 * 2 + 2)
+        self.assertEqual(SendRateBudget.objects.get().sent_today, 60)
+
+        limiter.release()
+        budget = SendRateBudget.objects.get()
+        self.assertEqual(budget.sent_today, 50)
+        self.assertGreaterEqual(budget.tokens, 50)
+
+    def test_throttling_gives_the_reserved_tokens_back(self):
+        limiter = SendRateLimiter(per_minute=6000, per_day=1000, burst=100, mailbox="m", reserve_block=20)
+        limiter.acquire()
+        limiter.throttled(421)
+        limiter.release()
+
+        budget = SendRateBudget.objects.get()
+        self.assertEqual((budget.sent_today, budget.tokens, budget.backoff_seconds), (1, 0, MIN_BACKOFF))
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend")
+class ParallelSendTests(StandInSMTPServerMixin, TransactionTestCase):
+    def test_each_recipient_gets_the_email_once(self):
+        addresses = [f"c{i}@example.com" for i in range(60)]
+        batch = create_batch("Parallel")
+        batch.recipients.set([Customer.objects.create(first_name="C", email=address) for address in addresses])
+
+        # Small chunks and one token per reservation, so the workers take
+        # turns on the messages and the send rate budget many times.
+        with mock.patch.object(batch_module, "SEND_CHUNK_SIZE", 4), mock.patch(
+            "email_tool.messaging.throttle.RESERVE_BLOCK", 1
+        ), mock.patch("email_tool.messaging.render.FROM_ADDRESS", "Sender <sender@example.com>"):
+            stats = send_email_batch(batch, workers=4)
+
+        # Every recipient exactly once, a duplicate would show up in the list.
+        self.assertEqual(self.received_by(), sorted(addresses))
+        self.assertEqual(stats.sent, 60)
+        self.assertEqual(SendRateBudget.objects.get().sent_today, 60)
+        self.assertEqual(stats.connections_opened, 4)
+        self.assertFalse(batch.email_messages.exclude(delivery_state=DeliveryState.SENT).exists())
+        batch.refresh_from_db()
+        self.assertEqual(
+            (batch.status, batch.emails_initiated, batch.emails_sent), (EmailBatchStatus.COMPLETED, 60, 60)
+        )
+
+
+@override_settings(EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend")
+class ReconnectTests(StandInSMTPServerMixin, TestCase):
+    def test_dropped_connection_is_reopened(self):
+        addresses = [f"c{i}@example.com" for i in range(10)]
+        batch = create_batch("Dropped")
+        batch.recipients.set([Customer.objects.create(first_name="C", email=address) for address in addresses])
+        # The relay hangs up after every third message.
+        self.smtp_server.messages_per_session = 3
+
+        with mock.patch("email_tool.messaging.render.FROM_ADDRESS", "Sender <sender@example.com>"):
+            stats = send_email_batch(batch)
+
+        self.assertEqual(self.received_by(), sorted(addresses))
+        self.assertEqual((stats.sent, stats.failed, stats.retrying), (10, 0, 0))
+        self.assertEqual(stats.connections_opened, 4)
+        self.assertEqual(self.smtp_server.connections, 4)
+        self.assertFalse(batch.email_messages.exclude(delivery_state=DeliveryState.SENT).exists())
+
+
+class RetryTests(SimpleTestCase):
+    def test_is_transient(self):
+        self.assertTrue(is_transient(SMTPResponseException(450, b"Mailbox busy")))
+        self.assertFalse(is_transient(SMTPResponseException(550, b"No such user")))
+        self.assertTrue(is_transient(SMTPRecipientsRefused({"a@example.com": (451, b"Try again later")})))
+        # Sending again would only go to the recipients that weren't refused for good.
+        mixed = {"a@example.com": (451, b"Try again later"), "b@example.com": (550, b"No such user")}
+        self.assertFalse(is_transient(SMTPRecipientsRefused(mixed)))
+        self.assertTrue(is_transient(ConnectionRefusedError()))
+        self.assertFalse(is_transient(ValueError("Broken template")))
+
+    def test_next_attempt_at(self):
+        self.assertGreater(next_attempt_at(1), timezone.now())
+        self.assertIsNone(next_attempt_at(MAX_ATTEMPTS))
+
+
+@override_settings(
+    UNSUBSCRIBE_ROUTE_BASE="http://testserver/email/unsubscribe",
+    EMAIL_SEND_RATE_PER_MINUTE=100000,
+    EMAIL_SEND_RATE_BURST=100000,
+)
+class DeadLetterTests(TestCase):
+    def setUp(self):
+        self.batch = create_batch("Retried")
+        customer = Customer.objects.create(first_name="C", email="c@example.com")
+        self.batch.recipients.add(customer)
+        email_message = self.batch.create_email_message(customer)
+        email_message.attempts = MAX_ATTEMPTS - 1
+        EmailMessage.objects.bulk_create([email_message])
+
+    def send(self):
+        send_email_batch(claim_batch(self.batch.pk, statuses=[EmailBatchStatus.QUEUED, EmailBatchStatus.COMPLETED]))
+        self.batch.refresh_from_db()
+        return self.batch.email_messages.get()
+
+    def test_unsent_messages_are_not_succeeded(self):
+        # e.g. left over from an earlier send of a message that was resent.
+        self.batch.email_messages.update(send_succeeded=True)
+        suppressed = Customer.objects.create(first_name="S", email="s@example.com")
+        Suppression.add_customer(suppressed)
+        self.batch.recipients.add(suppressed)
+
+        with mock.patch.object(BatchConnection, "send", side_effect=SMTPResponseException(550, b"No such user")):
+            send_email_batch(claim_batch(self.batch.pk))
+
+        states = dict(self.batch.email_messages.values_list("delivery_state", "send_succeeded"))
+        self.assertEqual(states, {DeliveryState.FAILED: False, DeliveryState.SUPPRESSED: False})
+        self.assertEqual(self.batch.email_messages.filter(send_succeeded=False).count(), 2)
+
+    def test_out_of_attempts_and_requeued(self):
+        with mock.patch.object(BatchConnection, "send", side_effect=SMTPResponseException(450, b"Mailbox busy")):
+            email_message = self.send()
+
+        self.assertEqual((email_message.delivery_state, email_message.attempts), (DeliveryState.DEAD_LETTER, 5))
+        self.assertEqual(self.batch.status, EmailBatchStatus.COMPLETED)
+        self.assertEqual((self.batch.emails_initiated, self.batch.emails_sent), (1, 0))
+
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.client.post(
+            "/email_tool/deadletteremailmessage/",
+            {"action": "requeue_action", "_selected_action": [email_message.pk]},
+        )
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.status, EmailBatchStatus.QUEUED)
+        self.assertEqual(self.batch.emails_initiated, 0)
+
+        email_message = self.send()
+        self.assertEqual((email_message.delivery_state, email_message.attempts), (DeliveryState.SENT, 1))
+        self.assertEqual((self.batch.emails_initiated, self.batch.emails_sent), (1, 1))
+
+
+@override_settings(
+    UNSUBSCRIBE_ROUTE_BASE="http://testserver/email/unsubscribe", EMAIL_ROUTE_BASE="http://testserver/email"
+)
+class BatchRendererTests(TestCase):
+    def test_same_email_as_rendering_the_template(self):
+        customer = Customer.objects.create(
+            first_name='<b>Tom & "Jerry"</b>', last_name="O'Brien", company="A&B <Co>", email="t@example.com"
+        )
+        for template_file in ["simple.html", "modern_standard.html"]:
+            with self.subTest(template_file):
+                batch = create_batch(template_file, template_file=template_file, subject="News & <offers>")
+                email_message = batch.create_email_message(customer)
+                email_message.save()
+
+                expected = build_email(email_message)
+                email = BatchRenderer(batch).build_email(email_message)
+
+                self.assertEqual(email.subject, expected.subject)
+                self.assertEqual(email.content_subtype, expected.content_subtype)
+                self.assertEqual(email.alternatives, expected.alternatives)
+                self.assertEqual(email.extra_headers, expected.extra_headers)
+                # The compiled html also has tracking and inlined CSS.
+                self.assertEqual(email.body, optimize_html(add_tracking(expected.body, email_message.token)))
+
+    def test_images_are_resolved_once_per_batch(self):
+        alt_logo = ImageResource.objects.create(description="Alt", image="email_images/alt.png")
+        batch = create_batch("Images", alt_company_logo=alt_logo)
+        customers = Customer.objects.bulk_create(
+            Customer(first_name=f"C{i}", email=f"c{i}@example.com") for i in range(5)
+        )
+        email_messages = [batch.create_email_message(customer) for customer in customers]
+
+        # The emails share the batch's image urls, loaded with one query.
+        with self.assertNumQueries(1):
+            emails = [build_email(email_message) for email_message in email_messages]
+        self.assertTrue(all(batch.image_urls["company_secondary_logo"] in email.body for email in emails))
+
+        renderer = BatchRenderer(batch)
+        with self.assertNumQueries(0):
+            for email_message in email_messages:
+                renderer.build_email(email_message)
+
+    def test_recipient_values_are_escaped_like_the_template_does(self):
+        # The shipped templates only show recipient values in the subject.
+        template = (
+            '{% extends "mail_templated/base.tpl" %}'
+            "{% block subject %}{{ customer.first_name }}, {{ email_message.subject }}{% endblock %}"
+            "{% block body %}Hi {{ customer.first_name }} of {{ customer.company }}{% endblock %}"
+            "{% block html %}<html><body><p>Hi {{ customer.first_name }} of {{ customer.company }}</p>"
+            '<a href="{{ unsubscribe_link }}">Unsubscribe</a></body></html>{% endblock %}'
+        )
+        customer = Customer.objects.create(
+            first_name='<b>Tom & "Jerry"</b>', company="A&B <Co>", email="t@example.com"
+        )
+        batch = create_batch("Escaped", template_file="escaping.html", subject="News & <offers>")
+        email_message = batch.create_email_message(customer)
+        email_message.save()
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, "email"))
+            with open(os.path.join(directory, "email", "escaping.html"), "w") as f:
+                f.write(template)
+            templates = [{**settings.TEMPLATES[0], "DIRS": [directory]}]
+            with override_settings(TEMPLATES=templates):
+                expected = build_email(email_message)
+                email = BatchRenderer(batch).build_email(email_message)
+
+        self.assertEqual(email.subject, '<b>Tom & "Jerry"</b>, News & <offers>')
+        self.assertEqual(email.subject, expected.subject)
+        self.assertEqual(email.body, expected.body)
+        self.assertEqual(email.body, 'Hi <b>Tom & "Jerry"</b> of A&B <Co>')
+        (html, _), (expected_html, _) = email.alternatives[0], expected.alternatives[0]
+        # The same document, though quotes in text are only escaped by the compiled html.
+        self.assertEqual(
+            BeautifulSoup(html, "html.parser").decode(formatter="minimal"),
+            optimize_html(add_tracking(expected_html, email_message.token)),
+        )
+        self.assertIn("Hi &lt;b&gt;Tom &amp; &quot;Jerry&quot;&lt;/b&gt; of A&amp;B &lt;Co&gt;", html)
+
+
+class OptimizeHtmlTests(SimpleTestCase):
+    def optimize(self, style, body):
+        return optimize_html(f"<html><head><style>{style}</style></head><body>{body}</body></html>")
+
+    def test_more_specific_selectors_win(self):
+        html = self.optimize(
+            "#main { color: green } .note { color: blue } p { color: red }",
+            '<p id="main" class="note">x</p><p class="note">y</p><p>z</p>',
+        )
+
+        self.assertIn('<p class="note" id="main" style="color:green">x</p>', html)
+        self.assertIn('<p class="note" style="color:blue">y</p>', html)
+        self.assertIn('<p style="color:red">z</p>', html)
+
+    def test_important_wins_over_the_style_attribute(self):
+        html = self.optimize(
+            "p { color: red !important } .note { color: blue }",
+            '<p style="color: green">x</p><div class="note" style="color: green">y</div>',
+        )
+
+        self.assertIn('<p style="color:red!important">x</p>', html)
+        self.assertIn('<div class="note" style="color:green">y</div>', html)
+
+    def test_inlined_style_blocks_are_removed(self):
+        html = self.optimize("p { font-size: 12px }", "<p>x</p>")
+
+        self.assertEqual(html, '<html><head></head><body><p style="font-size:12px">x</p></body></html>')
+
+    def test_media_queries_stay_in_place(self):
+        html = self.optimize(
+            "@media (max-width: 600px) { p { color: red } } p { font-size: 12px } .ExternalClass { width: 100% }",
+            "<p>x</p>",
+        )
+
+        self.assertIn("<style>@media (max-width:600px){p{color:red}}.ExternalClass{width:100%}</style>", html)
+        self.assertIn('<p style="font-size:12px">x</p>', html)
+
+
+@override_settings(EMAIL_ROUTE_BASE="http://testserver/email")
+class TrackingTests(TestCase):
+    def setUp(self):
+        self.batch = create_batch("Tracked")
+        customers = [Customer.objects.create(first_name="C", email=f"c{i}@example.com") for i in range(2)]
+        self.email_messages = EmailMessage.objects.bulk_create(
+            [self.batch.create_email_message(customer) for customer in customers]
+        )
+        # Only flushed when the test says so.
+        self.buffer = TrackingBuffer(flush_interval=3600)
+        buffer_override = mock.patch("email_tool.views.tracking_buffer", self.buffer)
+        buffer_override.start()
+        self.addCleanup(buffer_override.stop)
+        self.addCleanup(self.buffer.flush)
+
+    def test_click_redirects_to_signed_url(self):
+        response = self.client.get(click_url(self.email_messages[0].pk, "https://example.com/offer?a=1"))
+
+        self.assertRedirects(response, "https://example.com/offer?a=1", fetch_redirect_response=False)
+        self.assertEqual(self.buffer.pending, 1)
+
+    def test_click_rejects_tampered_urls(self):
+        token = self.email_messages[0].pk
+        signed = click_url(token, "https://example.com/offer")
+        for tampered in [
+            signed.replace("example.com", "evil.com"),
+            signed[: signed.index("&sig=")],
+            f"/email/click/{token}?url=https%3A%2F%2Fevil.com",
+            signed[:-1],
+        ]:
+            with self.subTest(tampered):
+                self.assertEqual(self.client.get(tampered).status_code, 404)
+        self.assertEqual(self.buffer.pending, 0)
+
+    def test_hits_are_buffered_and_flushed(self):
+        first, second = self.email_messages
+        for token in [first.pk, first.pk, second.pk, uuid.uuid4()]:
+            self.assertEqual(self.client.get(f"/email/open/{token}.gif").status_code, 200)
+        self.client.get(click_url(first.pk, "https://example.com"))
+
+        first.refresh_from_db()
+        self.assertEqual(first.open_count, 0)
+
+        # The rows are written a chunk at a time, unknown emails are dropped.
+        with mock.patch("email_tool.messaging.tracking.FLUSH_CHUNK_SIZE", 1):
+            self.assertEqual(self.buffer.flush(), 3)
+        self.assertEqual(self.buffer.pending, 0)
+        counts = dict(EmailMessage.objects.values_list("pk", "open_count"))
+        self.assertEqual((counts[first.pk], counts[second.pk]), (2, 1))
+        first.refresh_from_db()
+        self.assertEqual(first.click_count, 1)
+        self.batch.refresh_from_db()
+        self.assertEqual((self.batch.open_count, self.batch.click_count), (3, 1))
+
+
+def delivery_status_notification(recipient, status, action="failed", token=None, returned_as="message/rfc822"):
+    """A bounce for `recipient` as mail servers send them, returning the
+    headers of the email with its `token`.
+    """
+    returned = f"From: sender@example.com\nTo: {recipient}\nSubject: News\n"
+    if token is not None:
+        returned += f"X-Email-Message-Token: {token}\n"
+    if returned_as == "message/rfc822":
+        returned += "\nHi\n"
+    return (
+        "From: MAILER-DAEMON@mx.example.com\n"
+        "To: sender@example.com\n"
+        "Subject: Undelivered Mail Returned to Sender\n"
+        "MIME-Version: 1.0\n"
+        'Content-Type: multipart/report; report-type=delivery-status; boundary="report"\n'
+        "\n"
+        "--report\n"
+        "Content-Type: text/plain\n"
+        "\n"
+        "Your message could not be delivered.\n"
+        "\n"
+        "--report\n"
+        "Content-Type: message/delivery-status\n"
+        "\n"
+        "Reporting-MTA: dns; mx.example.com\n"
+        "\n"
+        f"Final-Recipient: rfc822; {recipient}\n"
+        f"Action: {action}\n"
+        f"Status: {status}\n"
+        f"Diagnostic-Code: smtp; {status[0]}50 {status}\n"
+        "    Mailbox unavailable\n"
+        "\n"
+        "--report\n"
+        f"Content-Type: {returned_as}\n"
+        "\n"
+        f"{returned}"
+        "\n"
+        "--report--\n"
+    ).encode()
+
+
+class BounceTests(TestCase):
+    def parse(self, *args, **kwargs):
+        return parse_dsn(
+            email.message_from_bytes(delivery_status_notification(*args, **kwargs), policy=email.policy.default)
+        )
+
+    def test_hard_bounce(self):
+        token = uuid.uuid4()
+
+        self.assertEqual(
+            self.parse(" Ada@Example.com", "5.1.1", token=token),
+            [Bounce("ada@example.com", "5.1.1", "smtp; 550 5.1.1 Mailbox unavailable", token)],
+        )
+        # Some servers only return the headers.
+        bounces = self.parse("ada@example.com", "5.1.1", token=token, returned_as="text/rfc822-headers")
+        self.assertEqual(bounces[0].message_token, token)
+
+    def test_temporary_failures_are_ignored(self):
+        self.assertEqual(self.parse("ada@example.com", "4.2.2"), [])
+        self.assertEqual(self.parse("ada@example.com", "4.4.7", action="delayed"), [])
+
+    def test_missing_token(self):
+        self.assertIsNone(self.parse("ada@example.com", "5.1.1")[0].message_token)
+        self.assertIsNone(self.parse("ada@example.com", "5.1.1", token="not-a-token")[0].message_token)
+
+    def test_other_email_is_not_a_bounce(self):
+        self.assertEqual(parse_dsn(email.message_from_string("Subject: Re: News\n\nThanks!\n")), [])
+
+    def test_maildir_and_mbox(self):
+        messages = [
+            delivery_status_notification("a@example.com", "5.1.1"),
+            delivery_status_notification("b@example.com", "4.2.2"),
+            delivery_status_notification("c@example.com", "5.2.1"),
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            maildir = mailbox.Maildir(os.path.join(directory, "maildir"))
+            mbox = mailbox.mbox(os.path.join(directory, "bounces.mbox"))
+            for box in [maildir, mbox]:
+                for message in messages:
+                    box.add(message)
+                box.close()
+
+            for path in [maildir._path, mbox._path]:
+                with self.subTest(path):
+                    bounced = [bounce.recipient for message in iter_mailbox(path) for bounce in parse_dsn(message)]
+                    self.assertEqual(sorted(bounced), ["a@example.com", "c@example.com"])
+            with self.assertRaises(FileNotFoundError):
+                next(iter_mailbox(os.path.join(directory, "missing")))
+
+    def test_process_bounces(self):
+        batch = create_batch("Bounced")
+        customer = Customer.objects.create(first_name="A", email="a@example.com", emails_sent_count=1)
+        email_message = batch.create_email_message(customer)
+        email_message.delivery_state, email_message.send_succeeded = DeliveryState.SENT, True
+        EmailMessage.objects.bulk_create([email_message])
+        EmailBatch.objects.filter(pk=batch.pk).update(emails_sent=1)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bounces.mbox")
+            mbox = mailbox.mbox(path)
+            mbox.add(delivery_status_notification("a@example.com", "5.1.1", token=email_message.pk))
+            mbox.add(delivery_status_notification("b@example.com", "4.2.2"))
+            mbox.close()
+            for _ in range(2):
+                call_command("process_bounces", path, stdout=io.StringIO())
+
+        email_message.refresh_from_db()
+        self.assertEqual(email_message.delivery_state, DeliveryState.BOUNCED)
+        batch.refresh_from_db()
+        self.assertEqual(batch.emails_sent, 0)
+        customer.refresh_from_db()
+        self.assertEqual(customer.emails_sent_count, 0)
+        self.assertEqual(list(Suppression.objects.values_list("email", "customer")), [("a@example.com", customer.pk)])
+
+
+class OneClickUnsubscribeTests(TestCase):
+    def setUp(self):
+        self.batch = create_batch("Unsubscribed")
+        self.customer = Customer.objects.create(first_name="C", email="c@example.com")
+        self.email_message = EmailMessage.objects.bulk_create([self.batch.create_email_message(self.customer)])[0]
+        self.url = f"/email/unsubscribe/{self.email_message.pk}/one-click"
+        # Mail clients post without a CSRF token.
+        self.client = Client(enforce_csrf_checks=True)
+
+    def test_post_unsubscribes_once(self):
+        for _ in range(2):
+            response = self.client.post(self.url, {"List-Unsubscribe": "One-Click"})
+            self.assertEqual(response.status_code, 200)
+
+        self.email_message.refresh_from_db()
+        self.assertTrue(self.email_message.unsubscribed)
+        self.batch.refresh_from_db()
+        self.assertEqual(self.batch.unsubscribe_count, 1)
+        self.assertEqual(
+            list(Suppression.objects.values_list("email", "customer")), [("c@example.com", self.customer.pk)]
+        )
+
+    def test_unsubscribing_marks_everyone_using_the_address(self):
+        same_address = Customer.objects.create(first_name="D", email=" C@Example.com")
+
+        # The email and its Customer, the two counters, the suppression and
+        # one UPDATE of the Customers, in a savepoint.
+        with self.assertNumQueries(7):
+            self.assertTrue(EmailMessage.mark_unsubscribed(self.email_message.pk))
+        self.assertEqual(Customer.objects.filter(is_dnc=True).count(), 2)
+        self.assertTrue(Customer.objects.get(pk=same_address.pk).is_dnc)
+
+    def test_get_does_not_unsubscribe(self):
+        response = self.client.get(self.url)
+
+        self.assertRedirects(response, f"/email/unsubscribe/{self.email_message.pk}")
+        self.email_message.refresh_from_db()
+        self.assertFalse(self.email_message.unsubscribed)
+        self.assertFalse(Suppression.objects.exists())
+
+    def test_unknown_email(self):
+        self.assertEqual(self.client.post(f"/email/unsubscribe/{uuid.uuid4()}/one-click").status_code, 404)
+        self.assertFalse(Suppression.objects.exists())
+
+
+class PreviewCacheTests(TestCase):
+    def setUp(self):
+        self.batch = create_batch("Previewed")
+        self.render = mock.Mock(return_value="<html></html>")
+
+    def preview(self, batch=None):
+        return cached_preview((batch or self.batch).pk, "simple.html", ["News"], self.render)
+
+    def test_preview_is_rendered_once(self):
+        self.preview()
+        self.preview()
+
+        self.assertEqual(self.render.call_count, 1)
+
+    def test_saving_the_batch_evicts_its_previews(self):
+        other = create_batch("Other")
+        self.preview()
+        self.preview(other)
+
+        self.batch.save()
+        self.preview()
+        self.preview(other)
+        self.assertEqual(self.render.call_count, 3)
+
+    def test_saving_an_image_evicts_all_previews(self):
+        self.preview()
+
+        self.batch.company_logo.save()
+        self.preview()
+        self.assertEqual(self.render.call_count, 2)
+
+    def test_culled_generation_evicts(self):
+        self.preview()
+
+        cache.delete(preview_module._IMAGES_GENERATION_KEY)
+        self.preview()
+        self.assertEqual(self.render.call_count, 2)
+
+
+class BloomFilterTests(SimpleTestCase):
+    def test_no_false_negatives_and_few_false_positives(self):
+        bloom = BloomFilter(5000, error_rate=0.01)
+        for i in range(5000):
+            bloom.add(f"suppressed{i}@example.com")
+
+        self.assertTrue(all(f"suppressed{i}@example.com" in bloom for i in range(5000)))
+        false_positives = sum(f"other{i}@example.com" in bloom for i in range(20000))
+        self.assertLess(false_positives / 20000, 0.02)
+
+
+class SuppressionListTests(TestCase):
+    def setUp(self):
+        self.by_email = Customer.objects.create(first_name="A", email=" Unsubscribed@Example.com")
+        self.by_customer = Customer.objects.create(first_name="B", email="b@example.com")
+        self.subscribed = Customer.objects.create(first_name="C", email="c@example.com")
+        Suppression.add_email("unsubscribed@example.com")
+        Suppression.add_customer(self.by_customer)
+
+    def test_exact_list(self):
+        suppressed = SuppressionList.load()
+
+        self.assertTrue(suppressed.exact)
+        with self.assertNumQueries(0):
+            self.assertIn(self.by_email, suppressed)
+            self.assertIn(self.by_customer, suppressed)
+            self.assertNotIn(self.subscribed, suppressed)
+
+    def test_bloom_filter_list(self):
+        with mock.patch("email_tool.messaging.suppression.BLOOM_FILTER_THRESHOLD", 0):
+            suppressed = SuppressionList.load()
+
+        self.assertFalse(suppressed.exact)
+        self.assertIn(self.by_email, suppressed)
+        self.assertIn(self.by_customer, suppressed)
+
+    def test_bloom_filter_positives_are_confirmed_in_the_db(self):
+        # A filter with every bit set, so every Customer is a false positive.
+        everyone = BloomFilter(1)
+        everyone.bits = bytearray(b"\xff" * len(everyone.bits))
+        suppressed = SuppressionList(everyone, everyone, exact=False)
+
+        with self.assertNumQueries(1):
+            self.assertNotIn(self.subscribed, suppressed)
+        self.assertIn(self.by_email, suppressed)
+
+
+class CustomerEmailStatsTests(TestCase):
+    def setUp(self):
+        self.ada = Customer.objects.create(first_name="Ada", email="ada@example.com")
+        self.bob = Customer.objects.create(first_name="Bob", email="bob@example.com")
+
+    def test_record_sent(self):
+        sent_at = timezone.now()
+        # One UPDATE per number of emails a Customer was sent.
+        with self.assertNumQueries(2):
+            Customer.record_sent([self.ada.pk, self.bob.pk, self.ada.pk], sent_at)
+
+        self.ada.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual((self.ada.emails_sent_count, self.ada.last_emailed_at), (2, sent_at))
+        self.assertEqual((self.bob.emails_sent_count, self.bob.last_emailed_at), (1, sent_at))
+
+    def test_is_dnc_follows_suppressions_and_email_changes(self):
+        Suppression.add_email("dnc@example.com")
+        self.assertTrue(Customer.objects.create(first_name="New", email=" DNC@example.com").is_dnc)
+
+        self.ada.email = "dnc@example.com"
+        self.ada.save(update_fields=["email"])
+        self.assertTrue(Customer.objects.get(pk=self.ada.pk).is_dnc)
+
+        customer = Customer.objects.get(pk=self.ada.pk)
+        customer.email = "ada@example.com"
+        customer.save()
+        self.assertFalse(Customer.objects.get(pk=self.ada.pk).is_dnc)
+
+        Suppression.add_customer(self.bob)
+        self.assertTrue(Customer.objects.get(pk=self.bob.pk).is_dnc)
+
+    def test_saving_without_email_changes_does_not_look_up_is_dnc(self):
+        customer = Customer.objects.get(pk=self.ada.pk)
+        customer.company = "Analytical Engines"
+        with CaptureQueriesContext(connection) as queries:
+            customer.save()
+        self.assertFalse([query for query in queries if "email_tool_suppression" in query["sql"]])
+
+    def test_refresh_customer_email_stats(self):
+        sent_at = timezone.now()
+        image = ImageResource.objects.create(description="Logo", image="email_images/logo.png")
+        # Rows written around the app, e.g. by an import, so the columns
+        # are out of date.
+        EmailMessage.objects.bulk_create(
+            EmailMessage(
+                customer=self.ada,
+                send_succeeded=send_succeeded,
+                last_attempt_at=sent_at,
+                company_logo=image,
+                primary_image=image,
+            )
+            for send_succeeded in [True, False]
+        )
+        Suppression.objects.bulk_create([Suppression(email="bob@example.com")])
+        Customer.objects.filter(pk=self.bob.pk).update(emails_sent_count=5, last_emailed_at=sent_at)
+
+        out = io.StringIO()
+        call_command("refresh_customer_email_stats", "--dry-run", stdout=out)
+        self.assertIn("2 Customer(s) refreshed (dry run)", out.getvalue())
+        self.assertFalse(Customer.objects.get(pk=self.bob.pk).is_dnc)
+
+        call_command("refresh_customer_email_stats", stdout=io.StringIO())
+        self.ada.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual((self.ada.emails_sent_count, self.ada.last_emailed_at, self.ada.is_dnc), (1, sent_at, False))
+        self.assertEqual((self.bob.emails_sent_count, self.bob.last_emailed_at, self.bob.is_dnc), (0, None, True))
+
+
+@override_settings(
+    UNSUBSCRIBE_ROUTE_BASE="http://testserver/email/unsubscribe",
+    EMAIL_SEND_RATE_PER_MINUTE=100000,
+    EMAIL_SEND_RATE_BURST=100000,
+)
+class EmailQueueWorkerTests(TestCase):
+    def test_a_failing_batch_does_not_stop_the_worker(self):
+        failing, other = create_batch("Failing"), create_batch("Other")
+        other.recipients.add(Customer.objects.create(first_name="C", email="c@example.com"))
+
+        def send(batch):
+            if batch.pk == failing.pk:
+                raise RuntimeError("Boom")
+            return send_email_batch(batch)
+
+        stderr = io.StringIO()
+        with mock.patch("email_tool.management.commands.process_email_queue.send_email_batch", side_effect=send):
+            call_command("process_email_queue", "--once", stdout=io.StringIO(), stderr=stderr)
+
+        self.assertIn("RuntimeError: Boom", stderr.getvalue())
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, EmailBatchStatus.QUEUED)
+        self.assertGreater(failing.next_attempt_at, timezone.now())
+        other.refresh_from_db()
+        self.assertEqual(other.status, EmailBatchStatus.COMPLETED)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_unreachable_relay_puts_the_batch_back_in_the_queue(self):
+        batch = create_batch("Unreachable")
+        batch.recipients.add(Customer.objects.create(first_name="C", email="c@example.com"))
+        # Nothing listens on the port once the socket is closed.
+        with socket.socket() as refusing:
+            refusing.bind(("127.0.0.1", 0))
+            port = refusing.getsockname()[1]
+
+        smtp = override_settings(
+            EMAIL_BACKEND="django.core.mail.backends.smtp.EmailBackend",
+            EMAIL_HOST="127.0.0.1",
+            EMAIL_PORT=port,
+            EMAIL_USE_TLS=False,
+            EMAIL_TIMEOUT=5,
+        )
+        stderr = io.StringIO()
+        with smtp:
+            call_command("process_email_queue", "--once", stdout=io.StringIO(), stderr=stderr)
+
+        self.assertEqual(stderr.getvalue(), "")
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, EmailBatchStatus.QUEUED)
+        self.assertGreater(batch.next_attempt_at, timezone.now())
+        email_message = batch.email_messages.get()
+        self.assertEqual((email_message.delivery_state, email_message.attempts), (DeliveryState.QUEUED, 0))
+
+    def test_abandoned_batch_is_claimed_again(self):
+        customer = Customer.objects.create(first_name="C", email="c@example.com")
+        abandoned = create_batch(
+            "Abandoned", status=EmailBatchStatus.SENDING, claimed_at=timezone.now() - BATCH_LEASE * 2
+        )
+        in_flight = abandoned.create_email_message(customer)
+        in_flight.delivery_state = DeliveryState.SENDING
+        EmailMessage.objects.bulk_create([in_flight])
+        create_batch("Being sent", status=EmailBatchStatus.SENDING, claimed_at=timezone.now())
+
+        self.assertEqual(claim_next_batch(), abandoned)
+        # It may have been delivered before the worker died.
+        self.assertEqual(abandoned.email_messages.get().delivery_state, DeliveryState.FAILED)
+        self.assertIsNone(claim_next_batch())
+
+    def test_resume_refuses_a_batch_that_is_being_sent(self):
+        customer = Customer.objects.create(first_name="C", email="c@example.com")
+        batch = create_batch("Being sent", status=EmailBatchStatus.SENDING, claimed_at=timezone.now())
+        in_flight = batch.create_email_message(customer)
+        in_flight.delivery_state = DeliveryState.SENDING
+        EmailMessage.objects.bulk_create([in_flight])
+
+        with self.assertRaisesMessage(CommandError, "is being sent by a worker"):
+            call_command("resume_batch", str(batch.pk), "--resend-in-flight", stdout=io.StringIO())
+        self.assertEqual(batch.email_messages.get().delivery_state, DeliveryState.SENDING)
+        self.assertEqual(len(mail.outbox), 0)
+
+        EmailBatch.objects.filter(pk=batch.pk).update(claimed_at=timezone.now() - BATCH_LEASE * 2)
+        call_command("resume_batch", str(batch.pk), "--resend-in-flight", stdout=io.StringIO())
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, EmailBatchStatus.COMPLETED)
+        self.assertEqual(batch.email_messages.get().delivery_state, DeliveryState.SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_lease_is_lost_to_another_worker(self):
+        batch = create_batch("Leased", status=EmailBatchStatus.SENDING, claimed_at=timezone.now())
+        lease = BatchLease(batch)
+        EmailBatch.objects.filter(pk=batch.pk).update(claimed_at=timezone.now() + datetime.timedelta(seconds=1))
+
+        with mock.patch.object(batch_module, "LEASE_RENEW_INTERVAL", 0), self.assertRaises(BatchLeaseLost):
+            lease.renew()
+
+
+@override_settings(UNSUBSCRIBE_ROUTE_BASE="http://testserver/email/unsubscribe")
+class StreamingRecipientsTests(TestCase):
+    # Loading the selected Customers at once would take about 6 KB each.
+    CUSTOMERS = 3000
+    MEMORY_CEILING = 4 * 1024 * 1024
+
+    @classmethod
+    def setUpTestData(cls):
+        image = ImageResource.objects.create(description="Logo", image="email_images/logo.png")
+        cls.batch = EmailBatch.objects.create(
+            batch_title="Streaming",
+            subject="News",
+            title="Title",
+            custom_message="Message",
+            call_to_action_button_text="Go",
+            call_to_action_button_link="http://example.com",
+            company_logo=image,
+            primary_image=image,
+        )
+        Customer.objects.bulk_create(
+            [
+                Customer(
+                    first_name=f"C{i}",
+                    email=f"c{i}@example.com",
+                    description="Notes " * 700,
+                    next_action_item="Call back " * 200,
+                )
+                for i in range(cls.CUSTOMERS)
+            ]
+        )
+
+    def test_queuing_and_preparing_a_batch_has_a_memory_ceiling(self):
+        tracemalloc.start()
+        try:
+            added = self.batch.add_recipients(Customer.objects.all())
+            prepare_email_batch(self.batch)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(added, self.CUSTOMERS)
+        self.assertEqual(self.batch.email_messages.count(), self.CUSTOMERS)
+        self.assertLess(peak, self.MEMORY_CEILING)
+
+    def test_send_chunks_load_only_the_columns_the_template_needs(self):
+        self.batch.add_recipients(Customer.objects.all())
+        prepare_email_batch(self.batch)
+
+        chunk = next(_queued_chunks(self.batch, BatchRenderer(self.batch)))
+        customer = chunk[0].customer
+
+        self.assertEqual(len(chunk), SEND_CHUNK_SIZE)
+        self.assertIn("description", customer.get_deferred_fields())
+        self.assertIn("next_action_item", customer.get_deferred_fields())
+        self.assertNotIn("first_name", customer.get_deferred_fields())
+        self.assertIn("custom_message", chunk[0].get_deferred_fields())
+
+
+class QueryPlanTests(TestCase):
+    """The hot lookups use their index instead of scanning the table. The
+    plans are captured with EXPLAIN on seeded data.
+    """
+
+    # A full table scan or a sort on SQLite, a sequential scan on PostgreSQL.
+    SEQUENTIAL_SCAN = r"(?m)\bSCAN (TABLE )?\w+\s*$|USE TEMP B-TREE|Seq Scan"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.assignee = User.objects.create(username="assignee")
+        image = ImageResource.objects.create(description="Logo", image="email_images/logo.png")
+        cls.batch = EmailBatch.objects.create(
+            batch_title="Plans",
+            subject="News",
+            title="Title",
+            custom_message="Message",
+            company_logo=image,
+            primary_image=image,
+        )
+        customers = Customer.objects.bulk_create(
+            [Customer(company=f"Company {i}", email=f"c{i}@example.com") for i in range(200)]
+        )
+        cls.customer = customers[0]
+        EmailMessage.objects.bulk_create(
+            [
+                EmailMessage(
+                    customer=customer,
+                    batch=cls.batch,
+                    company_logo=image,
+                    primary_image=image,
+                    send_succeeded=i % 4 != 0,
+                    unsubscribed=i % 50 == 0,
+                    delivery_state=DeliveryState.SENT if i % 4 else DeliveryState.QUEUED,
+                )
+                for i, customer in enumerate(customers)
+            ]
+        )
+        today = datetime.date.today()
+        NextActionItem.objects.bulk_create(
+            [
+                NextActionItem(
+                    customer=customer,
+                    assignee=cls.assignee,
+                    description="Call",
+                    target_date=today + datetime.timedelta(days=i % 30 - 15),
+                    completed=None if i % 5 == 0 else datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+                )
+                for i, customer in enumerate(customers)
+            ]
+        )
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # The seeded tables are small enough for a sequential scan to be cheapest.
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+        self.assertNotRegex(plan, self.SEQUENTIAL_SCAN)
+
+    def test_email_message_lookups(self):
+        lookups = {
+            "emailmsg_customer_sent_idx": EmailMessage.objects.filter(
+                customer=self.customer, send_succeeded=True
+            ).order_by("-created_at"),
+            "emailmsg_unsubscribed_idx": EmailMessage.objects.filter(customer=self.customer, unsubscribed=True),
+            "emailmsg_batch_sent_idx": EmailMessage.objects.filter(batch=self.batch, send_succeeded=True),
+            "emailmsg_batch_state_idx": self.batch.email_messages.filter(delivery_state=DeliveryState.QUEUED),
+        }
+        for index_name, queryset in lookups.items():
+            with self.subTest(index_name):
+                self.assertUsesIndex(queryset, index_name)
+
+    def test_open_next_action_item_lookups(self):
+        today = datetime.date.today()
+        lookups = {
+            "nextaction_open_assignee_idx": NextActionItem.objects.filter(
+                assignee=self.assignee, completed__isnull=True, target_date__lte=today
+            ),
+            "nextaction_open_customer_idx": self.customer.nextactionitem_set.filter(
+                completed__isnull=True, target_date__lt=today
+            ),
+        }
+        for index_name, queryset in lookups.items():
+            with self.subTest(index_name):
+                self.assertUsesIndex(queryset, index_name)
+
+    def test_suppressed_customer_lookups(self):
+        customers = Customer.objects.annotate(normalized_email=Lower(Trim("email")))
+        lookups = {
+            "by address": customers.filter(normalized_email="c1@example.com"),
+            "by addresses": customers.filter(normalized_email__in=["c1@example.com", "c2@example.com"]),
+        }
+        for name, queryset in lookups.items():
+            with self.subTest(name):
+                self.assertUsesIndex(queryset, "customer_email_normalized_idx")
+
+    def test_admin_orderings(self):
+        orderings = {
+            "customer_company_idx": Customer.objects.order_by("company"),
+            "emailbatch_title_idx": EmailBatch.objects.order_by("batch_title"),
+            "emailmsg_created_idx": EmailMessage.objects.order_by("-created_at"),
+            "nextaction_target_date_idx": NextActionItem.objects.order_by("-target_date"),
+        }
+        for index_name, queryset in orderings.items():
+            with self.subTest(index_name):
+                # A changelist page.
+                self.assertUsesIndex(queryset[:100], index_name)
+
+
+class FilterChoicesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("ada", first_name="Ada")
+        Customer.objects.create(company="Acme", email="a@example.com", state="NY", primary_contact=self.user)
+        load_choices = mock.patch.object(list_filters_module, "_load_choices", wraps=list_filters_module._load_choices)
+        self.load_choices = load_choices.start()
+        self.addCleanup(load_choices.stop)
+
+    def test_choices_are_cached_until_a_change_is_saved(self):
+        self.assertEqual(filter_choices(Customer, "state"), [("NY", "NY")])
+        self.assertEqual(filter_choices(Customer, "state"), [("NY", "NY")])
+        self.assertEqual(self.load_choices.call_count, 1)
+
+        Customer.objects.create(company="Other", email="b@example.com", state="NJ")
+        self.assertEqual(filter_choices(Customer, "state"), [("NJ", "NJ"), ("NY", "NY")])
+
+    def test_saving_a_related_object_evicts(self):
+        self.assertEqual(filter_choices(Customer, "primary_contact"), [(str(self.user.pk), "ada")])
+
+        self.user.username = "ada.lovelace"
+        self.user.save()
+        self.assertEqual(filter_choices(Customer, "primary_contact"), [(str(self.user.pk), "ada.lovelace")])
+
+    def test_logging_in_does_not_evict(self):
+        filter_choices(Customer, "primary_contact")
+
+        self.client.force_login(self.user)
+        filter_choices(Customer, "primary_contact")
+        self.assertEqual(self.load_choices.call_count, 1)
+
+
+class FilterAutocompleteTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(self.user)
+        for company in ["Acme", "Acme Steel", "Globex", "Initech"]:
+            Customer.objects.create(company=company, master_company=company, email=f"{company[0]}@example.com")
+        cache.clear()
+
+    def test_filters_with_many_choices_use_the_autocomplete(self):
+        response = self.client.get("/email_tool/customer/")
+        self.assertNotContains(response, "/email_tool/customer/filter-choices/master_company/")
+
+        with mock.patch.object(list_filters_module, "FILTER_AUTOCOMPLETE_THRESHOLD", 3):
+            response = self.client.get("/email_tool/customer/", {"master_company__exact": "Globex"})
+        self.assertContains(response, 'data-url="/email_tool/customer/filter-choices/master_company/"')
+        # Only the chosen value is rendered, the autocomplete loads the rest.
+        self.assertContains(response, '<option value="Globex" selected>Globex</option>', html=True)
+        self.assertNotContains(response, '<option value="Initech"')
+
+    def get_choices(self, field_path, **params):
+        return self.client.get(f"/email_tool/customer/filter-choices/{field_path}/", params)
+
+    def test_autocomplete_searches_and_pages_the_choices(self):
+        with mock.patch.object(list_filters_module, "FILTER_AUTOCOMPLETE_PAGE_SIZE", 2):
+            self.assertEqual(
+                self.get_choices("master_company", term="").json(),
+                {
+                    "results": [{"id": "Acme", "text": "Acme"}, {"id": "Acme Steel", "text": "Acme Steel"}],
+                    "pagination": {"more": True},
+                },
+            )
+            self.assertEqual(
+                self.get_choices("master_company", page="2").json()["results"],
+                [{"id": "Globex", "text": "Globex"}, {"id": "Initech", "text": "Initech"}],
+            )
+            self.assertEqual(self.get_choices("master_company", page="x").json()["results"][0]["id"], "Acme")
+
+        self.assertEqual(
+            self.get_choices("master_company", term="ACME").json(),
+            {
+                "results": [{"id": "Acme", "text": "Acme"}, {"id": "Acme Steel", "text": "Acme Steel"}],
+                "pagination": {"more": False},
+            },
+        )
+
+    def test_autocomplete_only_serves_cached_filters(self):
+        self.assertEqual(self.get_choices("email").status_code, 404)
+
+        staff = User.objects.create_user("staff", is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.get_choices("master_company").status_code, 403)
+
+
+class FilterChoicesEvictionTests(TransactionTestCase):
+    def test_a_change_saved_by_another_process_evicts(self):
+        Customer.objects.create(company="Acme", email="a@example.com", state="NY")
+        self.assertEqual(filter_choices(Customer, "state"), [("NY", "NY")])
+
+        # Another process, e.g. a web worker, saves a Customer in the same db.
+        script = (
+            "import sys, django; from django.conf import settings; "
+            "settings.DATABASES['default']['NAME'] = sys.argv[1]; django.setup(); "
+            "from email_tool.models import Customer; "
+            "Customer.objects.create(company='Other', email='b@example.com', state='NJ')"
+        )
+        subprocess.run(
+            [sys.executable, "-c", script, connection.settings_dict["NAME"]],
+            cwd=settings.BASE_DIR,
+            check=True,
+            timeout=60,
+        )
+
+        self.assertEqual(filter_choices(Customer, "state"), [("NJ", "NJ"), ("NY", "NY")])
+
+
+class CustomerChangelistTests(TestCase):
+    """The Customer changelist runs the same number of queries however many
+    rows it shows.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(self.user)
+
+    def add_customers(self, count):
+        customers = Customer.objects.bulk_create(
+            [
+                Customer(company=f"Company {i}", email=f"c{i}@example.com", primary_contact=self.user)
+                for i in range(Customer.objects.count(), Customer.objects.count() + count)
+            ]
+        )
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        NextActionItem.objects.bulk_create(
+            [
+                NextActionItem(customer=customer, assignee=self.user, description="Call", target_date=yesterday)
+                for customer in customers
+                for _ in range(2)
+            ]
+        )
+
+    def get_changelist(self):
+        # Both pages load the list filter choices, see `email_tool.list_filters`.
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/email_tool/customer/")
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_queries_do_not_grow_with_the_page(self):
+        self.add_customers(1)
+        _, one_row_queries = self.get_changelist()
+
+        self.add_customers(49)
+        response, page_queries = self.get_changelist()
+        self.assertEqual(len(response.context["cl"].result_list), 50)
+        self.assertEqual(page_queries, one_row_queries)
+        self.assertEqual({customer.pastdue_count for customer in response.context["cl"].result_list}, {2})
+
+
+class CustomerSearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(self.user)
+        self.viking = Customer.objects.create(company="Viking", master_company="Viking", email="v@example.com")
+        self.supplies = Customer.objects.create(
+            company="Viking Industrial Supplies Company of America", email="s@example.com"
+        )
+        self.other = Customer.objects.create(company="Acme", email="a@example.com", relationship_type="PARTNER")
+
+    def search(self, term):
+        return list(search_customers(Customer.objects.all(), term).order_by("-search_rank"))
+
+    def test_better_matches_rank_first(self):
+        self.assertEqual(self.search("viking"), [self.viking, self.supplies])
+        # Every word is matched as a prefix.
+        self.assertEqual(self.search("vik ind"), [self.supplies])
+
+    def test_choices_are_searched_by_label(self):
+        self.assertEqual(self.search("partner"), [self.other])
+
+    def test_search_syntax_is_not_interpreted(self):
+        self.assertEqual(self.search('viking" OR acme'), [])
+        self.assertIsNone(search_customers(Customer.objects.all(), "  "))
+
+    def test_postgresql_uses_the_indexed_expressions(self):
+        with mock.patch.object(connection, "vendor", "postgresql"):
+            sql = str(search_customers(Customer.objects.all(), "viking").query)
+        self.assertIn("""to_tsvector('simple', "email_tool_customer".search_document)""", sql)
+        self.assertIn("word_similarity", sql)
+
+    def test_other_databases_are_not_searched(self):
+        with mock.patch.object(connection, "vendor", "mysql"):
+            self.assertIsNone(search_customers(Customer.objects.all(), "viking"))
+
+    def get_changelist(self, **params):
+        response = self.client.get("/email_tool/customer/", params)
+        self.assertEqual(response.status_code, 200)
+        return list(response.context["cl"].result_list)
+
+    def test_changelist_ranks_results_unless_sorted(self):
+        self.assertEqual(self.get_changelist(q="viking"), [self.viking, self.supplies])
+        # Sorted on the company column, descending.
+        self.assertEqual(self.get_changelist(q="viking", o="-1"), [self.supplies, self.viking])
+
+    def test_changelist_falls_back_to_the_search_fields(self):
+        with mock.patch("email_tool.admin.search_customers", return_value=None):
+            self.assertEqual(self.get_changelist(q="Acme"), [self.other])
+
+    def test_saving_other_fields_keeps_the_search_document(self):
+        self.viking.is_dnc = True
+        with CaptureQueriesContext(connection) as queries:
+            self.viking.save(update_fields=["is_dnc"])
+        sql = [query["sql"] for query in queries if "auditlog" not in query["sql"]]
+        self.assertFalse(
+            [s for s in sql if "email_tool_customer_search" in s or s.startswith("UPDATE") and "search" in s]
+        )
+
+        self.viking.company = "Norse"
+        self.viking.save(update_fields=["company"])
+        self.assertEqual(self.search("norse"), [self.viking])
+        self.assertEqual(self.search("viking"), [self.viking, self.supplies])
+
+    def test_rebuild_customer_search(self):
+        # Not indexed, bulk_create doesn't save().
+        added = Customer.objects.bulk_create([Customer(company="Bulk Imported", email="b@example.com")])[0]
+        Customer.objects.filter(pk=self.other.pk).update(company="Renamed")
+        self.assertEqual(self.search("bulk"), [])
+
+        out = io.StringIO()
+        call_command("rebuild_customer_search", stdout=out)
+
+        self.assertIn("4 Customer(s) rebuilt", out.getvalue())
+        self.assertEqual(self.search("bulk"), [added])
+        self.assertEqual(self.search("renamed"), [self.other])
+        self.assertEqual(self.search("acme"), [])
+        self.assertEqual(Customer.objects.get(pk=added.pk).search_document.split()[:2], ["Bulk", "Imported"])
+
+
+class CustomerSegmentTests(TestCase):
+    """Segments are queued with a single `INSERT ... SELECT`, however many
+    Customers they have.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(self.user)
+        self.segment = CustomerSegment.objects.create(name="NY prospects", relationship_types=["PROSPECT"], state="ny")
+        self.batch = create_batch("Existing")
+        Customer.objects.create(company="NJ", email="nj@example.com", state="NJ")
+        Customer.objects.create(company="Partner", email="p@example.com", state="NY", relationship_type="PARTNER")
+        self.add_prospects(3)
+
+    def add_prospects(self, count):
+        start = Customer.objects.count()
+        Customer.objects.bulk_create(
+            Customer(company=f"Prospect {i}", email=f"c{i}@example.com", state="NY")
+            for i in range(start, start + count)
+        )
+
+    def prospects(self):
+        return set(Customer.objects.filter(company__startswith="Prospect"))
+
+    def test_add_recipients_skips_existing_recipients(self):
+        first = Customer.objects.filter(company__startswith="Prospect").first()
+        self.batch.recipients.add(first)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.batch.add_recipients(self.segment.customers()), 2)
+        self.assertEqual(set(self.batch.recipients.all()), self.prospects())
+        self.assertEqual(self.batch.add_recipients(self.segment.customers()), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.batch.add_recipients(Customer.objects.none()), 0)
+
+    def send_to_segment(self, batch_title):
+        data = {
+            "action": "send_existing_batch_to_segment",
+            "_selected_action": [self.segment.pk],
+            "apply": "Send",
+            "selected_batch": self.batch.pk,
+            "batch_title": batch_title,
+        }
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/email_tool/customersegment/", data)
+        self.assertEqual(response.status_code, 302)
+        return EmailBatch.objects.get(batch_title=batch_title), len(queries)
+
+    def test_send_existing_batch_to_segment(self):
+        response = self.client.post(
+            "/email_tool/customersegment/",
+            {"action": "send_existing_batch_to_segment", "_selected_action": [self.segment.pk]},
+        )
+        self.assertEqual(response.context["recipient_count"], 3)
+
+        batch, few_queries = self.send_to_segment("NY 1")
+        self.assertEqual(batch.segment, self.segment)
+        self.assertEqual(set(batch.recipients.all()), self.prospects())
+
+        self.add_prospects(50)
+        batch, many_queries = self.send_to_segment("NY 2")
+        self.assertEqual(batch.recipients.count(), 53)
+        self.assertEqual(many_queries, few_queries)
+
+    def test_adding_a_batch_with_a_segment_queues_its_customers(self):
+        image = self.batch.company_logo
+        data = {
+            "batch_title": "Added",
+            "template_file": self.batch.template_file,
+            "delivery_engine": DeliveryEngine.SMTP,
+            "subject": "News",
+            "title": "Title",
+            "custom_message": "Message",
+            "call_to_action_button_text": "Go",
+            "call_to_action_button_link": "http://example.com",
+            "company_logo": image.pk,
+            "primary_image": image.pk,
+            "segment": self.segment.pk,
+            "emails_initiated": 0,
+            "emails_skipped": 0,
+        }
+        response = self.client.post("/email_tool/emailbatch/add/", data)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(set(EmailBatch.objects.get(batch_title="Added").recipients.all()), self.prospects())
+
+
+class BatchCountersTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.force_login(self.user)
+        self.batch = self.add_batch("Counted", sent=3, unsubscribed=1)
+
+    def add_batch(self, batch_title, sent, unsubscribed):
+        batch = create_batch(batch_title)
+        customers = Customer.objects.bulk_create(
+            Customer(company=f"{batch_title} {i}", email=f"{batch_title}{i}@example.com") for i in range(sent + 1)
+        )
+        # One email that wasn't sent, which isn't counted.
+        EmailMessage.objects.bulk_create(
+            EmailMessage(
+                customer=customer,
+                batch=batch,
+                company_logo=batch.company_logo,
+                primary_image=batch.primary_image,
+                send_succeeded=i < sent,
+                unsubscribed=i < unsubscribed,
+            )
+            for i, customer in enumerate(customers)
+        )
+        EmailBatch.objects.filter(pk=batch.pk).update(emails_sent=sent, unsubscribe_count=unsubscribed)
+        return batch
+
+    def reconcile(self, *args):
+        out = io.StringIO()
+        call_command("reconcile_batch_counters", *args, stdout=out)
+        return out.getvalue()
+
+    def test_reconcile_fixes_drifted_counters(self):
+        untouched = self.add_batch("Untouched", sent=2, unsubscribed=0)
+        EmailBatch.objects.filter(pk=self.batch.pk).update(emails_sent=10, unsubscribe_count=0)
+
+        out = self.reconcile("--dry-run")
+        self.assertIn("Counted: 10 -> 3 sent, 0 -> 1 unsubscribed", out)
+        self.assertIn("1 batch(es) reconciled (dry run)", out)
+        self.assertEqual(EmailBatch.objects.get(pk=self.batch.pk).emails_sent, 10)
+
+        self.assertIn("1 batch(es) reconciled", self.reconcile())
+        counters = dict(EmailBatch.objects.values_list("pk", "emails_sent"))
+        self.assertEqual(counters, {self.batch.pk: 3, untouched.pk: 2})
+        self.assertEqual(EmailBatch.objects.get(pk=self.batch.pk).unsubscribe_count, 1)
+        self.assertIn("0 batch(es) reconciled", self.reconcile())
+
+    def get_changelist(self):
+        response = self.client.get("/email_tool/emailbatch/")
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_changelist_queries_do_not_grow_with_the_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.get_changelist()
+
+        for i in range(20):
+            self.add_batch(f"Batch {i}", sent=2, unsubscribed=1)
+        # The counters are columns of the batch, not counted per row.
+        with self.assertNumQueries(len(queries)):
+            response = self.get_changelist()
+        self.assertEqual(len(response.context["cl"].result_list), 21)
+        self.assertContains(response, '<td class="field-emails_sent">3</td>', html=True)
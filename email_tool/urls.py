@@ -8,5 +8,8 @@ urlpatterns = [
         views.unsubscribe_confirmed,
         name="unsubscribe_confirmed",
     ),
+    path("unsubscribe/<uuid:message_token>/one-click", views.unsubscribe_one_click, name="unsubscribe_one_click"),
     path("batches/<uuid:batch_token>/preview", views.preview_batch, name="preview_batch"),
+    path("open/<uuid:message_token>.gif", views.track_open, name="track_open"),
+    path("click/<uuid:message_token>", views.track_click, name="track_click"),
 ]
@@ -1,13 +1,17 @@
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import redirect, render, get_object_or_404
 from django.core import mail
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 from django.contrib.auth import get_user_model
-from django.http import HttpResponseRedirect, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotFound
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_exempt
 
 
 from email_tool.models import EmailMessage, EmailBatch, Customer
+from email_tool.messaging.preview import batch_preview
+from email_tool.messaging.tracking import TRACKING_PIXEL, is_signed_url, tracking_buffer
 
 
 @login_required
@@ -16,14 +20,7 @@ def preview_batch(request, batch_token):
 
     customer = Customer(company="Mock Company", first_name="John", last_name="Smith", email="john@smith.com")
 
-    email_message = email_batch.create_email_message(customer)
-
-    context = {
-        "customer": customer,
-        "email_message": email_message,
-        "unsubscribe_link": "https://www.google.com",
-    }
-    return render(request, f"email/{email_message.template_file}", context)
+    return HttpResponse(batch_preview(request, email_batch, customer))
 
 
 def unsubscribe(request, message_token):
@@ -43,25 +40,54 @@ def unsubscribe(request, message_token):
             POST -> Mark Customer is unsubscribed, forward to confirmed page.
             Anything else -> 404 NotFound
     """
-    # Load the EmailMessage object form DB or return BadRequest
-    email_message = get_object_or_404(EmailMessage, pk=message_token)
-
-    # Update the unsubscribed property on the EmailMessage and save.
+    # Mark the EmailMessage unsubscribed and add the Customer to the
+    # suppression list so future batches skip them.
     if request.method == "POST":
-        email_message.unsubscribed = True
-        email_message.save()
+        if not EmailMessage.mark_unsubscribed(message_token):
+            return HttpResponseNotFound()
         return HttpResponseRedirect(f"{message_token}/confirmed")
 
     # Any request type other that POST and GET is forbidden
     elif request.method != "GET":
         return HttpResponseNotFound()
 
+    # Load the EmailMessage object form DB or return BadRequest
+    email_message = get_object_or_404(EmailMessage, pk=message_token)
+
     # The template requires the customer object as context as well as
     # the message token to be sent back in the following up POST request.
     context = {"customer": email_message.customer, "message_token": message_token}
     return render(request, "unsubscribe.html", context)
 
 
+@csrf_exempt
+def unsubscribe_one_click(request, message_token):
+    """One-click unsubscribe (RFC 8058) from the `List-Unsubscribe` header
+    of an email.
+
+    POST http://<app_host>/email/unsubscribe/<message_token>/one-click
+
+    Mail clients POST `List-Unsubscribe=One-Click` here without cookies
+    or a CSRF token, so the token of the email is the only credential,
+    like for the unsubscribe page. Nothing is rendered.
+
+    Returns:
+        POST -> 200 once the Customer is unsubscribed, 404 if the
+                EmailMessage does not exist.
+        GET -> Redirect to the unsubscribe page, for mail clients that
+               open the header's link in a browser instead.
+        Anything else -> 404 NotFound
+    """
+    if request.method == "GET":
+        return redirect("unsubscribe", message_token=message_token)
+    elif request.method != "POST":
+        return HttpResponseNotFound()
+
+    if not EmailMessage.mark_unsubscribed(message_token):
+        return HttpResponseNotFound()
+    return HttpResponse()
+
+
 def unsubscribe_confirmed(request, message_token):
     """Unsubscribe confirmed page.
 
@@ -87,3 +113,34 @@ def unsubscribe_confirmed(request, message_token):
         return render(request, "unsubscribe_confirmed.html", context)
 
     return HttpResponseNotFound()
+
+
+@never_cache
+def track_open(request, message_token):
+    """Open tracking pixel of an email.
+
+    GET http://<app_host>/email/open/<message_token>.gif
+
+    The hit is counted through the write-behind tracking buffer, so this
+    doesn't touch the db. Unknown tokens are dropped when it is flushed.
+    """
+    tracking_buffer.record(message_token, opens=1)
+    return HttpResponse(TRACKING_PIXEL, content_type="image/gif")
+
+
+@never_cache
+def track_click(request, message_token):
+    """Click tracking redirect of a link in an email.
+
+    GET http://<app_host>/email/click/<message_token>?url=<url>&sig=<signature>
+
+    Returns:
+        A redirect to `url` if it was signed by `tracking.click_url()`,
+        otherwise 404, so it can't be used to redirect anywhere else.
+    """
+    url = request.GET.get("url", "")
+    if not is_signed_url(url, request.GET.get("sig", "")):
+        return HttpResponseNotFound()
+
+    tracking_buffer.record(message_token, clicks=1)
+    return HttpResponseRedirect(url)
@@ -0,0 +1,32 @@
+// Turns the list filters with too many choices to list, see
+// `email_tool.list_filters.CachedChoicesFilter`, into autocompletes.
+document.addEventListener("DOMContentLoaded", function () {
+    "use strict";
+    var $ = window.jQuery;
+
+    $(".autocomplete-filter").each(function () {
+        var $select = $(this);
+        $select.select2({
+            width: "auto",
+            allowClear: true,
+            placeholder: $select.data("title"),
+            ajax: {
+                url: $select.data("url"),
+                dataType: "json",
+                delay: 250,
+                data: function (params) {
+                    return {term: params.term, page: params.page};
+                }
+            }
+        });
+
+        // Only a chosen value is submitted with the search form.
+        $select.on("change", function () {
+            if ($select.val()) {
+                $select.attr("name", $select.data("name"));
+            } else {
+                $select.removeAttr("name");
+            }
+        }).trigger("change");
+    });
+});